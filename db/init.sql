@@ -24,8 +24,11 @@ CREATE TABLE IF NOT EXISTS Problem (
     description_path VARCHAR(255) NOT NULL, -- 課題の説明文のファイルパス
     timeMS INT NOT NULL, -- ジャッジの制限時間[ms] e.g., 1000
     memoryMB INT NOT NULL, -- ジャッジの制限メモリ[MB] e.g., 1024
+    outputLimitKB INT NOT NULL DEFAULT 1024, -- ジャッジの標準出力・標準エラー出力の上限[KB] e.g., 1024
     build_script_path VARCHAR(255) NOT NULL, -- ビルドする際に用いるスクリプトファイルのパス
     executable VARCHAR(255) NOT NULL, -- 最終的に得られる実行バイナリ名 e.g., main
+    memoize BOOLEAN NOT NULL DEFAULT TRUE, -- 同じ内容の提出にジャッジ結果を使い回すかどうか(結果が実行ごとに変わる課題ではFALSE)
+    fail_fast BOOLEAN NOT NULL DEFAULT FALSE, -- 最初のAC以外の結果で、残りのジャッジのテストケースを打ち切るかどうか
     PRIMARY KEY (lecture_id, assignment_id, for_evaluation),
     FOREIGN KEY (lecture_id) REFERENCES Lecture(id)
 );
@@ -144,6 +147,8 @@ CREATE TABLE IF NOT EXISTS Submission (
     postbuilt_result ENUM('Unprocessed', 'AC', 'WA', 'TLE', 'MLE', 'CE', 'RE', 'OLE', 'IE') DEFAULT 'Unprocessed', -- postbuiltチェックの結果
     judge_result ENUM('Unprocessed', 'AC', 'WA', 'TLE', 'MLE', 'CE', 'RE', 'OLE', 'IE') DEFAULT 'Unprocessed', -- ジャッジ結果
     message VARCHAR(255) DEFAULT '',
+    fail_fast BOOLEAN DEFAULT NULL, -- 最初のAC以外の結果で残りのテストケースを打ち切るかどうか, NULLなら課題の設定(Problem.fail_fast)に従う
+    worker_id VARCHAR(64) DEFAULT NULL, -- ジャッジを実行した(している)ワーカー(JudgeWorker.id), キューに戻すとNULLになる
     FOREIGN KEY (batch_id) REFERENCES BatchSubmission(id),
     FOREIGN KEY (student_id) REFERENCES Student(id),
     FOREIGN KEY (lecture_id, assignment_id, for_evaluation) REFERENCES Problem(lecture_id, assignment_id, for_evaluation)
@@ -169,7 +174,29 @@ CREATE TABLE IF NOT EXISTS JudgeResult (
     exit_code INT NOT NULL, -- 戻り値
     stdout TEXT NOT NULL, -- 標準出力
     stderr TEXT NOT NULL, -- 標準エラー出力
-    result ENUM('AC', 'WA', 'TLE', 'MLE', 'CE', 'RE', 'OLE', 'IE') NOT NULL, -- 実行結果のステータス、 AC/WA/TLE/MLE/CE/RE/OLE/IE, 参考: https://atcoder.jp/contests/abc367/glossary
+    result ENUM('AC', 'WA', 'TLE', 'MLE', 'CE', 'RE', 'OLE', 'IE', 'SKIP') NOT NULL, -- 実行結果のステータス、 AC/WA/TLE/MLE/CE/RE/OLE/IE/SKIP(fail-fastで打ち切った), 参考: https://atcoder.jp/contests/abc367/glossary
     FOREIGN KEY (submission_id) REFERENCES Submission(id),
     FOREIGN KEY (testcase_id) REFERENCES TestCases(id)
 );
+
+-- JudgeMemoテーブル(同じ内容の提出のジャッジ結果を使い回すためのメモ)の作成
+CREATE TABLE IF NOT EXISTS JudgeMemo (
+    id INT AUTO_INCREMENT PRIMARY KEY, -- メモのID(auto increment)
+    ts TIMESTAMP DEFAULT CURRENT_TIMESTAMP, -- メモが登録された時刻
+    content_hash CHAR(64) NOT NULL, -- 提出されたファイル(名前と内容)のハッシュ値(sha256)
+    problem_hash CHAR(64) NOT NULL, -- 課題の設定・配置ファイル・テストケース・イメージのハッシュ値(sha256)
+    submission_id INT NOT NULL, -- ジャッジ結果のコピー元のジャッジリクエストのID
+    UNIQUE (content_hash, problem_hash),
+    FOREIGN KEY (submission_id) REFERENCES Submission(id)
+);
+
+-- JudgeWorkerテーブル(ジャッジを実行するワーカープロセスの死活監視)の作成
+CREATE TABLE IF NOT EXISTS JudgeWorker (
+    id VARCHAR(64) PRIMARY KEY, -- ワーカーのインスタンスID(プロセスごとに一意)
+    hostname VARCHAR(255) NOT NULL, -- ワーカーが動いているホスト名
+    pid INT NOT NULL, -- ワーカーのプロセスID
+    capacity INT NOT NULL, -- 同時に実行できるジャッジの数
+    running INT NOT NULL DEFAULT 0, -- 実行中のジャッジの数
+    started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, -- ワーカーが起動した時刻
+    heartbeat_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP -- 最後に生存を報告した時刻
+);
@@ -0,0 +1,378 @@
+/*
+ * judge-harness: 1つのコンテナ内で、複数のテストケースを1つずつ子プロセスとして実行する。
+ *
+ * 入力(標準入力): マニフェスト
+ *   <テストケース数>\n
+ *   テストケースごとに
+ *     <実時間の制限[ms]> <CPU時間の制限[s]> <出力の上限[byte]> <引数の数>\n
+ *     引数ごとに <バイト数>\n<バイト列>
+ *     <標準入力のバイト数>\n<バイト列>
+ *
+ * 出力(標準出力): テストケースごとに1行
+ *   <終了コード> <TLE(0/1)> <OLE(0/1)> <MLE(0/1)> <実行時間[ms]> <CPU時間[ms]> <最大メモリ使用量[KB]> <標準出力> <標準エラー出力>\n
+ *   TLEは実時間の制限で強制終了させたかどうか。CPU時間の制限はRLIMIT_CPUで子プロセスに設定する。
+ *   OLEは標準出力・標準エラー出力の合計が上限を超えて強制終了させたかどうか(出力は上限までの先頭部分)。
+ *   上限が0の場合は出力を制限しない。
+ *   MLEは実行中にコンテナのcgroupでOOM killが起きたかどうか(/sys/fs/cgroup/memory.eventsのoom_kill)。
+ *   最大メモリ使用量は子プロセスのru_maxrssで、cgroupのmemory.peakとは異なりページキャッシュ等を含まない。
+ *   標準出力・標準エラー出力はbase64でエンコードし、空の場合は"-"とする。
+ *
+ * 各テストケースは独立したプロセスグループで実行し、終了後(もしくは制限時間の超過後)に
+ * プロセスグループごとSIGKILLで片付ける。終了コードはシグナルで終了した場合128+シグナル番号とする。
+ * テストケースを1つずつ別のコンテナで実行する場合と同じになるように、最初のテストケースの前の
+ * 作業ディレクトリ(カレントディレクトリ)の内容を保存しておき、2つ目以降のテストケースの前に
+ * 作業ディレクトリと一時ディレクトリを空にしてから元に戻す。
+ */
+#define _GNU_SOURCE
+#include <errno.h>
+#include <fcntl.h>
+#include <poll.h>
+#include <signal.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/mman.h>
+#include <sys/resource.h>
+#include <sys/time.h>
+#include <sys/types.h>
+#include <sys/wait.h>
+#include <time.h>
+#include <unistd.h>
+
+typedef struct {
+    char *data;
+    size_t len;
+    size_t cap;
+} buffer_t;
+
+static void die(const char *message) {
+    fprintf(stderr, "judge-harness: %s: %s\n", message, strerror(errno));
+    exit(2);
+}
+
+static void buffer_append(buffer_t *buf, const char *data, size_t len) {
+    if (buf->len + len > buf->cap) {
+        size_t cap = buf->cap ? buf->cap : 4096;
+        while (cap < buf->len + len) cap *= 2;
+        buf->data = realloc(buf->data, cap);
+        if (buf->data == NULL) die("realloc");
+        buf->cap = cap;
+    }
+    memcpy(buf->data + buf->len, data, len);
+    buf->len += len;
+}
+
+/* ---------------- マニフェストの読み込み ---------------- */
+
+static buffer_t manifest;
+static size_t manifest_pos = 0;
+
+static void read_manifest(void) {
+    char chunk[65536];
+    ssize_t n;
+    while ((n = read(STDIN_FILENO, chunk, sizeof(chunk))) != 0) {
+        if (n < 0) {
+            if (errno == EINTR) continue;
+            die("read manifest");
+        }
+        buffer_append(&manifest, chunk, (size_t)n);
+    }
+    /* strtolが終端を越えて読まないように、NUL終端しておく */
+    buffer_append(&manifest, "", 1);
+    manifest.len--;
+}
+
+static long read_number(void) {
+    char *end;
+    while (manifest_pos < manifest.len &&
+           (manifest.data[manifest_pos] == ' ' || manifest.data[manifest_pos] == '\n'))
+        manifest_pos++;
+    if (manifest_pos >= manifest.len) {
+        fprintf(stderr, "judge-harness: unexpected end of manifest\n");
+        exit(2);
+    }
+    /* 数値の後ろには必ず空白か改行があるので、バッファの終端を越えて読むことはない */
+    long value = strtol(manifest.data + manifest_pos, &end, 10);
+    manifest_pos = (size_t)(end - manifest.data);
+    return value;
+}
+
+/* <バイト数>\n<バイト列> を読み込み、NUL終端した文字列を返す */
+static char *read_bytes(size_t *len) {
+    long n = read_number();
+    manifest_pos++; /* 改行を読み飛ばす */
+    if (n < 0 || manifest_pos + (size_t)n > manifest.len) {
+        fprintf(stderr, "judge-harness: broken manifest\n");
+        exit(2);
+    }
+    char *data = malloc((size_t)n + 1);
+    if (data == NULL) die("malloc");
+    memcpy(data, manifest.data + manifest_pos, (size_t)n);
+    data[n] = '\0';
+    manifest_pos += (size_t)n;
+    if (len != NULL) *len = (size_t)n;
+    return data;
+}
+
+/* ---------------- 結果の出力 ---------------- */
+
+static void write_base64(const buffer_t *buf) {
+    static const char table[] =
+        "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/";
+    if (buf->len == 0) {
+        fputc('-', stdout);
+        return;
+    }
+    const unsigned char *p = (const unsigned char *)buf->data;
+    size_t i;
+    for (i = 0; i + 2 < buf->len; i += 3) {
+        uint32_t v = (p[i] << 16) | (p[i + 1] << 8) | p[i + 2];
+        fputc(table[(v >> 18) & 63], stdout);
+        fputc(table[(v >> 12) & 63], stdout);
+        fputc(table[(v >> 6) & 63], stdout);
+        fputc(table[v & 63], stdout);
+    }
+    if (i < buf->len) {
+        uint32_t v = p[i] << 16;
+        if (i + 1 < buf->len) v |= p[i + 1] << 8;
+        fputc(table[(v >> 18) & 63], stdout);
+        fputc(table[(v >> 12) & 63], stdout);
+        fputc(i + 1 < buf->len ? table[(v >> 6) & 63] : '=', stdout);
+        fputc('=', stdout);
+    }
+}
+
+/* ---------------- 作業ディレクトリの復元 ---------------- */
+
+/* 最初のテストケースの前の作業ディレクトリの内容を保存しておく場所 */
+#define SEED_DIR "/.judge-harness-seed"
+
+/* シェルスクリプトを実行し、失敗したら終了する(スクリプトの出力は結果と混ざらないように標準エラー出力に出す) */
+static void run_script(const char *script) {
+    fflush(stdout);
+    pid_t pid = fork();
+    if (pid < 0) die("fork");
+    if (pid == 0) {
+        dup2(STDERR_FILENO, STDOUT_FILENO);
+        execl("/bin/sh", "sh", "-c", script, (char *)NULL);
+        _exit(127);
+    }
+    int status;
+    while (waitpid(pid, &status, 0) < 0) {
+        if (errno != EINTR) die("waitpid");
+    }
+    if (!WIFEXITED(status) || WEXITSTATUS(status) != 0) {
+        fprintf(stderr, "judge-harness: failed to run: %s\n", script);
+        exit(2);
+    }
+}
+
+static void save_workdir(void) {
+    run_script("rm -rf " SEED_DIR " && mkdir " SEED_DIR " && cp -a . " SEED_DIR "/");
+}
+
+static void restore_workdir(void) {
+    run_script(
+        "for d in . /tmp /var/tmp /dev/shm; do [ -d \"$d\" ] && find \"$d\" -mindepth 1 -delete; done; "
+        "cp -a " SEED_DIR "/. .");
+}
+
+/* ---------------- テストケースの実行 ---------------- */
+
+/* コンテナのcgroupでOOM killerにkillされたプロセスの数(読めなければ-1) */
+static long read_oom_kill(void) {
+    FILE *fp = fopen("/sys/fs/cgroup/memory.events", "r");
+    if (fp == NULL) return -1;
+    char key[64];
+    long value;
+    long oom_kill = -1;
+    while (fscanf(fp, "%63s %ld", key, &value) == 2) {
+        if (strcmp(key, "oom_kill") == 0) oom_kill = value;
+    }
+    fclose(fp);
+    return oom_kill;
+}
+
+static int64_t now_ms(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (int64_t)ts.tv_sec * 1000 + ts.tv_nsec / 1000000;
+}
+
+static void run_case(long timeout_ms, long cpu_limit_sec, long output_limit, char **argv, const char *input, size_t input_len) {
+    buffer_t out = {0}, err = {0};
+    int out_pipe[2], err_pipe[2];
+
+    /* 標準入力はメモリ上のファイルから与える(パイプだと書き込みで詰まる可能性がある) */
+    int input_fd = memfd_create("stdin", MFD_CLOEXEC);
+    if (input_fd < 0) die("memfd_create");
+    for (size_t written = 0; written < input_len;) {
+        ssize_t n = write(input_fd, input + written, input_len - written);
+        if (n < 0) die("write stdin");
+        written += (size_t)n;
+    }
+    lseek(input_fd, 0, SEEK_SET);
+
+    if (pipe2(out_pipe, O_CLOEXEC) < 0 || pipe2(err_pipe, O_CLOEXEC) < 0) die("pipe2");
+
+    fflush(stdout);
+    long oom_kill_before = read_oom_kill();
+    int64_t start = now_ms();
+    pid_t pid = fork();
+    if (pid < 0) die("fork");
+    if (pid == 0) {
+        setpgid(0, 0);
+        if (cpu_limit_sec > 0) {
+            /* softでSIGXCPU、hardでSIGKILL */
+            struct rlimit limit = {.rlim_cur = (rlim_t)cpu_limit_sec,
+                                   .rlim_max = (rlim_t)cpu_limit_sec + 1};
+            setrlimit(RLIMIT_CPU, &limit);
+        }
+        dup2(input_fd, STDIN_FILENO);
+        dup2(out_pipe[1], STDOUT_FILENO);
+        dup2(err_pipe[1], STDERR_FILENO);
+        execvp(argv[0], argv);
+        fprintf(stderr, "%s: %s\n", argv[0], strerror(errno));
+        _exit(127);
+    }
+    setpgid(pid, pid);
+    close(input_fd);
+    close(out_pipe[1]);
+    close(err_pipe[1]);
+
+    int64_t deadline = timeout_ms > 0 ? start + timeout_ms : -1;
+    int tle = 0;
+    int ole = 0;
+    int status = 0;
+    struct rusage usage;
+    memset(&usage, 0, sizeof(usage));
+    int reaped = 0;
+
+    struct pollfd fds[2] = {
+        {.fd = out_pipe[0], .events = POLLIN},
+        {.fd = err_pipe[0], .events = POLLIN},
+    };
+    buffer_t *bufs[2] = {&out, &err};
+    int open_fds = 2;
+
+    while (!reaped && !ole) {
+        int timeout = -1;
+        if (deadline >= 0) {
+            int64_t remaining = deadline - now_ms();
+            if (remaining <= 0) {
+                tle = 1;
+                kill(-pid, SIGKILL);
+                break;
+            }
+            timeout = (int)remaining;
+        }
+        if (open_fds == 0) {
+            /* 出力は閉じられたがプロセスはまだ動いている */
+            if (timeout < 0 || timeout > 5) timeout = 5;
+            pid_t r = wait4(pid, &status, WNOHANG, &usage);
+            if (r == pid) {
+                reaped = 1;
+                break;
+            }
+            poll(NULL, 0, timeout);
+            continue;
+        }
+        int ready = poll(fds, 2, timeout);
+        if (ready < 0) {
+            if (errno == EINTR) continue;
+            die("poll");
+        }
+        for (int i = 0; i < 2; i++) {
+            if (fds[i].fd < 0 || !(fds[i].revents & (POLLIN | POLLHUP | POLLERR))) continue;
+            char chunk[65536];
+            ssize_t n = read(fds[i].fd, chunk, sizeof(chunk));
+            if (n > 0) {
+                buffer_append(bufs[i], chunk, (size_t)n);
+                if (output_limit > 0 && out.len + err.len > (size_t)output_limit) {
+                    /* 上限を超えた分は捨てて、プロセスを止める */
+                    if (out.len > (size_t)output_limit) out.len = (size_t)output_limit;
+                    err.len = (size_t)output_limit - out.len < err.len
+                                  ? (size_t)output_limit - out.len
+                                  : err.len;
+                    ole = 1;
+                    kill(-pid, SIGKILL);
+                    break;
+                }
+            } else if (n == 0 || errno != EINTR) {
+                close(fds[i].fd);
+                fds[i].fd = -1;
+                open_fds--;
+            }
+        }
+    }
+
+    if (!reaped) {
+        while (wait4(pid, &status, 0, &usage) < 0 && errno == EINTR)
+            ;
+    }
+    int64_t elapsed = now_ms() - start;
+
+    /* 子プロセスが残していったプロセスも片付ける */
+    kill(-pid, SIGKILL);
+    long oom_kill_after = read_oom_kill();
+    int mle = oom_kill_before >= 0 && oom_kill_after > oom_kill_before;
+    for (int i = 0; i < 2; i++) {
+        if (fds[i].fd >= 0) close(fds[i].fd);
+    }
+
+    int exit_code;
+    if (WIFEXITED(status)) {
+        exit_code = WEXITSTATUS(status);
+    } else if (WIFSIGNALED(status)) {
+        exit_code = 128 + WTERMSIG(status);
+    } else {
+        exit_code = -1;
+    }
+
+    long long cpu_ms = (long long)(usage.ru_utime.tv_sec + usage.ru_stime.tv_sec) * 1000 +
+                       (usage.ru_utime.tv_usec + usage.ru_stime.tv_usec) / 1000;
+    printf("%d %d %d %d %lld %lld %ld ", exit_code, tle, ole, mle, (long long)elapsed, cpu_ms,
+           usage.ru_maxrss);
+    write_base64(&out);
+    fputc(' ', stdout);
+    write_base64(&err);
+    fputc('\n', stdout);
+    fflush(stdout);
+
+    free(out.data);
+    free(err.data);
+}
+
+int main(void) {
+    /* 子プロセスに渡すSIGPIPEの扱いをデフォルトに戻しておく */
+    signal(SIGPIPE, SIG_DFL);
+
+    read_manifest();
+
+    long ncases = read_number();
+    if (ncases > 1) save_workdir();
+    for (long c = 0; c < ncases; c++) {
+        if (c > 0) restore_workdir();
+        long timeout_ms = read_number();
+        long cpu_limit_sec = read_number();
+        long output_limit = read_number();
+        long argc = read_number();
+        if (argc <= 0) {
+            fprintf(stderr, "judge-harness: empty command\n");
+            return 2;
+        }
+        char **argv = calloc((size_t)argc + 1, sizeof(char *));
+        if (argv == NULL) die("calloc");
+        for (long i = 0; i < argc; i++) argv[i] = read_bytes(NULL);
+        size_t input_len;
+        char *input = read_bytes(&input_len);
+
+        run_case(timeout_ms, cpu_limit_sec, output_limit, argv, input, input_len);
+
+        for (long i = 0; i < argc; i++) free(argv[i]);
+        free(argv);
+        free(input);
+    }
+    return 0;
+}
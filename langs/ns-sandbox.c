@@ -0,0 +1,613 @@
+/*
+ * ns-sandbox: Dockerデーモンを介さずに、Linuxのnamespace・cgroup v2・rlimit・seccompで
+ * 1つのコマンドを隔離して実行する。(src/sandbox/namespace.pyから呼び出される)
+ *
+ * 使い方: ns-sandbox [オプション] -- <コマンド> [引数...]
+ *   --rootfs DIR          ルートファイルシステム(イメージを展開したディレクトリ)
+ *   --workdir PATH        作業ディレクトリ(サンドボックス内のパス)
+ *   --env KEY=VALUE       環境変数
+ *   --bind SRC:DST[:ro]   ディレクトリのバインドマウント
+ *   --overlay DST:OPTS    overlayfsのマウント(OPTSはmountのオプション文字列)
+ *   --tmpfs DST:OPTS      tmpfsのマウント
+ *   --copy-file SRC:DST   マウントした後、実行前にファイルをコピーする
+ *   --cgroup DIR          このディレクトリ(cgroup v2)の下に実行ごとのcgroupを作る
+ *   --memory BYTES        メモリ制限(スワップは使わせない)
+ *   --pids N              プロセス数の制限
+ *   --cpus N              CPUの割り当て数(cpu.max)
+ *   --cpuset CPUS         実行に使うコア
+ *   --cpu-sec N           RLIMIT_CPU(softでSIGXCPU、hardでSIGKILL)
+ *   --stack KB            RLIMIT_STACK
+ *   --wall-ms N           実時間の制限
+ *   --network             ネットワークを隔離しない
+ *   --status-fd N         結果を書き込むファイルディスクリプタ
+ *
+ * 結果(status-fdに1行):
+ *   <終了コード> <TLE(0/1)> <実行時間[ms]> <CPU時間[ms]> <最大メモリ使用量[byte]> <OOM kill数>
+ *   サンドボックスを用意できなかった場合は "error <メッセージ>"
+ *   終了コードはシグナルで終了した場合128+シグナル番号とする(docker run --initと同じ)。
+ *   --cgroupを指定しない場合、CPU時間・メモリ使用量はgetrusageの値になる。
+ *
+ * SIGTERMを受け取ると、サンドボックス内のプロセスを全て止めて結果を書き込む。
+ *
+ * サンドボックス内のプロセスはroot(uid 0)のままだが、capabilityを全て落とし、
+ * no_new_privsとseccompで危険なシステムコールを禁止してから実行する。
+ */
+#define _GNU_SOURCE
+#include <errno.h>
+#include <fcntl.h>
+#include <limits.h>
+#include <linux/audit.h>
+#include <linux/filter.h>
+#include <linux/seccomp.h>
+#include <poll.h>
+#include <sched.h>
+#include <signal.h>
+#include <stddef.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/mount.h>
+#include <sys/prctl.h>
+#include <sys/resource.h>
+#include <sys/signalfd.h>
+#include <sys/stat.h>
+#include <sys/syscall.h>
+#include <sys/types.h>
+#include <sys/wait.h>
+#include <time.h>
+#include <unistd.h>
+
+#define MAX_ITEMS 64
+
+typedef struct {
+    char *src;
+    char *dst;
+    char *opts;
+    int readonly;
+} mount_t;
+
+static const char *rootfs = NULL;
+static const char *workdir = "/";
+static char *envs[MAX_ITEMS];
+static int nenvs = 0;
+static mount_t binds[MAX_ITEMS], overlays[MAX_ITEMS], tmpfss[MAX_ITEMS], copies[MAX_ITEMS];
+static int nbinds = 0, noverlays = 0, ntmpfss = 0, ncopies = 0;
+static const char *cgroup_parent = NULL;
+static long long memory_limit = 0;
+static long pids_limit = 0;
+static long cpus = 0;
+static const char *cpuset = NULL;
+static long cpu_limit_sec = 0;
+static long stack_limit_kb = 0;
+static long wall_ms = 0;
+static int enable_network = 0;
+static int status_fd = -1;
+
+static char cgroup_dir[PATH_MAX];
+static int error_pipe[2] = {-1, -1};
+
+/* ---------------- エラー処理 ---------------- */
+
+static void report_error(const char *message) {
+    char line[1024];
+    int len = snprintf(line, sizeof(line), "error %s: %s\n", message, strerror(errno));
+    if (status_fd >= 0 && write(status_fd, line, (size_t)len) < 0) {
+        /* 書き込めなければ終了コードで伝わる */
+    }
+    exit(2);
+}
+
+/* サンドボックス内(子プロセス)でのエラーは、パイプ経由で親プロセスに伝える */
+static void child_error(const char *message) {
+    char line[1024];
+    int len = snprintf(line, sizeof(line), "%s: %s", message, strerror(errno));
+    if (write(error_pipe[1], line, (size_t)len) < 0) {
+        /* 親プロセスは終了コードで失敗を検出する */
+    }
+    _exit(127);
+}
+
+/* ---------------- 引数の解析 ---------------- */
+
+static mount_t parse_mount(char *arg, int with_src) {
+    mount_t m = {0};
+    char *sep = strchr(arg, ':');
+    if (sep == NULL) {
+        fprintf(stderr, "ns-sandbox: invalid mount: %s\n", arg);
+        exit(2);
+    }
+    *sep = '\0';
+    if (with_src) {
+        m.src = arg;
+        m.dst = sep + 1;
+        char *ro = strchr(m.dst, ':');
+        if (ro != NULL) {
+            *ro = '\0';
+            m.readonly = strcmp(ro + 1, "ro") == 0;
+        }
+    } else {
+        m.dst = arg;
+        m.opts = sep + 1;
+    }
+    return m;
+}
+
+static void add_item(mount_t *items, int *n, mount_t item) {
+    if (*n >= MAX_ITEMS) {
+        fprintf(stderr, "ns-sandbox: too many mounts\n");
+        exit(2);
+    }
+    items[(*n)++] = item;
+}
+
+static char **parse_args(int argc, char **argv) {
+    for (int i = 1; i < argc; i++) {
+        const char *opt = argv[i];
+        if (strcmp(opt, "--") == 0) return argv + i + 1;
+        if (strcmp(opt, "--network") == 0) {
+            enable_network = 1;
+            continue;
+        }
+        if (i + 1 >= argc) {
+            fprintf(stderr, "ns-sandbox: missing value for %s\n", opt);
+            exit(2);
+        }
+        char *value = argv[++i];
+        if (strcmp(opt, "--rootfs") == 0) rootfs = value;
+        else if (strcmp(opt, "--workdir") == 0) workdir = value;
+        else if (strcmp(opt, "--env") == 0 && nenvs < MAX_ITEMS) envs[nenvs++] = value;
+        else if (strcmp(opt, "--bind") == 0) add_item(binds, &nbinds, parse_mount(value, 1));
+        else if (strcmp(opt, "--overlay") == 0) add_item(overlays, &noverlays, parse_mount(value, 0));
+        else if (strcmp(opt, "--tmpfs") == 0) add_item(tmpfss, &ntmpfss, parse_mount(value, 0));
+        else if (strcmp(opt, "--copy-file") == 0) add_item(copies, &ncopies, parse_mount(value, 1));
+        else if (strcmp(opt, "--cgroup") == 0) cgroup_parent = value;
+        else if (strcmp(opt, "--memory") == 0) memory_limit = atoll(value);
+        else if (strcmp(opt, "--pids") == 0) pids_limit = atol(value);
+        else if (strcmp(opt, "--cpus") == 0) cpus = atol(value);
+        else if (strcmp(opt, "--cpuset") == 0) cpuset = value;
+        else if (strcmp(opt, "--cpu-sec") == 0) cpu_limit_sec = atol(value);
+        else if (strcmp(opt, "--stack") == 0) stack_limit_kb = atol(value);
+        else if (strcmp(opt, "--wall-ms") == 0) wall_ms = atol(value);
+        else if (strcmp(opt, "--status-fd") == 0) status_fd = atoi(value);
+        else {
+            fprintf(stderr, "ns-sandbox: unknown option: %s\n", opt);
+            exit(2);
+        }
+    }
+    fprintf(stderr, "ns-sandbox: missing command\n");
+    exit(2);
+}
+
+/* ---------------- cgroup ---------------- */
+
+static int write_file(const char *dir, const char *name, const char *value) {
+    char path[PATH_MAX];
+    snprintf(path, sizeof(path), "%s/%s", dir, name);
+    int fd = open(path, O_WRONLY | O_CLOEXEC);
+    if (fd < 0) return -1;
+    ssize_t n = write(fd, value, strlen(value));
+    close(fd);
+    return n < 0 ? -1 : 0;
+}
+
+static long long read_keyed(const char *name, const char *key) {
+    char path[PATH_MAX + 64], buf[4096];
+    snprintf(path, sizeof(path), "%s/%s", cgroup_dir, name);
+    int fd = open(path, O_RDONLY | O_CLOEXEC);
+    if (fd < 0) return -1;
+    ssize_t n = read(fd, buf, sizeof(buf) - 1);
+    close(fd);
+    if (n <= 0) return -1;
+    buf[n] = '\0';
+    if (key == NULL) return atoll(buf);
+    size_t keylen = strlen(key);
+    for (char *line = buf; line != NULL && *line != '\0';) {
+        if (strncmp(line, key, keylen) == 0 && line[keylen] == ' ') return atoll(line + keylen + 1);
+        line = strchr(line, '\n');
+        if (line != NULL) line++;
+    }
+    return -1;
+}
+
+static void setup_cgroup(void) {
+    char value[64];
+    /* 子孫のcgroupでコントローラを使えるようにする(既に有効なら何もしない) */
+    write_file(cgroup_parent, "cgroup.subtree_control", "+memory +pids +cpu +cpuset");
+
+    snprintf(cgroup_dir, sizeof(cgroup_dir), "%s/run-%d", cgroup_parent, (int)getpid());
+    if (mkdir(cgroup_dir, 0755) < 0 && errno != EEXIST) report_error("mkdir cgroup");
+    if (memory_limit > 0) {
+        snprintf(value, sizeof(value), "%lld", memory_limit);
+        if (write_file(cgroup_dir, "memory.max", value) < 0) report_error("memory.max");
+        write_file(cgroup_dir, "memory.swap.max", "0");
+    }
+    if (pids_limit > 0) {
+        snprintf(value, sizeof(value), "%ld", pids_limit);
+        if (write_file(cgroup_dir, "pids.max", value) < 0) report_error("pids.max");
+    }
+    if (cpus > 0) {
+        snprintf(value, sizeof(value), "%ld 100000", cpus * 100000);
+        if (write_file(cgroup_dir, "cpu.max", value) < 0) report_error("cpu.max");
+    }
+    if (cpuset != NULL && write_file(cgroup_dir, "cpuset.cpus", cpuset) < 0) report_error("cpuset.cpus");
+}
+
+static void cleanup_cgroup(void) {
+    if (cgroup_dir[0] == '\0') return;
+    /* 残っているプロセスを全て止めてから削除する(cgroup.killはLinux 5.14以降) */
+    write_file(cgroup_dir, "cgroup.kill", "1");
+    for (int i = 0; i < 100; i++) {
+        if (rmdir(cgroup_dir) == 0 || errno == ENOENT) return;
+        usleep(10000);
+    }
+}
+
+/* ---------------- サンドボックス内の準備 ---------------- */
+
+static void join_path(char *out, const char *base, const char *path) {
+    snprintf(out, PATH_MAX, "%s/%s", base, path[0] == '/' ? path + 1 : path);
+}
+
+static void mkdir_p(const char *path) {
+    char buf[PATH_MAX];
+    snprintf(buf, sizeof(buf), "%s", path);
+    for (char *p = buf + 1; *p != '\0'; p++) {
+        if (*p != '/') continue;
+        *p = '\0';
+        mkdir(buf, 0755);
+        *p = '/';
+    }
+    mkdir(buf, 0755);
+}
+
+static void copy_file(const char *src, const char *dst) {
+    int in = open(src, O_RDONLY | O_CLOEXEC);
+    if (in < 0) child_error("open copy source");
+    struct stat st;
+    if (fstat(in, &st) < 0) child_error("stat copy source");
+    char dir[PATH_MAX];
+    snprintf(dir, sizeof(dir), "%s", dst);
+    char *slash = strrchr(dir, '/');
+    if (slash != NULL && slash != dir) {
+        *slash = '\0';
+        mkdir_p(dir);
+    }
+    int out = open(dst, O_WRONLY | O_CREAT | O_TRUNC | O_CLOEXEC, st.st_mode & 07777);
+    if (out < 0) child_error("open copy destination");
+    char chunk[65536];
+    ssize_t n;
+    while ((n = read(in, chunk, sizeof(chunk))) > 0) {
+        for (ssize_t written = 0; written < n;) {
+            ssize_t w = write(out, chunk + written, (size_t)(n - written));
+            if (w < 0) child_error("write copy destination");
+            written += w;
+        }
+    }
+    if (n < 0) child_error("read copy source");
+    fchmod(out, st.st_mode & 07777);
+    close(in);
+    close(out);
+}
+
+static void bind_device(const char *root, const char *name) {
+    char src[PATH_MAX], dst[PATH_MAX];
+    snprintf(src, sizeof(src), "/dev/%s", name);
+    snprintf(dst, sizeof(dst), "%s/dev/%s", root, name);
+    int fd = open(dst, O_WRONLY | O_CREAT | O_CLOEXEC, 0666);
+    if (fd >= 0) close(fd);
+    if (mount(src, dst, NULL, MS_BIND, NULL) < 0) child_error("bind device");
+}
+
+static void setup_mounts(void) {
+    static const char root[] = "/run/ns-sandbox-root";
+    char target[PATH_MAX];
+
+    /* ホストのマウントに変更が伝わらないようにする */
+    if (mount(NULL, "/", NULL, MS_REC | MS_PRIVATE, NULL) < 0) child_error("make mounts private");
+
+    mkdir_p(root);
+    if (mount(rootfs, root, NULL, MS_BIND | MS_REC, NULL) < 0) child_error("bind rootfs");
+
+    /* /tmpと/dev/shmはDockerのコンテナと同じく書き込めるようにする(使った分はメモリ使用量に計上される) */
+    join_path(target, root, "/tmp");
+    mkdir_p(target);
+    if (mount("tmpfs", target, "tmpfs", MS_NOSUID | MS_NODEV, "mode=1777") < 0) child_error("mount /tmp");
+
+    join_path(target, root, "/dev");
+    mkdir_p(target);
+    if (mount("tmpfs", target, "tmpfs", MS_NOSUID | MS_NOEXEC, "mode=755") < 0) child_error("mount /dev");
+    const char *devices[] = {"null", "zero", "full", "random", "urandom"};
+    for (size_t i = 0; i < sizeof(devices) / sizeof(devices[0]); i++) bind_device(root, devices[i]);
+    join_path(target, root, "/dev/shm");
+    mkdir_p(target);
+    if (mount("tmpfs", target, "tmpfs", MS_NOSUID | MS_NODEV, "mode=1777") < 0) child_error("mount /dev/shm");
+    char link[PATH_MAX];
+    join_path(link, root, "/dev/fd");
+    symlink("/proc/self/fd", link);
+    join_path(link, root, "/dev/stdin");
+    symlink("/proc/self/fd/0", link);
+    join_path(link, root, "/dev/stdout");
+    symlink("/proc/self/fd/1", link);
+    join_path(link, root, "/dev/stderr");
+    symlink("/proc/self/fd/2", link);
+
+    for (int i = 0; i < nbinds; i++) {
+        join_path(target, root, binds[i].dst);
+        mkdir_p(target);
+        if (mount(binds[i].src, target, NULL, MS_BIND | MS_REC, NULL) < 0) child_error("bind mount");
+        if (binds[i].readonly &&
+            mount(NULL, target, NULL, MS_REMOUNT | MS_BIND | MS_RDONLY | MS_NOSUID | MS_NODEV, NULL) < 0)
+            child_error("remount read-only");
+    }
+    for (int i = 0; i < noverlays; i++) {
+        join_path(target, root, overlays[i].dst);
+        mkdir_p(target);
+        if (mount("overlay", target, "overlay", MS_NOSUID | MS_NODEV, overlays[i].opts) < 0)
+            child_error("mount overlay");
+    }
+    for (int i = 0; i < ntmpfss; i++) {
+        join_path(target, root, tmpfss[i].dst);
+        mkdir_p(target);
+        /* mountのオプション文字列のうち、フラグはここで解釈し、残りはtmpfsに渡す */
+        unsigned long flags = MS_NODEV;
+        char data[1024] = "";
+        char opts[1024];
+        snprintf(opts, sizeof(opts), "%s", tmpfss[i].opts);
+        for (char *save, *opt = strtok_r(opts, ",", &save); opt != NULL; opt = strtok_r(NULL, ",", &save)) {
+            if (strcmp(opt, "rw") == 0 || strcmp(opt, "exec") == 0) continue;
+            if (strcmp(opt, "ro") == 0) flags |= MS_RDONLY;
+            else if (strcmp(opt, "noexec") == 0) flags |= MS_NOEXEC;
+            else if (strcmp(opt, "nosuid") == 0) flags |= MS_NOSUID;
+            else {
+                if (data[0] != '\0') strncat(data, ",", sizeof(data) - strlen(data) - 1);
+                strncat(data, opt, sizeof(data) - strlen(data) - 1);
+            }
+        }
+        if (mount("tmpfs", target, "tmpfs", flags, data) < 0) child_error("mount tmpfs");
+    }
+
+    /* 新しいPID namespaceのプロセスだけが見えるprocfs */
+    join_path(target, root, "/proc");
+    mkdir_p(target);
+    if (mount("proc", target, "proc", MS_NOSUID | MS_NODEV | MS_NOEXEC, NULL) < 0) child_error("mount /proc");
+
+    for (int i = 0; i < ncopies; i++) {
+        join_path(target, root, copies[i].dst);
+        copy_file(copies[i].src, target);
+    }
+
+    /* ルートファイルシステム自体は読み取り専用にする(イメージを書き換えられないように) */
+    if (mount(NULL, root, NULL, MS_REMOUNT | MS_BIND | MS_RDONLY, NULL) < 0) child_error("remount rootfs");
+
+    if (chdir(root) < 0) child_error("chdir rootfs");
+    if (chroot(".") < 0) child_error("chroot");
+    if (chdir(workdir) < 0) child_error("chdir workdir");
+}
+
+/* 危険なシステムコールをEPERMで失敗させる */
+static void install_seccomp(void) {
+#if defined(__x86_64__)
+#define SANDBOX_AUDIT_ARCH AUDIT_ARCH_X86_64
+#elif defined(__aarch64__)
+#define SANDBOX_AUDIT_ARCH AUDIT_ARCH_AARCH64
+#endif
+#ifdef SANDBOX_AUDIT_ARCH
+    static const int denied[] = {
+        SYS_ptrace, SYS_mount, SYS_umount2, SYS_pivot_root, SYS_unshare, SYS_setns,
+        SYS_kexec_load, SYS_init_module, SYS_finit_module, SYS_delete_module, SYS_reboot,
+        SYS_swapon, SYS_swapoff, SYS_bpf, SYS_perf_event_open, SYS_keyctl, SYS_add_key,
+        SYS_request_key, SYS_userfaultfd, SYS_open_by_handle_at, SYS_process_vm_readv,
+        SYS_process_vm_writev, SYS_chroot, SYS_acct, SYS_settimeofday, SYS_clock_settime,
+    };
+    enum { NDENIED = sizeof(denied) / sizeof(denied[0]) };
+    struct sock_filter filter[4 + NDENIED * 2 + 1];
+    size_t n = 0;
+    filter[n++] = (struct sock_filter)BPF_STMT(BPF_LD | BPF_W | BPF_ABS, offsetof(struct seccomp_data, arch));
+    filter[n++] = (struct sock_filter)BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, SANDBOX_AUDIT_ARCH, 1, 0);
+    filter[n++] = (struct sock_filter)BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_KILL_PROCESS);
+    filter[n++] = (struct sock_filter)BPF_STMT(BPF_LD | BPF_W | BPF_ABS, offsetof(struct seccomp_data, nr));
+    for (int i = 0; i < NDENIED; i++) {
+        filter[n++] = (struct sock_filter)BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, (unsigned)denied[i], 0, 1);
+        filter[n++] = (struct sock_filter)BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_ERRNO | EPERM);
+    }
+    filter[n++] = (struct sock_filter)BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_ALLOW);
+    struct sock_fprog prog = {.len = (unsigned short)n, .filter = filter};
+    if (prctl(PR_SET_SECCOMP, SECCOMP_MODE_FILTER, &prog) < 0) child_error("seccomp");
+#endif
+}
+
+static void drop_privileges(void) {
+    /* capabilityのbounding setを空にすると、uid 0のままでもexec後のcapabilityは空になる */
+    for (int cap = 0; cap < 64; cap++) {
+        if (prctl(PR_CAPBSET_DROP, cap, 0, 0, 0) < 0 && errno == EINVAL) break;
+    }
+    prctl(PR_CAP_AMBIENT, PR_CAP_AMBIENT_CLEAR_ALL, 0, 0, 0);
+    if (prctl(PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0) < 0) child_error("no_new_privs");
+}
+
+static void set_limits(void) {
+    struct rlimit limit;
+    if (cpu_limit_sec > 0) {
+        limit.rlim_cur = (rlim_t)cpu_limit_sec;
+        limit.rlim_max = (rlim_t)cpu_limit_sec + 1;
+        if (setrlimit(RLIMIT_CPU, &limit) < 0) child_error("RLIMIT_CPU");
+    }
+    if (stack_limit_kb > 0) {
+        limit.rlim_cur = limit.rlim_max = (rlim_t)stack_limit_kb * 1024;
+        if (setrlimit(RLIMIT_STACK, &limit) < 0) child_error("RLIMIT_STACK");
+    }
+    limit.rlim_cur = limit.rlim_max = 0;
+    setrlimit(RLIMIT_CORE, &limit);
+}
+
+/* PID namespaceのinit(PID 1)。コマンドを子プロセスとして実行し、終了するまで孤児を回収する */
+static int run_init(char **command, int sync_fd) {
+    char c;
+    /* 親プロセスがcgroupへの移動を終えるまで待つ */
+    if (read(sync_fd, &c, 1) != 1) child_error("wait for parent");
+    close(sync_fd);
+
+    if (cgroup_parent != NULL && unshare(CLONE_NEWCGROUP) < 0) child_error("unshare cgroup");
+    setup_mounts();
+    sethostname("sandbox", 7);
+
+    pid_t pid = fork();
+    if (pid < 0) child_error("fork");
+    if (pid == 0) {
+        set_limits();
+        drop_privileges();
+        install_seccomp();
+        /* コマンドはサンドボックス内のPATHから探す */
+        clearenv();
+        for (int i = 0; i < nenvs; i++) putenv(envs[i]);
+        execvp(command[0], command);
+        child_error(command[0]);
+    }
+    close(error_pipe[1]);
+
+    int status = 0;
+    for (;;) {
+        int s;
+        pid_t r = wait(&s);
+        if (r < 0 && errno == EINTR) continue;
+        if (r < 0) break;
+        if (r == pid) {
+            status = s;
+            break;
+        }
+    }
+    /* PID 1が終了すると、namespace内の残りのプロセスは全てSIGKILLで止められる */
+    if (WIFEXITED(status)) return WEXITSTATUS(status);
+    if (WIFSIGNALED(status)) return 128 + WTERMSIG(status);
+    return 1;
+}
+
+/* ---------------- 親プロセス ---------------- */
+
+static int64_t now_ms(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (int64_t)ts.tv_sec * 1000 + ts.tv_nsec / 1000000;
+}
+
+int main(int argc, char **argv) {
+    char **command = parse_args(argc, argv);
+    if (rootfs == NULL) {
+        fprintf(stderr, "ns-sandbox: --rootfs is required\n");
+        return 2;
+    }
+
+    if (cgroup_parent != NULL) setup_cgroup();
+
+    int sync_pipe[2];
+    if (pipe2(sync_pipe, O_CLOEXEC) < 0 || pipe2(error_pipe, O_CLOEXEC) < 0) report_error("pipe2");
+
+    /* SIGTERMはsignalfdで受け取る(子プロセスではデフォルトに戻す) */
+    sigset_t mask, oldmask;
+    sigemptyset(&mask);
+    sigaddset(&mask, SIGTERM);
+    sigaddset(&mask, SIGCHLD);
+    sigprocmask(SIG_BLOCK, &mask, &oldmask);
+
+    int flags = CLONE_NEWNS | CLONE_NEWPID | CLONE_NEWIPC | CLONE_NEWUTS;
+    if (!enable_network) flags |= CLONE_NEWNET;
+    pid_t child = (pid_t)syscall(SYS_clone, flags | SIGCHLD, NULL, NULL, NULL, NULL);
+    if (child < 0) report_error("clone");
+    if (child == 0) {
+        sigprocmask(SIG_SETMASK, &oldmask, NULL);
+        close(sync_pipe[1]);
+        close(error_pipe[0]);
+        if (status_fd >= 0) close(status_fd);
+        _exit(run_init(command, sync_pipe[0]));
+    }
+    close(sync_pipe[0]);
+    close(error_pipe[1]);
+
+    if (cgroup_parent != NULL) {
+        char pid[32];
+        snprintf(pid, sizeof(pid), "%d", (int)child);
+        if (write_file(cgroup_dir, "cgroup.procs", pid) < 0) {
+            kill(child, SIGKILL);
+            waitpid(child, NULL, 0);
+            cleanup_cgroup();
+            report_error("cgroup.procs");
+        }
+    }
+
+    /* 標準入出力はサンドボックス内のプロセスだけが持つようにする(全員終了したらEOFになる) */
+    int devnull = open("/dev/null", O_RDWR | O_CLOEXEC);
+    dup2(devnull, STDIN_FILENO);
+    dup2(devnull, STDOUT_FILENO);
+
+    int64_t start = now_ms();
+    if (write(sync_pipe[1], "x", 1) != 1) report_error("start sandbox");
+    close(sync_pipe[1]);
+
+    int sfd = signalfd(-1, &mask, SFD_CLOEXEC);
+    if (sfd < 0) report_error("signalfd");
+
+    int tle = 0, status = 0, reaped = 0;
+    struct rusage usage;
+    memset(&usage, 0, sizeof(usage));
+    int64_t deadline = wall_ms > 0 ? start + wall_ms : -1;
+    while (!reaped) {
+        pid_t r = wait4(child, &status, WNOHANG, &usage);
+        if (r == child) {
+            reaped = 1;
+            break;
+        }
+        int timeout = -1;
+        if (deadline >= 0) {
+            int64_t remaining = deadline - now_ms();
+            if (remaining <= 0) {
+                tle = 1;
+                break;
+            }
+            timeout = (int)remaining;
+        }
+        struct pollfd pfd = {.fd = sfd, .events = POLLIN};
+        if (poll(&pfd, 1, timeout) > 0) {
+            struct signalfd_siginfo info;
+            if (read(sfd, &info, sizeof(info)) == sizeof(info) && info.ssi_signo == SIGTERM) break;
+        }
+    }
+    if (!reaped) {
+        /* PID 1を止めればnamespace内のプロセスは全て止まる */
+        kill(child, SIGKILL);
+        while (wait4(child, &status, 0, &usage) < 0 && errno == EINTR)
+            ;
+    }
+    int64_t elapsed = now_ms() - start;
+
+    char error[1024];
+    ssize_t errlen = read(error_pipe[0], error, sizeof(error) - 1);
+    if (errlen > 0) {
+        error[errlen] = '\0';
+        cleanup_cgroup();
+        dprintf(status_fd, "error %s\n", error);
+        return 2;
+    }
+
+    long long cpu_ms = (long long)(usage.ru_utime.tv_sec + usage.ru_stime.tv_sec) * 1000 +
+                       (usage.ru_utime.tv_usec + usage.ru_stime.tv_usec) / 1000;
+    long long memory = (long long)usage.ru_maxrss * 1024;
+    long long oom_kill = 0;
+    if (cgroup_parent != NULL) {
+        long long usage_usec = read_keyed("cpu.stat", "usage_usec");
+        if (usage_usec >= 0) cpu_ms = usage_usec / 1000;
+        long long peak = read_keyed("memory.peak", NULL);
+        if (peak >= 0) memory = peak;
+        long long oom = read_keyed("memory.events", "oom_kill");
+        if (oom >= 0) oom_kill = oom;
+        cleanup_cgroup();
+    }
+
+    int exit_code = -1;
+    if (WIFEXITED(status)) exit_code = WEXITSTATUS(status);
+    else if (WIFSIGNALED(status)) exit_code = 128 + WTERMSIG(status);
+
+    dprintf(status_fd, "%d %d %lld %lld %lld %lld\n", exit_code, tle, (long long)elapsed, cpu_ms, memory,
+            oom_kill);
+    return 0;
+}
@@ -0,0 +1,126 @@
+# 1テストケースあたりのsandboxのオーバーヘッドを計測するベンチマーク
+# 実行方法
+# $ cd src
+# $ python benchmark_sandbox.py --iterations 20
+#
+# 以下の2つを比較する。
+# * cli: dockerコマンドのサブプロセスを使う従来の経路
+#        (volume create → cp -aでクローン → create → start -i → inspect → rm → volume rm)
+# * api: Docker Engine APIを直接使う経路(Volume.clone → TaskInfo.run → Volume.remove)
+import argparse
+import statistics
+import subprocess
+import time
+import uuid
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from sandbox.execute import TaskInfo
+from sandbox.execute import Volume
+from sandbox.execute import VolumeMountInfo
+
+
+def docker_cli(*args: str, stdin: str | None = None) -> str:
+    result = subprocess.run(
+        ["docker", *args], capture_output=True, text=True, input=stdin, check=True
+    )
+    return result.stdout.strip()
+
+
+# dockerコマンドを使って、1テストケース分の処理を行う
+def run_testcase_by_cli(initial_volume: Volume, image: str) -> None:
+    volume_name = "volume-" + str(uuid.uuid4())
+    docker_cli("volume", "create", "--name", volume_name)
+
+    # ボリュームのクローン
+    container_id = docker_cli(
+        "create", "-v", f"{initial_volume.name}:/src", "-v", f"{volume_name}:/dst",
+        "ubuntu", "cp", "-a", "/src/.", "/dst/",
+    )
+    docker_cli("start", "-a", container_id)
+    docker_cli("container", "rm", container_id)
+
+    # テストケースの実行
+    container_id = docker_cli(
+        "create", "-i", "--init", "--network", "none", "--memory=256m",
+        "--memory-swap=256m", "--workdir", "/workdir/",
+        "-v", f"{volume_name}:/workdir/", image, "cat", "input.txt",
+    )
+    docker_cli("start", "-i", container_id, stdin="")
+    docker_cli("inspect", "--format={{.State.ExitCode}}", container_id)
+    docker_cli("container", "rm", container_id)
+
+    docker_cli("volume", "rm", volume_name)
+
+
+# Docker Engine APIを使って、1テストケース分の処理を行う
+def run_testcase_by_api(initial_volume: Volume, image: str) -> None:
+    volume, err = initial_volume.clone()
+    assert err.silence(), err
+
+    task = TaskInfo(
+        name=image,
+        arguments=["cat", "input.txt"],
+        workDir="/workdir/",
+        volumeMountInfo=[VolumeMountInfo(path="/workdir/", volume=volume)],
+        memoryLimitMB=256,
+    )
+    result, err = task.run()
+    assert err.silence(), err
+    assert result.exitCode == 0
+
+    err = volume.remove()
+    assert err.silence(), err
+
+
+def measure(func, initial_volume: Volume, image: str, iterations: int) -> list[float]:
+    elapsed_ms = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func(initial_volume, image)
+        elapsed_ms.append((time.perf_counter() - start) * 1000)
+    return elapsed_ms
+
+
+def report(label: str, elapsed_ms: list[float]) -> None:
+    elapsed_ms = sorted(elapsed_ms)
+    p95 = elapsed_ms[min(len(elapsed_ms) - 1, int(len(elapsed_ms) * 0.95))]
+    print(
+        f"{label:>4}: mean={statistics.mean(elapsed_ms):8.1f}ms "
+        f"median={statistics.median(elapsed_ms):8.1f}ms p95={p95:8.1f}ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="sandboxのテストケースあたりのオーバーヘッドを計測する")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--image", default="binary-runner")
+    args = parser.parse_args()
+
+    initial_volume, err = Volume.create()
+    assert err.silence(), err
+
+    try:
+        with TemporaryDirectory() as tempdir:
+            input_path = Path(tempdir) / "input.txt"
+            input_path.write_text("Hello, World!\n")
+            err = initial_volume.copyFile(input_path, Path("input.txt"))
+            assert err.silence(), err
+
+        # 初回はイメージの読み込み等が入るので、計測から除外する
+        run_testcase_by_cli(initial_volume, args.image)
+        run_testcase_by_api(initial_volume, args.image)
+
+        cli_ms = measure(run_testcase_by_cli, initial_volume, args.image, args.iterations)
+        api_ms = measure(run_testcase_by_api, initial_volume, args.image, args.iterations)
+    finally:
+        initial_volume.remove()
+
+    print(f"per-testcase overhead ({args.iterations} iterations, image={args.image})")
+    report("cli", cli_ms)
+    report("api", api_ms)
+    print(f"speedup: {statistics.median(cli_ms) / statistics.median(api_ms):.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,11 @@
 # Create, Read, Update and Delete (CRUD)
 from sqlalchemy.orm import Session
+from sqlalchemy import and_, func, literal_column, or_
+from sqlalchemy.exc import IntegrityError
 from pathlib import Path
 from dataclasses import dataclass
 from datetime import datetime
+from typing import Callable
 
 from . import models
 
@@ -44,19 +47,70 @@ class SubmissionRecord:
     postbuilt_result: JudgeSummaryStatus
     judge_result: JudgeSummaryStatus
     message: str
+    fail_fast: bool | None = None  # 最初のAC以外の結果で残りのテストケースを打ち切るか(Noneなら課題の設定に従う)
+
+@dataclass
+class QueuedJudgeRecord:
+    id: int
+    batch_id: int | None
+    lecture_id: int
+    wait_sec: int  # キューに入ってからの経過時間[秒]
+
+# 提出IDの古い順にn件選ぶ(スケジューラを指定しない場合)
+def _select_oldest(candidates: list[QueuedJudgeRecord], n: int) -> list[QueuedJudgeRecord]:
+    return sorted(candidates, key=lambda candidate: candidate.id)[:n]
 
 # Submissionテーブルから、statusが"queued"のジャッジリクエストを数件取得し、statusを"running"
 # に変え、変更したリクエスト(複数)を返す
-def fetch_queued_judge_and_change_status_to_running(db: Session, n: int) -> list[SubmissionRecord]:
+# selectには、候補から実行するリクエストを実行する順に選ぶ関数を渡す(scheduler.JudgeScheduler.select)
+def fetch_queued_judge_and_change_status_to_running(
+    db: Session,
+    n: int,
+    select: Callable[[list[QueuedJudgeRecord], int], list[QueuedJudgeRecord]] = _select_oldest,
+    worker_id: str | None = None,
+) -> list[SubmissionRecord]:
     logger.info("fetch_queued_judgeが呼び出されました")
+    if n <= 0:
+        return []
     try:
-        # FOR UPDATE NOWAITを使用して排他的にロックを取得
-        submission_list = db.query(models.Submission).filter(models.Submission.progress == 'queued').with_for_update(nowait=True).limit(n).all()
+        # 候補として、バッチ(フォーマットチェックはまとめて1つ)・授業ごとに古い順にn件ずつ取得する
+        # (1つのバッチに大量のリクエストがあっても、他のリクエストが候補から漏れないようにする)
+        rank = func.row_number().over(
+            partition_by=(models.Submission.batch_id, models.Submission.lecture_id),
+            order_by=models.Submission.id,
+        ).label("rank")
+        queued = db.query(
+            models.Submission.id,
+            models.Submission.batch_id,
+            models.Submission.lecture_id,
+            func.timestampdiff(literal_column("SECOND"), models.Submission.ts, func.now()).label("wait_sec"),
+            rank,
+        ).filter(models.Submission.progress == 'queued').subquery()
+        candidates = [
+            QueuedJudgeRecord(id=row.id, batch_id=row.batch_id, lecture_id=row.lecture_id, wait_sec=row.wait_sec or 0)
+            for row in db.query(queued).filter(queued.c.rank <= n).all()
+        ]
+        selected_ids = [candidate.id for candidate in select(candidates, n)][:n]
+        if len(selected_ids) == 0:
+            db.commit()
+            return []
+
+        # FOR UPDATE SKIP LOCKEDを使用して排他的にロックを取得
+        # (他のワーカーがロックしているもの・先にrunningにしたものは除く。NOWAITと違い、他のワーカーと
+        # 同時に取得しても失敗せず、ロックできたものだけを取得する)
+        submission_list = db.query(models.Submission).filter(
+            models.Submission.id.in_(selected_ids),
+            models.Submission.progress == 'queued'
+        ).with_for_update(skip_locked=True).all()
         
         for submission in submission_list:
             submission.progress = 'running'
+            submission.worker_id = worker_id
         
         db.commit()
+        # スケジューラが選んだ順に返す
+        order = {submission_id: i for i, submission_id in enumerate(selected_ids)}
+        submission_list.sort(key=lambda submission: order[submission.id])
         return [
             SubmissionRecord(
                 id=submission.id,
@@ -70,7 +124,8 @@ def fetch_queued_judge_and_change_status_to_running(db: Session, n: int) -> list
                 prebuilt_result=JudgeSummaryStatus(submission.prebuilt_result),
                 postbuilt_result=JudgeSummaryStatus(submission.postbuilt_result),
                 judge_result=JudgeSummaryStatus(submission.judge_result),
-                message=submission.message)
+                message=submission.message,
+                fail_fast=submission.fail_fast)
             for submission in submission_list
         ]
     except Exception as e:
@@ -89,6 +144,9 @@ class ProblemRecord:
     memoryMB: int
     build_script_path: str
     executable: str
+    outputLimitKB: int = 1024
+    memoize: bool = True  # 同じ内容の提出にジャッジ結果を使い回すかどうか
+    fail_fast: bool = False  # 最初のAC以外の結果で、残りのジャッジのテストケースを打ち切るかどうか
 
 # lecture_id, assignment_id, for_evaluationのデータから、それに対応するProblemデータ(実行ファイル名、制限リソース量)を取得する
 def fetch_problem(db: Session, lecture_id: int, assignment_id: int, for_evaluation: bool) -> ProblemRecord | None:
@@ -108,7 +166,10 @@ def fetch_problem(db: Session, lecture_id: int, assignment_id: int, for_evaluati
             timeMS=problem.timeMS,
             memoryMB=problem.memoryMB,
             build_script_path=problem.build_script_path,
-            executable=problem.executable
+            executable=problem.executable,
+            outputLimitKB=problem.outputLimitKB,
+            memoize=problem.memoize,
+            fail_fast=problem.fail_fast
         )
 
     return None
@@ -197,6 +258,7 @@ class SingleJudgeStatus(Enum):
     RE = 'RE'
     OLE = 'OLE'
     IE = 'IE'
+    SKIP = 'SKIP' # fail-fastで実行を打ち切ったテストケース
     
 @dataclass
 class JudgeResultRecord:
@@ -245,20 +307,98 @@ def update_submission_record(db: Session, submission_record: SubmissionRecord) -
     raw_submission_record.message = submission_record.message
     db.commit()
 
+# 特定のジャッジリクエストをSubmissionテーブルから取得する
+def fetch_submission_record(db: Session, submission_id: int) -> SubmissionRecord | None:
+    logger.info("call fetch_submission_record")
+    submission = db.query(models.Submission).filter(models.Submission.id == submission_id).first()
+    if submission is None:
+        return None
+    return SubmissionRecord(
+        id=submission.id,
+        ts=submission.ts,
+        batch_id=submission.batch_id,
+        student_id=submission.student_id,
+        lecture_id=submission.lecture_id,
+        assignment_id=submission.assignment_id,
+        for_evaluation=submission.for_evaluation,
+        progress=SubmissionProgressStatus(submission.progress),
+        prebuilt_result=JudgeSummaryStatus(submission.prebuilt_result),
+        postbuilt_result=JudgeSummaryStatus(submission.postbuilt_result),
+        judge_result=JudgeSummaryStatus(submission.judge_result),
+        message=submission.message,
+        fail_fast=submission.fail_fast)
+
+@dataclass
+class JudgeMemoRecord:
+    content_hash: str  # 提出されたファイルのハッシュ値
+    problem_hash: str  # 課題のハッシュ値
+    submission_id: int  # ジャッジ結果のコピー元のジャッジリクエストのID
+
+# 同じ内容の提出・同じ課題のジャッジ結果のメモをJudgeMemoテーブルから取得する
+def fetch_judge_memo(db: Session, content_hash: str, problem_hash: str) -> JudgeMemoRecord | None:
+    logger.info("call fetch_judge_memo")
+    memo = db.query(models.JudgeMemo).filter(
+        models.JudgeMemo.content_hash == content_hash,
+        models.JudgeMemo.problem_hash == problem_hash
+    ).first()
+    if memo is None:
+        return None
+    return JudgeMemoRecord(
+        content_hash=memo.content_hash,
+        problem_hash=memo.problem_hash,
+        submission_id=memo.submission_id
+    )
+
+# ジャッジ結果のメモをJudgeMemoテーブルに登録する
+# 同じ内容の提出が同時にジャッジされた場合等で既に登録されていれば、何もしない
+def register_judge_memo(db: Session, memo: JudgeMemoRecord) -> None:
+    logger.info("call register_judge_memo")
+    db.add(models.JudgeMemo(
+        content_hash=memo.content_hash,
+        problem_hash=memo.problem_hash,
+        submission_id=memo.submission_id
+    ))
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+
+# あるジャッジリクエストのJudgeResultを、別のジャッジリクエストのものとしてコピーする
+def copy_judge_results(db: Session, src_submission_id: int, dst_submission_id: int) -> None:
+    logger.info("call copy_judge_results")
+    raw_judge_results = db.query(models.JudgeResult).filter(models.JudgeResult.submission_id == src_submission_id).all()
+    for raw_result in raw_judge_results:
+        db.add(models.JudgeResult(
+            submission_id=dst_submission_id,
+            testcase_id=raw_result.testcase_id,
+            timeMS=raw_result.timeMS,
+            memoryKB=raw_result.memoryKB,
+            exit_code=raw_result.exit_code,
+            stdout=raw_result.stdout,
+            stderr=raw_result.stderr,
+            result=raw_result.result
+        ))
+    db.commit()
+
 # Undo処理: judge-serverをシャットダウンするときに実行する
 # 1. その時点でstatusが"running"になっているジャッジリクエスト(from Submissionテーブル)を
 #    全て"queued"に変更する
 # 2. 変更したジャッジリクエストについて、それに紐づいたJudgeResultを全て削除する
-def undo_running_submissions(db: Session) -> None:
+# worker_idを指定した場合は、そのワーカーが実行しているものだけを戻す(他のワーカーのジャッジには触らない)
+def undo_running_submissions(db: Session, worker_id: str | None = None) -> None:
     logger.info("call undo_running_submissions")
     # 1. "running"状態のSubmissionを全て取得
-    running_submissions = db.query(models.Submission).filter(models.Submission.progress == "running").all()
+    query = db.query(models.Submission).filter(models.Submission.progress == "running")
+    if worker_id is not None:
+        query = query.filter(models.Submission.worker_id == worker_id)
+    running_submissions = query.all()
     
     submission_id_list = [submission.id for submission in running_submissions]
     
     # すべてのrunning submissionのstatusを"queued"に変更
     for submission in running_submissions:
         submission.progress = "queued"
+        submission.worker_id = None
     
     db.commit()
     
@@ -267,12 +407,78 @@ def undo_running_submissions(db: Session) -> None:
     # 変更をコミット
     db.commit()
 
+@dataclass
+class JudgeWorkerRecord:
+    id: str  # ワーカーのインスタンスID
+    hostname: str
+    pid: int
+    capacity: int  # 同時に実行できるジャッジの数
+    running: int = 0  # 実行中のジャッジの数
+
+# ワーカーの生存をJudgeWorkerテーブルに報告する(無ければ登録する)
+def register_worker_heartbeat(db: Session, worker: JudgeWorkerRecord) -> None:
+    row = db.query(models.JudgeWorker).filter(models.JudgeWorker.id == worker.id).first()
+    if row is None:
+        row = models.JudgeWorker(id=worker.id)
+        db.add(row)
+    row.hostname = worker.hostname
+    row.pid = worker.pid
+    row.capacity = worker.capacity
+    row.running = worker.running
+    # ホスト間で時計がずれていても比べられるように、DBサーバーの時刻を使う
+    row.heartbeat_at = func.now()
+    db.commit()
+
+# 終了するワーカーをJudgeWorkerテーブルから削除する
+def unregister_worker(db: Session, worker_id: str) -> None:
+    db.query(models.JudgeWorker).filter(models.JudgeWorker.id == worker_id).delete(synchronize_session=False)
+    db.commit()
+
+# timeout_sec秒以内に生存を報告したワーカーのホスト名を返す
+def fetch_live_worker_hostnames(db: Session, timeout_sec: float) -> set[str]:
+    rows = db.query(models.JudgeWorker.hostname).filter(
+        func.timestampdiff(literal_column("SECOND"), models.JudgeWorker.heartbeat_at, func.now()) <= timeout_sec
+    ).distinct().all()
+    return {row.hostname for row in rows}
+
+# timeout_sec秒以内に生存を報告したワーカーのIDを返す
+def fetch_live_worker_ids(db: Session, timeout_sec: float) -> set[str]:
+    rows = db.query(models.JudgeWorker.id).filter(
+        func.timestampdiff(literal_column("SECOND"), models.JudgeWorker.heartbeat_at, func.now()) <= timeout_sec
+    ).all()
+    return {row.id for row in rows}
+
+# timeout_sec秒以上生存を報告していないワーカーが実行していたジャッジリクエストをキューに戻し、途中結果を削除する
+# 戻したジャッジリクエストのIDを返す
+def requeue_submissions_of_dead_workers(db: Session, timeout_sec: float) -> list[int]:
+    try:
+        live_worker_ids = fetch_live_worker_ids(db, timeout_sec)
+        # 他のワーカーが同時に戻している(ロックしている)ものは除く
+        submission_list = db.query(models.Submission).filter(
+            models.Submission.progress == 'running',
+            models.Submission.worker_id.is_not(None),
+            models.Submission.worker_id.not_in(live_worker_ids)
+        ).with_for_update(skip_locked=True).all()
+        submission_id_list = [submission.id for submission in submission_list]
+        for submission in submission_list:
+            submission.progress = 'queued'
+            submission.worker_id = None
+        if submission_id_list:
+            db.query(models.JudgeResult).filter(models.JudgeResult.submission_id.in_(submission_id_list)).delete(synchronize_session=False)
+        db.query(models.JudgeWorker).filter(models.JudgeWorker.id.not_in(live_worker_ids)).delete(synchronize_session=False)
+        db.commit()
+        return submission_id_list
+    except Exception as e:
+        db.rollback()
+        logger.error(f"requeue_submissions_of_dead_workersでエラーが発生しました: {str(e)}")
+        return []
+
 # ----------------------- end --------------------------------------------------
 
 # ---------------- for client server -------------------------------------------
 
 # Submissionテーブルにジャッジリクエストを追加する
-def register_judge_request(db: Session, batch_id: int | None, student_id: str, lecture_id: int, assignment_id: int, for_evaluation: bool) -> SubmissionRecord:
+def register_judge_request(db: Session, batch_id: int | None, student_id: str, lecture_id: int, assignment_id: int, for_evaluation: bool, fail_fast: bool | None = None) -> SubmissionRecord:
     logger.info("call register_judge_request")
     new_submission = models.Submission(
         batch_id=batch_id,
@@ -280,6 +486,7 @@ def register_judge_request(db: Session, batch_id: int | None, student_id: str, l
         lecture_id=lecture_id,
         assignment_id=assignment_id,
         for_evaluation=for_evaluation,
+        fail_fast=fail_fast,
     )
     db.add(new_submission)
     db.commit()
@@ -296,7 +503,8 @@ def register_judge_request(db: Session, batch_id: int | None, student_id: str, l
         prebuilt_result=JudgeSummaryStatus(new_submission.prebuilt_result),
         postbuilt_result=JudgeSummaryStatus(new_submission.postbuilt_result),
         judge_result=JudgeSummaryStatus(new_submission.postbuilt_result),
-        message=new_submission.message
+        message=new_submission.message,
+        fail_fast=new_submission.fail_fast
     )
 
 # アップロードされたファイルをUploadedFilesに登録する
@@ -321,6 +529,45 @@ def enqueue_judge_request(db: Session, submission_id: int) -> None:
     else:
         raise ValueError(f"Submission with id {submission_id} not found")
 
+# ジャッジリクエストと提出されたファイルを登録し、キューに追加する
+# (1つのトランザクションで行うので、ファイルが揃っていないジャッジリクエストがキューに並ぶことはない)
+def register_and_enqueue_judge_request(db: Session, batch_id: int | None, student_id: str, lecture_id: int, assignment_id: int, for_evaluation: bool, paths: list[Path], fail_fast: bool | None = None) -> SubmissionRecord:
+    logger.info("call register_and_enqueue_judge_request")
+    try:
+        new_submission = models.Submission(
+            batch_id=batch_id,
+            student_id=student_id,
+            lecture_id=lecture_id,
+            assignment_id=assignment_id,
+            for_evaluation=for_evaluation,
+            progress='queued',
+            fail_fast=fail_fast,
+        )
+        db.add(new_submission)
+        db.flush()
+        for path in paths:
+            db.add(models.UploadedFiles(submission_id=new_submission.id, path=str(path)))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    db.refresh(new_submission)
+    return SubmissionRecord(
+        id=new_submission.id,
+        ts=new_submission.ts,
+        batch_id=new_submission.batch_id,
+        student_id=new_submission.student_id,
+        lecture_id=new_submission.lecture_id,
+        assignment_id=new_submission.assignment_id,
+        for_evaluation=new_submission.for_evaluation,
+        progress=SubmissionProgressStatus(new_submission.progress),
+        prebuilt_result=JudgeSummaryStatus(new_submission.prebuilt_result),
+        postbuilt_result=JudgeSummaryStatus(new_submission.postbuilt_result),
+        judge_result=JudgeSummaryStatus(new_submission.judge_result),
+        message=new_submission.message,
+        fail_fast=new_submission.fail_fast
+    )
+
 # Submissionテーブルのジャッジリクエストのstatusを確認する
 def fetch_judge_status(db: Session, submission_id: int) -> SubmissionProgressStatus:
     logger.info("call fetch_judge_status")
@@ -348,3 +595,63 @@ def fetch_judge_results(db: Session, submission_id: int) -> list[JudgeResultReco
         )
         for raw_result in raw_judge_results
     ]
+
+# 指定した提出・バッチに属する、IDがafter_idより大きいか、直近recent_sec秒以内に登録されたジャッジ結果をIDの順に取得する
+# (複数のワーカーが結果を登録する場合、IDの小さい結果が後からコミットされることがあるので、IDだけでは取りこぼす)
+def fetch_judge_results_after(db: Session, after_id: int, submission_ids: set[int], batch_ids: set[int], recent_sec: int = 0) -> list[JudgeResultRecord]:
+    if not submission_ids and not batch_ids:
+        return []
+    raw_judge_results = db.query(models.JudgeResult).join(
+        models.Submission, models.Submission.id == models.JudgeResult.submission_id
+    ).filter(
+        or_(
+            models.JudgeResult.id > after_id,
+            func.timestampdiff(literal_column("SECOND"), models.JudgeResult.ts, func.now()) <= recent_sec,
+        ),
+        or_(models.Submission.id.in_(submission_ids), models.Submission.batch_id.in_(batch_ids))
+    ).order_by(models.JudgeResult.id).all()
+    return [
+        JudgeResultRecord(
+            id=raw_result.id,
+            ts=raw_result.ts,
+            submission_id=raw_result.submission_id,
+            testcase_id=raw_result.testcase_id,
+            timeMS=raw_result.timeMS,
+            memoryKB=raw_result.memoryKB,
+            exit_code=raw_result.exit_code,
+            stdout=raw_result.stdout,
+            stderr=raw_result.stderr,
+            result=SingleJudgeStatus(raw_result.result)
+        )
+        for raw_result in raw_judge_results
+    ]
+
+# JudgeResultテーブルの最大のIDを返す(空なら0)
+def fetch_max_judge_result_id(db: Session) -> int:
+    return db.query(func.max(models.JudgeResult.id)).scalar() or 0
+
+# 指定した提出と、指定したバッチに属する実行中の提出を取得する
+def fetch_submission_records(db: Session, submission_ids: set[int], running_batch_ids: set[int]) -> list[SubmissionRecord]:
+    if not submission_ids and not running_batch_ids:
+        return []
+    submission_list = db.query(models.Submission).filter(or_(
+        models.Submission.id.in_(submission_ids),
+        and_(models.Submission.batch_id.in_(running_batch_ids), models.Submission.progress == 'running')
+    )).all()
+    return [
+        SubmissionRecord(
+            id=submission.id,
+            ts=submission.ts,
+            batch_id=submission.batch_id,
+            student_id=submission.student_id,
+            lecture_id=submission.lecture_id,
+            assignment_id=submission.assignment_id,
+            for_evaluation=submission.for_evaluation,
+            progress=SubmissionProgressStatus(submission.progress),
+            prebuilt_result=JudgeSummaryStatus(submission.prebuilt_result),
+            postbuilt_result=JudgeSummaryStatus(submission.postbuilt_result),
+            judge_result=JudgeSummaryStatus(submission.judge_result),
+            message=submission.message,
+            fail_fast=submission.fail_fast)
+        for submission in submission_list
+    ]
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, TIMESTAMP, Enum, text, ForeignKey, ForeignKeyConstraint
+from sqlalchemy import Column, Integer, String, Boolean, TIMESTAMP, Enum, text, ForeignKey, ForeignKeyConstraint, UniqueConstraint
 from sqlalchemy.orm import relationship
 
 from .database import Base
@@ -20,8 +20,11 @@ class Problem(Base):
     description_path = Column(String(255), nullable=False)
     timeMS = Column(Integer, nullable=False)
     memoryMB = Column(Integer, nullable=False)
+    outputLimitKB = Column(Integer, nullable=False, default=1024)
     build_script_path = Column(String(255), nullable=False)
     executable = Column(String(255), nullable=False)
+    memoize = Column(Boolean, nullable=False, default=True)
+    fail_fast = Column(Boolean, nullable=False, default=False)
     lecture = relationship("Lecture", back_populates="problems")
 
 class ArrangedFiles(Base):
@@ -86,6 +89,8 @@ class Submission(Base):
     postbuilt_result = Column(Enum('Unprocessed', 'AC', 'WA', 'TLE', 'MLE', 'CE', 'RE', 'OLE', 'IE'), default='Unprocessed')
     judge_result = Column(Enum('Unprocessed', 'AC', 'WA', 'TLE', 'MLE', 'CE', 'RE', 'OLE', 'IE'), default='Unprocessed')
     message = Column(String(255), default='')
+    fail_fast = Column(Boolean, nullable=True, default=None)
+    worker_id = Column(String(64), nullable=True, default=None)
 
 class UploadedFiles(Base):
     __tablename__ = 'UploadedFiles'
@@ -105,5 +110,24 @@ class JudgeResult(Base):
     exit_code = Column(Integer, nullable=False)
     stdout = Column(String, nullable=False)
     stderr = Column(String, nullable=False)
-    result = Column(Enum('AC', 'WA', 'TLE', 'MLE', 'CE', 'RE', 'OLE', 'IE'), nullable=False)
+    result = Column(Enum('AC', 'WA', 'TLE', 'MLE', 'CE', 'RE', 'OLE', 'IE', 'SKIP'), nullable=False)
 
+
+class JudgeMemo(Base):
+    __tablename__ = 'JudgeMemo'
+    __table_args__ = (UniqueConstraint('content_hash', 'problem_hash'),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    ts = Column(TIMESTAMP, server_default=text('CURRENT_TIMESTAMP'))
+    content_hash = Column(String(64), nullable=False)
+    problem_hash = Column(String(64), nullable=False)
+    submission_id = Column(Integer, ForeignKey('Submission.id'), nullable=False)
+
+class JudgeWorker(Base):
+    __tablename__ = 'JudgeWorker'
+    id = Column(String(64), primary_key=True)
+    hostname = Column(String(255), nullable=False)
+    pid = Column(Integer, nullable=False)
+    capacity = Column(Integer, nullable=False)
+    running = Column(Integer, nullable=False, default=0)
+    started_at = Column(TIMESTAMP, server_default=text('CURRENT_TIMESTAMP'))
+    heartbeat_at = Column(TIMESTAMP, server_default=text('CURRENT_TIMESTAMP'))
@@ -6,13 +6,28 @@ from sandbox.execute import TaskInfo
 from sandbox.execute import VolumeMountInfo
 from sqlalchemy.orm import Session
 from sandbox.execute import TaskResult
+from sandbox.execute import DEFAULT_OUTPUT_LIMIT_BYTE
+from sandbox.pool import container_pool
+from sandbox.batch import BatchCase, BatchTaskInfo
+from sandbox.async_execute import AsyncVolume, runTask
+from sandbox.compile_cache import compile_cache, compileCacheKey, imageID
+from sandbox.ccache import withCcache
+from sandbox.prebuilt import prebuiltObjects
+from sandbox.cpuset import parse_cpu_list
+from typing import AsyncIterator, Iterator
 from dotenv import load_dotenv
 from db.models import TestCases, Problem
 import logging
 from db.crud import *
 from db.database import SessionLocal
 from checker import StandardChecker
+from progress import EVENT_SUBMISSION, EVENT_TESTCASE, progress_bus
 import os
+import asyncio
+import contextvars
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
 # ロガーの設定
@@ -23,6 +38,37 @@ load_dotenv()
 
 RESOURCE_DIR = Path(os.getenv("RESOURCE_PATH"))
 
+# テストケースごとのボリュームを、コピーではなくoverlayのスナップショットで作るかどうか
+SNAPSHOT_CLONE = os.getenv("SANDBOX_SNAPSHOT_CLONE", "true").lower() == "true"
+
+# 0より大きければ、テストケースをこの大きさ[MB]のtmpfsの作業ディレクトリで実行する
+# (ボリュームの作成・削除が不要になる。tmpfsの使用量はmemoryMBに計上される)
+TMPFS_WORKDIR_MB = int(os.getenv("SANDBOX_TMPFS_WORKDIR_MB", "0"))
+
+# ジャッジのテストケースを、judge-harnessで1つのコンテナにまとめて実行するかどうか
+# (テストケースごとにcgroupが分かれないので、最大メモリ使用量の計り方が1つずつ実行する場合と異なる)
+BATCH_JUDGE = os.getenv("SANDBOX_BATCH_JUDGE", "false").lower() == "true"
+
+# ジャッジのテストケースを1つずつコンテナで実行する場合に、1つの提出の中で同時に実行する数
+# (コアが割り当てられている場合は、そのコア数も超えない)
+TESTCASE_PARALLELISM = int(os.getenv("SANDBOX_TESTCASE_PARALLELISM", "4"))
+# 並列に実行するテストケースの、全ての提出を合わせた同時実行数の上限
+TESTCASE_CONCURRENCY = int(os.getenv("SANDBOX_TESTCASE_CONCURRENCY", "16"))
+_testcase_budget = threading.BoundedSemaphore(max(TESTCASE_CONCURRENCY, 1))
+_testcase_budget_async = asyncio.Semaphore(max(TESTCASE_CONCURRENCY, 1))
+
+# コンパイル・チェッカー(解析処理)の制限時間と最大メモリ使用量(固定)
+CHECKER_TIMEOUT_SEC = 2.0
+CHECKER_MEMORY_LIMIT_MB = 512
+
+# JudgeResultテーブルに保存する標準出力・標準エラー出力の最大サイズ[Byte]
+JUDGE_RESULT_OUTPUT_MAX_BYTES = 8000
+
+# 同じ内容の提出に、以前のジャッジ結果を使い回すかどうか(課題ごとにはProblem.memoizeで無効にできる)
+JUDGE_MEMO = os.getenv("JUDGE_MEMO", "true").lower() == "true"
+# チェッカー等、ジャッジ結果を左右する処理を変えたら上げる(それ以前のメモは使われなくなる)
+JUDGE_MEMO_VERSION = 1
+
 StatusOrder = {
     JudgeSummaryStatus.UNPROCESSED: 0,
     JudgeSummaryStatus.AC: 1,
@@ -46,6 +92,32 @@ class JudgeSummaryStatusAggregator:
         if StatusOrder[self.flag] < StatusOrder[flag]:
             self.flag = flag
 
+# JudgeResultテーブルに保存できる大きさに出力を切り詰める
+def _truncate_output(output: str) -> str:
+    encoded = output.encode("utf-8")
+    if len(encoded) <= JUDGE_RESULT_OUTPUT_MAX_BYTES:
+        return output
+    return encoded[:JUDGE_RESULT_OUTPUT_MAX_BYTES].decode("utf-8", errors="ignore")
+
+# ファイルの名前と内容をハッシュ値に加える
+def _update_with_file(digest, path: Path) -> None:
+    digest.update(f"{path.name}\0".encode("utf-8"))
+    with open(path, mode="rb") as f:
+        digest.update(hashlib.sha256(f.read()).digest())
+
+
+# チェッカーで使うコンテナをコンテナプールに事前に用意しておく
+def prewarm_container_pool() -> None:
+    for container_name in ["binary-runner", "checker-lang-gcc"]:
+        container_pool.prewarm(
+            TaskInfo(
+                name=container_name,
+                workDir="/workdir/",
+                timeoutSec=CHECKER_TIMEOUT_SEC,
+                memoryLimitMB=CHECKER_MEMORY_LIMIT_MB,
+            )
+        )
+
 class JudgeInfo:
     submission_record: SubmissionRecord # Submissionテーブル内のジャッジリクエストレコード
     
@@ -65,11 +137,15 @@ class JudgeInfo:
 
     judge_testcases: list[TestCaseRecord]
 
+    cpuset: str  # このジャッジのコンテナに使わせるコア(e.g., "0,1")。空なら指定しない
+
     def __init__(
         self,
-        submission: SubmissionRecord
+        submission: SubmissionRecord,
+        cpuset: str = "",
     ):
         self.submission_record = submission
+        self.cpuset = cpuset
 
         db = SessionLocal()
         
@@ -85,7 +161,7 @@ class JudgeInfo:
             self.submission_record.progress = SubmissionProgressStatus.DONE
             # Submissionテーブルのmessageにエラー文を追加
             self.submission_record.message = f"Error on Problem {self.lecture_id}-{self.assignment_id}:{self.for_evaluation}: Not found"
-            update_submission_record(db=db, submission_record=self.submission_record)
+            self._save_submission(db)
             db.close()
             raise ValueError(self.submission_record.message)
         else:
@@ -156,13 +232,43 @@ class JudgeInfo:
         # copy uploaded files and arranged files to volume
         err = docker_volume.copyFiles(self.uploaded_filepaths + self.arranged_filepaths)
         if not err.silence():
+            docker_volume.remove()
             return (
                 Volume(""),
                 Error(f"failed to copy uploaded files to volume: {docker_volume.name}"),
             )
 
+        # 配置するソースコードのオブジェクトファイルを置き、コンパイルを提出されたファイルだけにする
+        objects = self._prebuilt_objects()
+        if objects is not None:
+            err = docker_volume.extractArchive(objects)
+            if not err.silence():
+                test_logger.info(f"failed to stage prebuilt objects: {err.message}")
+
         return (docker_volume, Error.Nothing())
 
+    # 配置するソースコードを事前にコンパイルしたオブジェクトファイル(tarアーカイブ)。無ければNone
+    def _prebuilt_objects(self) -> bytes | None:
+        objects, err = prebuiltObjects(
+            image="checker-lang-gcc",
+            arrangedFiles=self.arranged_filepaths,
+            cpusetCpus=self.cpuset,
+        )
+        if not err.silence():
+            test_logger.info(f"compile without prebuilt objects: {err.message}")
+            return None
+        return objects
+
+    # ジャッジ結果を登録し、提出・バッチの進み具合を見ているクライアントに配信する
+    def _register_result(self, db: Session, result: JudgeResultRecord) -> None:
+        register_judge_result(db=db, result=result)
+        progress_bus.publish(self.submission_record, EVENT_TESTCASE, result)
+
+    # 提出の状態を更新し、配信する
+    def _save_submission(self, db: Session) -> None:
+        update_submission_record(db=db, submission_record=self.submission_record)
+        progress_bus.publish(self.submission_record, EVENT_SUBMISSION, self.submission_record)
+
     def _result_check_and_register(
         self,
         db: Session,
@@ -170,22 +276,27 @@ class JudgeInfo:
         result: TaskResult,
         expected_stdout: str,
         expected_stderr: str,
+        memoryLimitMB: int,
     ) -> JudgeSummaryStatus:
         judge_result_record = JudgeResultRecord(
             submission_id=self.submission_record.id,
             testcase_id=testcase.id,
-            timeMS=result.timeMS,
+            # CPU時間が取得できればそちらを記録する(TLEの判定もCPU時間で行われる)
+            timeMS=result.cpuTimeMS if result.cpuTimeMS >= 0 else result.timeMS,
             memoryKB=result.memoryByte / 1024,
             exit_code=result.exitCode,
-            stdout=result.stdout,
-            stderr=result.stderr,
+            stdout=_truncate_output(result.stdout),
+            stderr=_truncate_output(result.stderr),
             result=SingleJudgeStatus.AC
         )
         # TLEチェック
         if result.TLE:
             judge_result_record.result=SingleJudgeStatus.TLE
-        # MLEチェック
-        elif result.memoryByte + 1024 * 1024 > 512 * 1024 * 1024:
+        # OLEチェック
+        elif result.OLE:
+            judge_result_record.result=SingleJudgeStatus.OLE
+        # MLEチェック(OOM killerにkillされたか、最大メモリ使用量が制限の近くまで達した)
+        elif result.MLE or result.memoryByte + 1024 * 1024 > memoryLimitMB * 1024 * 1024:
             judge_result_record.result=SingleJudgeStatus.MLE
         # RE(Runtime Errorチェック)
         elif result.exitCode != testcase.exit_code:
@@ -198,129 +309,341 @@ class JudgeInfo:
         else:
         # AC(正解)として登録
             judge_result_record.result=SingleJudgeStatus.AC
-        register_judge_result(
-            db=db,
-            result=judge_result_record
-        )
+        self._register_result(db, judge_result_record)
         return JudgeSummaryStatus(judge_result_record.result.value)
             
-    def _exec_checker(self, testcase_list: list[TestCaseRecord], initial_volume: Volume, container_name: str, timeoutSec: float, memoryLimitMB: int) -> JudgeSummaryStatus:
+    def _register_internal_error(self, db: Session, testcase: TestCaseRecord, message: str) -> None:
+        self._register_result(
+            db=db,
+            result=JudgeResultRecord(
+                submission_id=self.submission_record.id,
+                testcase_id=testcase.id,
+                timeMS=0,
+                memoryKB=0,
+                exit_code=-1,
+                stdout='',
+                stderr=message,
+                result=SingleJudgeStatus.IE
+            )
+        )
+
+    # fail-fastで実行しなかったテストケースを登録する
+    def _register_skipped(self, db: Session, testcase: TestCaseRecord) -> None:
+        self._register_result(
+            db=db,
+            result=JudgeResultRecord(
+                submission_id=self.submission_record.id,
+                testcase_id=testcase.id,
+                timeMS=0,
+                memoryKB=0,
+                exit_code=-1,
+                stdout='',
+                stderr='',
+                result=SingleJudgeStatus.SKIP
+            )
+        )
+
+    # 最初のAC以外の結果で、残りのジャッジのテストケースを打ち切るかどうか
+    # 提出ごとの指定(Submission.fail_fast)が無ければ、課題の設定(Problem.fail_fast)に従う
+    def _fail_fast(self) -> bool:
+        if self.submission_record.fail_fast is not None:
+            return self.submission_record.fail_fast
+        return self.problem_record.fail_fast
+
+    # テストケースで実行するコマンド、標準入力、想定される標準出力・標準エラー出力を読み込む
+    def _load_testcase(self, testcase: TestCaseRecord) -> tuple[list[str], str, str, str, Error]:
+        args = []
+        if testcase.script_path is not None:
+            # スクリプトが要求されるならそれを実行する
+            args = [f"./{Path(testcase.script_path).name}"]
+        else:
+            # そうでないなら通常のexecutableをargsに追加
+            args = [f"./{self.problem_record.executable}"]
+
+        stdin: str = ""
+        expected_stdout: str = ""
+        expected_stderr: str = ""
+
+        try:
+            # 引数をargに追加する
+            if testcase.argument_path is not None:
+                with open(RESOURCE_DIR / testcase.argument_path, "r", encoding='utf-8') as f:
+                    arguments = f.read().strip().split()
+                    args.extend(arguments)
+
+            # stdin, expected_stdout, expected_stderrを読み込む
+            if testcase.stdin_path is not None:
+                with open(
+                    RESOURCE_DIR / testcase.stdin_path, "r", encoding="utf-8"
+                ) as f:
+                    stdin = f.read()
+
+            with open(
+                RESOURCE_DIR / testcase.stdout_path, "r", encoding="utf-8"
+            ) as f:
+                expected_stdout = f.read()
+
+            with open(
+                RESOURCE_DIR / testcase.stderr_path, "r", encoding="utf-8"
+            ) as f:
+                expected_stderr = f.read()
+        except FileNotFoundError as e:
+            return [], "", "", "", Error(f"testcase file not found: {e.filename}")
+
+        return args, stdin, expected_stdout, expected_stderr, Error.Nothing()
+
+    # テストケース用に、initial_volumeと同じ内容の書き込み可能なボリュームを作る
+    def _clone_volume(self, initial_volume: Volume) -> tuple[Volume, Error]:
+        if SNAPSHOT_CLONE:
+            volume, err = initial_volume.snapshot()
+            if err.silence():
+                return volume, err
+            test_logger.info(f"failed to create snapshot, fall back to copying: {err}")
+        return initial_volume.clone()
+
+    # テストケースを実行するタスクと、作業ディレクトリにコピーするスクリプトを用意する
+    def _testcase_task(
+        self,
+        testcase: TestCaseRecord,
+        args: list[str],
+        stdin: str,
+        container_name: str,
+        timeoutSec: float,
+        memoryLimitMB: int,
+        outputLimitByte: int,
+    ) -> tuple[TaskInfo, list[tuple[Path, Path]]]:
+        # sandbox環境のセットアップ
+        task = TaskInfo(
+            name=container_name,
+            arguments=args,
+            workDir="/workdir/",
+            timeoutSec=timeoutSec,
+            memoryLimitMB=memoryLimitMB,
+            outputLimitByte=outputLimitByte,
+            cpusetCpus=self.cpuset,
+            Stdin=stdin,
+        )
+
+        # スクリプトが要求されるならそれも作業ディレクトリにコピーする
+        script_files: list[tuple[Path, Path]] = []
+        if testcase.script_path is not None:
+            script_files = [(RESOURCE_DIR / testcase.script_path, Path(testcase.script_path).name)]
+
+        return task, script_files
+
+    # テストケースをsandbox環境で実行する
+    # workdir_archiveが与えられた場合はコンテナプールで、そうでなければinitial_volumeのクローン上で実行する
+    def _run_testcase(
+        self,
+        testcase: TestCaseRecord,
+        args: list[str],
+        stdin: str,
+        initial_volume: Volume,
+        workdir_archive: bytes | None,
+        container_name: str,
+        timeoutSec: float,
+        memoryLimitMB: int,
+        outputLimitByte: int,
+    ) -> tuple[TaskResult, Error]:
+        task, script_files = self._testcase_task(
+            testcase, args, stdin, container_name, timeoutSec, memoryLimitMB, outputLimitByte
+        )
+
+        if workdir_archive is not None:
+            return container_pool.run(task, workdir_archive, extraFiles=script_files)
+
+        task.extraFiles = script_files
+
+        if TMPFS_WORKDIR_MB > 0:
+            # ボリュームを作らず、initial_volumeの内容をコピーしたtmpfs上で実行する
+            task.tmpfsWorkDirMB = TMPFS_WORKDIR_MB
+            task.tmpfsSeedVolume = initial_volume
+            return task.run()
+
+        # ボリューム作成
+        volume, err = self._clone_volume(initial_volume)
+        if not err.silence():
+            return TaskResult(), err
+
+        task.volumeMountInfo = [VolumeMountInfo(path="/workdir/", volume=volume)]
+
+        try:
+            # sandbox環境で実行
+            return task.run()
+        finally:
+            # ボリュームを削除
+            err2 = volume.remove()
+            if not err2.silence():
+                test_logger.info(f"failed to remove volume: {volume.name}")
+
+    # 全てのテストケースを1つのコンテナ内でjudge-harnessを使って順番に実行する
+    # 結果はtestcasesと同じ順番で返される
+    def _run_batch(
+        self,
+        testcases: list[tuple[list[str], str]],
+        initial_volume: Volume,
+        container_name: str,
+        timeoutSec: float,
+        memoryLimitMB: int,
+        outputLimitByte: int,
+    ) -> tuple[list[TaskResult], Error]:
+        task = self._batch_task(
+            testcases, container_name, timeoutSec, memoryLimitMB, outputLimitByte
+        )
+
+        if TMPFS_WORKDIR_MB > 0:
+            task.tmpfsWorkDirMB = TMPFS_WORKDIR_MB
+            task.tmpfsSeedVolume = initial_volume
+            return task.run()
+
+        volume, err = self._clone_volume(initial_volume)
+        if not err.silence():
+            return [], err
+
+        task.volumeMountInfo = [VolumeMountInfo(path="/workdir/", volume=volume)]
+
+        try:
+            return task.run()
+        finally:
+            err2 = volume.remove()
+            if not err2.silence():
+                test_logger.info(f"failed to remove volume: {volume.name}")
+
+    def _batch_task(
+        self,
+        testcases: list[tuple[list[str], str]],
+        container_name: str,
+        timeoutSec: float,
+        memoryLimitMB: int,
+        outputLimitByte: int,
+    ) -> BatchTaskInfo:
+        return BatchTaskInfo(
+            name=container_name,
+            cases=[
+                BatchCase(
+                    arguments=args,
+                    Stdin=stdin,
+                    timeoutSec=timeoutSec,
+                    outputLimitByte=outputLimitByte,
+                )
+                for args, stdin in testcases
+            ],
+            workDir="/workdir/",
+            memoryLimitMB=memoryLimitMB,
+            cpusetCpus=self.cpuset,
+        )
+
+    # 1つの提出の中で同時に実行するテストケースの数
+    def _testcase_parallelism(self) -> int:
+        parallelism = TESTCASE_PARALLELISM
+        if self.cpuset != "":
+            # 割り当てられたコアより多く同時に実行すると、実行時間の計測が不安定になる
+            parallelism = min(parallelism, len(parse_cpu_list(self.cpuset)))
+        return max(parallelism, 1)
+
+    # テストケースを1つずつコンテナで実行し、結果をloaded_testcasesと同じ順番で返す
+    # parallelの場合は、全体の同時実行数の上限(TESTCASE_CONCURRENCY)の範囲で並列に実行する
+    # 途中で読むのをやめた場合(fail-fast)は、まだ始まっていないテストケースは実行しない
+    def _run_testcases(self, loaded_testcases: list[tuple[TestCaseRecord, list[str], str, str, str]], parallel: bool, **run_args) -> Iterator[tuple[TaskResult, Error]]:
+        def run(testcase: TestCaseRecord, args: list[str], stdin: str) -> tuple[TaskResult, Error]:
+            return self._run_testcase(testcase=testcase, args=args, stdin=stdin, **run_args)
+
+        parallelism = self._testcase_parallelism() if parallel else 1
+        if parallelism <= 1 or len(loaded_testcases) <= 1:
+            for testcase, args, stdin, _, _ in loaded_testcases:
+                yield run(testcase, args, stdin)
+            return
+
+        def run_in_budget(testcase: TestCaseRecord, args: list[str], stdin: str) -> tuple[TaskResult, Error]:
+            with _testcase_budget:
+                return run(testcase, args, stdin)
+
+        with ThreadPoolExecutor(max_workers=parallelism) as executor:
+            # 作成するリソースに提出のラベルが付くように、コンテキスト(owned_by)を引き継ぐ
+            futures = [
+                executor.submit(contextvars.copy_context().run, run_in_budget, testcase, args, stdin)
+                for testcase, args, stdin, _, _ in loaded_testcases
+            ]
+            try:
+                for future in futures:
+                    yield future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def _exec_checker(self, testcase_list: list[TestCaseRecord], initial_volume: Volume, container_name: str, timeoutSec: float, memoryLimitMB: int, outputLimitByte: int = DEFAULT_OUTPUT_LIMIT_BYTE, batch: bool = False, parallel: bool = False, fail_fast: bool = False) -> JudgeSummaryStatus:
         db = SessionLocal()
         status_aggregator: JudgeSummaryStatusAggregator = JudgeSummaryStatusAggregator(JudgeSummaryStatus.AC)
+
+        # テストケースの入力と想定される出力を読み込む
+        loaded_testcases: list[tuple[TestCaseRecord, list[str], str, str, str]] = []
         for testcase in testcase_list:
-            # ボリューム作成
-            volume, err = initial_volume.clone()
+            args, stdin, expected_stdout, expected_stderr, err = self._load_testcase(testcase)
             if not err.silence():
-                register_judge_result(
-                    db=db,
-                    result=JudgeResultRecord(
-                        submission_id=self.submission_record.id,
-                        testcase_id=testcase.id,
-                        timeMS=0,
-                        memoryKB=0,
-                        exit_code=-1,
-                        stdout='',
-                        stderr=err.message,
-                        result=SingleJudgeStatus.IE
-                    )
-                )
+                self._register_internal_error(db, testcase, err.message)
                 status_aggregator.update(JudgeSummaryStatus.IE)
                 continue
-            
-            args = []
-            
-            # スクリプトが要求されるならそれをボリュームにコピー
-            if testcase.script_path is not None:
-                err = volume.copyFile(
-                    RESOURCE_DIR / testcase.script_path,
-                    Path("./") / Path(testcase.script_path).name
-                )
-                if not err.silence():
-                    test_logger.info(f"err occured when copying script file: {err}")
-                    register_judge_result(
-                        db=db,
-                        result=JudgeResultRecord(
-                            submission_id=self.submission_record.id,
-                            testcase_id=testcase.id,
-                            timeMS=0,
-                            memoryKB=0,
-                            exit_code=-1,
-                            stdout='',
-                            stderr=err.message,
-                            result=SingleJudgeStatus.IE
-                        )
-                    )
-                    status_aggregator.update(JudgeSummaryStatus.IE)
-                    continue
-                args = [f"./{Path(testcase.script_path).name}"]
+            loaded_testcases.append((testcase, args, stdin, expected_stdout, expected_stderr))
+
+        # バッチ実行の場合は、全てのテストケースを1つのコンテナでまとめて実行する
+        # (テストケースごとにスクリプトをコピーする必要がある場合は使わない)
+        # fail-fastの場合は、AC以外の結果が出た後のテストケースを実行しないように1つずつ実行する
+        batch_results: list[TaskResult] | None = None
+        if (
+            batch
+            and BATCH_JUDGE
+            and not fail_fast
+            and len(loaded_testcases) > 0
+            and all(testcase.script_path is None for testcase, *_ in loaded_testcases)
+        ):
+            results, err = self._run_batch(
+                testcases=[(args, stdin) for _, args, stdin, _, _ in loaded_testcases],
+                initial_volume=initial_volume,
+                container_name=container_name,
+                timeoutSec=timeoutSec,
+                memoryLimitMB=memoryLimitMB,
+                outputLimitByte=outputLimitByte,
+            )
+            if err.silence():
+                batch_results = results
             else:
-                # そうでないなら通常のexecutableをargsに追加
-                args = [f"./{self.problem_record.executable}"]
-            
-            stdin: str = ""
-            expected_stdout: str = ""
-            expected_stderr: str = ""
-            
-            try:
-                # 引数をargに追加する
-                if testcase.argument_path is not None:
-                    with open(RESOURCE_DIR / testcase.argument_path, "r", encoding='utf-8') as f:
-                        arguments = f.read().strip().split()
-                        args.extend(arguments)
-                    
-                # stdin, expected_stdout, expected_stderrを読み込む
-                if testcase.stdin_path is not None:
-                    with open(
-                        RESOURCE_DIR / testcase.stdin_path, "r", encoding="utf-8"
-                    ) as f:
-                        stdin = f.read()
-                else:
-                    stdin = ""
+                test_logger.info(f"failed to run testcases in batch, fall back to one by one: {err}")
 
-                with open(
-                    RESOURCE_DIR / testcase.stdout_path, "r", encoding="utf-8"
-                ) as f:
-                    expected_stdout = f.read()
+        # コンテナプールを使う場合は、作業ディレクトリの内容を一度だけ取り出しておく
+        workdir_archive: bytes | None = None
+        if batch_results is None and len(loaded_testcases) > 0 and container_pool.enabled():
+            workdir_archive, err = initial_volume.archive()
+            if not err.silence():
+                test_logger.info(f"failed to archive volume, fall back to cloning: {err}")
+                workdir_archive = None
 
-                with open(
-                    RESOURCE_DIR / testcase.stderr_path, "r", encoding="utf-8"
-                ) as f:
-                    expected_stderr = f.read()
-        
-            except FileNotFoundError as e:
-                register_judge_result(
-                    db=db,
-                    result=JudgeResultRecord(
-                        submission_id=self.submission_record.id,
-                        testcase_id=testcase.id,
-                        timeMS=0,
-                        memoryKB=0,
-                        exit_code=-1,
-                        stdout='',
-                        stderr=err.message,
-                        result=SingleJudgeStatus.IE
-                    )
-                )
-                status_aggregator.update(JudgeSummaryStatus.IE)
-                # ボリュームを削除
-                err = volume.remove()
-                if not err.silence():
-                    test_logger.info(f"failed to remove volume: {volume.name}")
-                continue
-            
-            # sandbox環境のセットアップ
-            task = TaskInfo(
-                name=container_name,
-                arguments=args,
-                workDir="/workdir/",
-                volumeMountInfo=[VolumeMountInfo(path="/workdir/", volume=volume)],
+        if batch_results is not None:
+            run_results = ((result, Error.Nothing()) for result in batch_results)
+        else:
+            run_results = self._run_testcases(
+                loaded_testcases,
+                parallel=parallel,
+                initial_volume=initial_volume,
+                workdir_archive=workdir_archive,
+                container_name=container_name,
                 timeoutSec=timeoutSec,
                 memoryLimitMB=memoryLimitMB,
-                Stdin=stdin,
+                outputLimitByte=outputLimitByte,
             )
 
-            # sandbox環境で実行
-            result, err = task.run()
+        # 結果の登録・集計は、並列に実行した場合もテストケースの順番に行う
+        for testcase, args, stdin, expected_stdout, expected_stderr in loaded_testcases:
+            if fail_fast and status_aggregator.flag is not JudgeSummaryStatus.AC:
+                # AC以外の結果が出たので、残りは実行せずにSKIPとして登録する
+                run_results.close()
+                self._register_skipped(db, testcase)
+                continue
+
+            result, err = next(run_results)
+            if not err.silence():
+                self._register_internal_error(db, testcase, err.message)
+                status_aggregator.update(JudgeSummaryStatus.IE)
+                continue
 
             status = self._result_check_and_register(
                 db=db,
@@ -328,19 +651,58 @@ class JudgeInfo:
                 result=result,
                 expected_stdout=expected_stdout,
                 expected_stderr=expected_stderr,
+                memoryLimitMB=memoryLimitMB,
             )
-            
-            # ボリュームを削除
-            err = volume.remove()
-            if not err.silence():
-                test_logger.info(f"failed to remove volume: {volume.name}")
-            
+
             status_aggregator.update(status)
-        
+
         db.close()
         return status_aggregator.flag
 
     def _compile(self, working_volume: Volume, container_name: str) -> Error:
+        task, err = self._compile_task(working_volume, container_name)
+        if not err.silence():
+            return err
+
+        # 同じ入力のコンパイル結果があれば、コンテナを起動せずに展開する
+        cache_key = self._compile_cache_key(container_name)
+        if cache_key != "" and compile_cache.restore(cache_key, working_volume):
+            test_logger.info(f"compile cache hit: {cache_key}")
+            return Error.Nothing()
+
+        # sandbox環境で実行
+        result, err = task.run()
+        
+        if not err.silence():
+            return Error(f"compile failed: {result.stderr}")
+
+        if cache_key != "" and self._compile_cacheable(result):
+            err = compile_cache.save(cache_key, working_volume)
+            if not err.silence():
+                test_logger.info(f"failed to save compile cache: {err.message}")
+        
+        return Error.Nothing()
+
+    # コンパイル結果のキャッシュのキー。キャッシュが無効・キーを計算できない場合は空文字列
+    def _compile_cache_key(self, container_name: str) -> str:
+        if not compile_cache.enabled():
+            return ""
+        key, err = compileCacheKey(
+            image=container_name,
+            inputFiles=self.uploaded_filepaths + self.arranged_filepaths,
+            buildScript=RESOURCE_DIR / self.problem_record.build_script_path,
+        )
+        if not err.silence():
+            test_logger.info(f"compile cache disabled for this submission: {err.message}")
+            return ""
+        return key
+
+    # 正常に終了したコンパイルの結果だけを保存する
+    @staticmethod
+    def _compile_cacheable(result: TaskResult) -> bool:
+        return result.exitCode == 0 and not result.TLE and not result.MLE and not result.OLE
+
+    def _compile_task(self, working_volume: Volume, container_name: str) -> tuple[TaskInfo, Error]:
         # コンパイルコマンドの取得
         args = []
         try:
@@ -348,7 +710,7 @@ class JudgeInfo:
                 compile_command = f.read().strip().split()
                 args.extend(compile_command)
         except FileNotFoundError:
-            return Error(f"script for compile commands not found: {self.problem_record.build_script_path}")
+            return TaskInfo(name=container_name), Error(f"script for compile commands not found: {self.problem_record.build_script_path}")
     
         # sandbox環境のセットアップ
         task = TaskInfo(
@@ -356,33 +718,145 @@ class JudgeInfo:
             arguments=args,
             workDir="/workdir/",
             volumeMountInfo=[VolumeMountInfo(path="/workdir/", volume=working_volume)],
-            timeoutSec=2.0,
-            memoryLimitMB=512
+            timeoutSec=CHECKER_TIMEOUT_SEC,
+            memoryLimitMB=CHECKER_MEMORY_LIMIT_MB,
+            cpusetCpus=self.cpuset,
         )
-        
-        # sandbox環境で実行
-        result, err = task.run()
-        
+        # ジャッジをまたいで共有するコンパイラキャッシュを使う(使えなくてもコンパイルはできる)
+        err = withCcache(task)
         if not err.silence():
-            return Error(f"compile failed: {result.stderr}")
-        
-        return Error.Nothing()
+            test_logger.info(f"compile without ccache: {err.message}")
+        return task, Error.Nothing()
+
+    # 同じ内容の提出のジャッジ結果を探すためのキー(提出のハッシュ値, 課題のハッシュ値)
+    # メモを使わない場合・ハッシュ値を計算できない場合はNone
+    def _memo_keys(self) -> tuple[str, str] | None:
+        if not JUDGE_MEMO or not self.problem_record.memoize:
+            return None
+        try:
+            content = hashlib.sha256()
+            for path in sorted(self.uploaded_filepaths, key=lambda path: path.name):
+                _update_with_file(content, path)
+
+            problem = hashlib.sha256()
+            problem.update(repr((
+                JUDGE_MEMO_VERSION,
+                self.problem_record.timeMS,
+                self.problem_record.memoryMB,
+                self.problem_record.outputLimitKB,
+                self.problem_record.executable,
+                sorted(self.required_files),
+                # fail-fastかどうかで登録されるジャッジ結果が変わる
+                self._fail_fast(),
+            )).encode("utf-8"))
+            for image in ["binary-runner", "checker-lang-gcc"]:
+                image_id, err = imageID(image)
+                if not err.silence():
+                    test_logger.info(f"judge memo disabled: {err.message}")
+                    return None
+                problem.update(image_id.encode("utf-8"))
+            _update_with_file(problem, RESOURCE_DIR / self.problem_record.build_script_path)
+            for path in sorted(self.arranged_filepaths, key=lambda path: path.name):
+                _update_with_file(problem, path)
+            # JudgeResultはテストケースのIDを参照するので、IDもキーに含める
+            testcases = self.prebuilt_testcases + self.postbuilt_testcases + self.judge_testcases
+            for testcase in sorted(testcases, key=lambda testcase: testcase.id):
+                problem.update(repr((testcase.id, testcase.type.value, testcase.score, testcase.exit_code)).encode("utf-8"))
+                for path in [testcase.script_path, testcase.argument_path, testcase.stdin_path, testcase.stdout_path, testcase.stderr_path]:
+                    if path is None:
+                        problem.update(b"\0")
+                    else:
+                        _update_with_file(problem, RESOURCE_DIR / path)
+        except OSError as e:
+            test_logger.info(f"judge memo disabled: {e}")
+            return None
+
+        return content.hexdigest(), problem.hexdigest()
+
+    # 同じ内容の提出のジャッジ結果があれば、それをこのジャッジリクエストの結果としてコピーし、Trueを返す
+    def _reuse_memoized_result(self, memo_keys: tuple[str, str]) -> bool:
+        db = SessionLocal()
+        try:
+            memo = fetch_judge_memo(db=db, content_hash=memo_keys[0], problem_hash=memo_keys[1])
+            if memo is None:
+                return False
+            source = fetch_submission_record(db=db, submission_id=memo.submission_id)
+            if source is None or source.progress != SubmissionProgressStatus.DONE:
+                return False
+
+            copy_judge_results(db=db, src_submission_id=source.id, dst_submission_id=self.submission_record.id)
+            self.submission_record.progress = SubmissionProgressStatus.DONE
+            self.submission_record.prebuilt_result = source.prebuilt_result
+            self.submission_record.postbuilt_result = source.postbuilt_result
+            self.submission_record.judge_result = source.judge_result
+            self.submission_record.message = source.message
+            self._save_submission(db)
+        finally:
+            db.close()
+
+        test_logger.info(f"reuse judge result of submission {memo.submission_id} for submission {self.submission_record.id}")
+        return True
+
+    # ジャッジ結果をメモに登録する
+    # (IEは一時的な失敗、TLEはホストの負荷による揺らぎの可能性があるので登録しない)
+    def _register_memo(self, memo_keys: tuple[str, str]) -> None:
+        if self.submission_record.progress != SubmissionProgressStatus.DONE:
+            return
+        statuses = [
+            self.submission_record.prebuilt_result,
+            self.submission_record.postbuilt_result,
+            self.submission_record.judge_result,
+        ]
+        if JudgeSummaryStatus.IE in statuses or JudgeSummaryStatus.TLE in statuses:
+            return
+
+        db = SessionLocal()
+        # まとめの結果が他の結果で隠れていても、個々のテストケースにTLEがあれば登録しない
+        judge_results = fetch_judge_results(db=db, submission_id=self.submission_record.id)
+        if any(result.result in (SingleJudgeStatus.TLE, SingleJudgeStatus.IE) for result in judge_results):
+            db.close()
+            return
+        register_judge_memo(db=db, memo=JudgeMemoRecord(
+            content_hash=memo_keys[0],
+            problem_hash=memo_keys[1],
+            submission_id=self.submission_record.id,
+        ))
+        db.close()
 
     def judge(self) -> Error:
 
+        # 0. 同じ内容の提出のジャッジ結果があれば、コンテナを使わずにそれをコピーする
+        memo_keys = self._memo_keys()
+        if memo_keys is not None and self._reuse_memoized_result(memo_keys):
+            return Error.Nothing()
+
         # 1. コンパイル前のチェックを行う
         # required_files, arranged_filesが入ったボリュームを作る
         working_volume, err = self._create_complete_volume()
         if not err.silence():
             return err
+
+        # 途中で終了・例外が発生しても、ボリュームは必ず削除する
+        try:
+            judge_err = self._judge_on(working_volume)
+        finally:
+            err = working_volume.remove()
+            if not err.silence():
+                test_logger.info(f"failed to remove volume: {working_volume.name}")
+
+        if judge_err.silence() and memo_keys is not None:
+            self._register_memo(memo_keys)
+        return judge_err
+
+    def _judge_on(self, working_volume: Volume) -> Error:
         # チェッカーを走らせる
-        prebuilt_result = self._exec_checker(testcase_list=self.prebuilt_testcases, initial_volume=working_volume, container_name="binary-runner", timeoutSec=2.0, memoryLimitMB=512)
+        prebuilt_result = self._exec_checker(testcase_list=self.prebuilt_testcases, initial_volume=working_volume, container_name="binary-runner", timeoutSec=CHECKER_TIMEOUT_SEC, memoryLimitMB=CHECKER_MEMORY_LIMIT_MB)
         if prebuilt_result is not JudgeSummaryStatus.AC:
             # 早期終了
             db = SessionLocal()
             self.submission_record.progress = SubmissionProgressStatus.DONE
             self.submission_record.prebuilt_result = prebuilt_result
-            update_submission_record(db=db, submission_record=self.submission_record)
+            self._save_submission(db)
             db.close()
             return Error.Nothing()
         else:
@@ -396,19 +870,19 @@ class JudgeInfo:
             db = SessionLocal()
             self.submission_record.progress = SubmissionProgressStatus.DONE
             self.submission_record.postbuilt_result = JudgeSummaryStatus.CE
-            update_submission_record(db=db, submission_record=self.submission_record)
+            self._save_submission(db)
             db.close()
             return Error.Nothing()
         
         # 3. コンパイル後のチェックを行う
         # チェッカーを走らせる
-        postbuilt_result = self._exec_checker(testcase_list=self.postbuilt_testcases, initial_volume=working_volume, container_name="checker-lang-gcc", timeoutSec=2.0, memoryLimitMB=512)
+        postbuilt_result = self._exec_checker(testcase_list=self.postbuilt_testcases, initial_volume=working_volume, container_name="checker-lang-gcc", timeoutSec=CHECKER_TIMEOUT_SEC, memoryLimitMB=CHECKER_MEMORY_LIMIT_MB)
         if postbuilt_result is not JudgeSummaryStatus.AC:
             # 早期終了
             db = SessionLocal()
             self.submission_record.progress = SubmissionProgressStatus.DONE
             self.submission_record.postbuilt_result = postbuilt_result
-            update_submission_record(db=db, submission_record=self.submission_record)
+            self._save_submission(db)
             db.close()
             return Error.Nothing()
         else:
@@ -416,17 +890,251 @@ class JudgeInfo:
         
         # 4. ジャッジを行う
         # チェッカーを走らせる
-        judge_result = self._exec_checker(testcase_list=self.judge_testcases, initial_volume=working_volume, container_name="binary-runner", timeoutSec=self.problem_record.timeMS / 1000.0, memoryLimitMB=self.problem_record.memoryMB)
-        
-        # ボリュームを削除
-        err = working_volume.remove()
-        if not err.silence():
-            test_logger.info(f"failed to remove volume: {working_volume.name}")
+        judge_result = self._exec_checker(testcase_list=self.judge_testcases, initial_volume=working_volume, container_name="binary-runner", timeoutSec=self.problem_record.timeMS / 1000.0, memoryLimitMB=self.problem_record.memoryMB, outputLimitByte=self.problem_record.outputLimitKB * 1024, batch=True, parallel=True, fail_fast=self._fail_fast())
         
         # ジャッジ結果を登録
         db = SessionLocal()
         self.submission_record.progress = SubmissionProgressStatus.DONE
         self.submission_record.judge_result = judge_result
-        update_submission_record(db=db, submission_record=self.submission_record)
+        self._save_submission(db)
+        db.close()
+        return Error.Nothing()
+
+    # 以下はjudge()のasyncio版。sandboxの操作をイベントループ上で行い、スレッドを専有しない。
+    # (コンテナプールはスレッドで管理しているので使わない。DBの操作は別スレッドで行う)
+
+    def _update_submission(self) -> None:
+        db = SessionLocal()
+        self._save_submission(db)
+        db.close()
+
+    async def _create_complete_volume_async(self) -> tuple[Volume, Error]:
+        docker_volume, err = await AsyncVolume.create()
+        if not err.silence():
+            return (Volume(""), Error(f"cannot create volume: {docker_volume.name}"))
+
+        # copy uploaded files and arranged files to volume
+        err = await docker_volume.copyFiles(self.uploaded_filepaths + self.arranged_filepaths)
+        if not err.silence():
+            await docker_volume.remove()
+            return (
+                Volume(""),
+                Error(f"failed to copy uploaded files to volume: {docker_volume.name}"),
+            )
+
+        objects = await asyncio.to_thread(self._prebuilt_objects)
+        if objects is not None:
+            err = await docker_volume.extractArchive(objects)
+            if not err.silence():
+                test_logger.info(f"failed to stage prebuilt objects: {err.message}")
+
+        return (docker_volume.volume, Error.Nothing())
+
+    async def _clone_volume_async(self, initial_volume: Volume) -> tuple[AsyncVolume, Error]:
+        if SNAPSHOT_CLONE:
+            volume, err = await AsyncVolume(initial_volume).snapshot()
+            if err.silence():
+                return volume, err
+            test_logger.info(f"failed to create snapshot, fall back to copying: {err}")
+        return await AsyncVolume(initial_volume).clone()
+
+    async def _run_on_workdir_async(self, task: TaskInfo | BatchTaskInfo, initial_volume: Volume, run):
+        if TMPFS_WORKDIR_MB > 0:
+            # ボリュームを作らず、initial_volumeの内容をコピーしたtmpfs上で実行する
+            task.tmpfsWorkDirMB = TMPFS_WORKDIR_MB
+            task.tmpfsSeedVolume = initial_volume
+            return await run()
+
+        volume, err = await self._clone_volume_async(initial_volume)
+        if not err.silence():
+            return None, err
+
+        task.volumeMountInfo = [VolumeMountInfo(path="/workdir/", volume=volume.volume)]
+        try:
+            return await run()
+        finally:
+            err2 = await volume.remove()
+            if not err2.silence():
+                test_logger.info(f"failed to remove volume: {volume.name}")
+
+    # _run_testcasesのasyncio版
+    async def _run_testcases_async(self, loaded_testcases: list[tuple[TestCaseRecord, list[str], str, str, str]], parallel: bool, initial_volume: Volume, container_name: str, timeoutSec: float, memoryLimitMB: int, outputLimitByte: int) -> AsyncIterator[tuple[TaskResult, Error]]:
+        async def run(testcase: TestCaseRecord, args: list[str], stdin: str) -> tuple[TaskResult, Error]:
+            task, script_files = self._testcase_task(
+                testcase, args, stdin, container_name, timeoutSec, memoryLimitMB, outputLimitByte
+            )
+            task.extraFiles = script_files
+            return await self._run_on_workdir_async(task, initial_volume, lambda: runTask(task))
+
+        parallelism = self._testcase_parallelism() if parallel else 1
+        if parallelism <= 1 or len(loaded_testcases) <= 1:
+            for testcase, args, stdin, _, _ in loaded_testcases:
+                yield await run(testcase, args, stdin)
+            return
+
+        local_budget = asyncio.Semaphore(parallelism)
+
+        async def run_in_budget(testcase: TestCaseRecord, args: list[str], stdin: str) -> tuple[TaskResult, Error]:
+            async with local_budget, _testcase_budget_async:
+                return await run(testcase, args, stdin)
+
+        tasks = [
+            asyncio.create_task(run_in_budget(testcase, args, stdin))
+            for testcase, args, stdin, _, _ in loaded_testcases
+        ]
+        try:
+            for task in tasks:
+                yield await task
+        finally:
+            # 途中で読むのをやめた場合(fail-fast)は、残りのテストケースの実行を止める
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _exec_checker_async(self, testcase_list: list[TestCaseRecord], initial_volume: Volume, container_name: str, timeoutSec: float, memoryLimitMB: int, outputLimitByte: int = DEFAULT_OUTPUT_LIMIT_BYTE, batch: bool = False, parallel: bool = False, fail_fast: bool = False) -> JudgeSummaryStatus:
+        db = SessionLocal()
+        status_aggregator: JudgeSummaryStatusAggregator = JudgeSummaryStatusAggregator(JudgeSummaryStatus.AC)
+
+        loaded_testcases: list[tuple[TestCaseRecord, list[str], str, str, str]] = []
+        for testcase in testcase_list:
+            args, stdin, expected_stdout, expected_stderr, err = self._load_testcase(testcase)
+            if not err.silence():
+                await asyncio.to_thread(self._register_internal_error, db, testcase, err.message)
+                status_aggregator.update(JudgeSummaryStatus.IE)
+                continue
+            loaded_testcases.append((testcase, args, stdin, expected_stdout, expected_stderr))
+
+        # fail-fastの場合は、AC以外の結果が出た後のテストケースを実行しないように1つずつ実行する
+        batch_results: list[TaskResult] | None = None
+        if (
+            batch
+            and BATCH_JUDGE
+            and not fail_fast
+            and len(loaded_testcases) > 0
+            and all(testcase.script_path is None for testcase, *_ in loaded_testcases)
+        ):
+            task = self._batch_task(
+                [(args, stdin) for _, args, stdin, _, _ in loaded_testcases],
+                container_name, timeoutSec, memoryLimitMB, outputLimitByte,
+            )
+            results, err = await self._run_on_workdir_async(task, initial_volume, task.runAsync)
+            if err.silence():
+                batch_results = results
+            else:
+                test_logger.info(f"failed to run testcases in batch, fall back to one by one: {err}")
+
+        async def batch_results_of(results: list[TaskResult]) -> AsyncIterator[tuple[TaskResult, Error]]:
+            for result in results:
+                yield result, Error.Nothing()
+
+        if batch_results is not None:
+            run_results = batch_results_of(batch_results)
+        else:
+            run_results = self._run_testcases_async(
+                loaded_testcases, parallel, initial_volume, container_name, timeoutSec, memoryLimitMB, outputLimitByte
+            )
+
+        for testcase, args, stdin, expected_stdout, expected_stderr in loaded_testcases:
+            if fail_fast and status_aggregator.flag is not JudgeSummaryStatus.AC:
+                await run_results.aclose()
+                await asyncio.to_thread(self._register_skipped, db, testcase)
+                continue
+
+            result, err = await anext(run_results)
+            if not err.silence():
+                await asyncio.to_thread(self._register_internal_error, db, testcase, err.message)
+                status_aggregator.update(JudgeSummaryStatus.IE)
+                continue
+
+            status = await asyncio.to_thread(
+                self._result_check_and_register,
+                db=db,
+                testcase=testcase,
+                result=result,
+                expected_stdout=expected_stdout,
+                expected_stderr=expected_stderr,
+                memoryLimitMB=memoryLimitMB,
+            )
+
+            status_aggregator.update(status)
+
         db.close()
+        return status_aggregator.flag
+
+    async def _compile_async(self, working_volume: Volume, container_name: str) -> Error:
+        task, err = self._compile_task(working_volume, container_name)
+        if not err.silence():
+            return err
+
+        cache_key = await asyncio.to_thread(self._compile_cache_key, container_name)
+        if cache_key != "" and await asyncio.to_thread(compile_cache.restore, cache_key, working_volume):
+            test_logger.info(f"compile cache hit: {cache_key}")
+            return Error.Nothing()
+
+        result, err = await runTask(task)
+
+        if not err.silence():
+            return Error(f"compile failed: {result.stderr}")
+
+        if cache_key != "" and self._compile_cacheable(result):
+            err = await asyncio.to_thread(compile_cache.save, cache_key, working_volume)
+            if not err.silence():
+                test_logger.info(f"failed to save compile cache: {err.message}")
+
+        return Error.Nothing()
+
+    async def judge_async(self) -> Error:
+        # 0. 同じ内容の提出のジャッジ結果があれば、それをコピーする
+        memo_keys = await asyncio.to_thread(self._memo_keys)
+        if memo_keys is not None and await asyncio.to_thread(self._reuse_memoized_result, memo_keys):
+            return Error.Nothing()
+
+        # 1. コンパイル前のチェックを行う
+        working_volume, err = await self._create_complete_volume_async()
+        if not err.silence():
+            return err
+
+        try:
+            judge_err = await self._judge_on_async(working_volume)
+        finally:
+            # ボリュームを削除
+            err = await AsyncVolume(working_volume).remove()
+            if not err.silence():
+                test_logger.info(f"failed to remove volume: {working_volume.name}")
+
+        if judge_err.silence() and memo_keys is not None:
+            await asyncio.to_thread(self._register_memo, memo_keys)
+        return judge_err
+
+    async def _judge_on_async(self, working_volume: Volume) -> Error:
+        prebuilt_result = await self._exec_checker_async(testcase_list=self.prebuilt_testcases, initial_volume=working_volume, container_name="binary-runner", timeoutSec=CHECKER_TIMEOUT_SEC, memoryLimitMB=CHECKER_MEMORY_LIMIT_MB)
+        self.submission_record.prebuilt_result = prebuilt_result
+        if prebuilt_result is not JudgeSummaryStatus.AC:
+            self.submission_record.progress = SubmissionProgressStatus.DONE
+            await asyncio.to_thread(self._update_submission)
+            return Error.Nothing()
+
+        # 2. コンパイルを行う
+        err = await self._compile_async(working_volume=working_volume, container_name="checker-lang-gcc")
+        if not err.silence():
+            self.submission_record.progress = SubmissionProgressStatus.DONE
+            self.submission_record.postbuilt_result = JudgeSummaryStatus.CE
+            await asyncio.to_thread(self._update_submission)
+            return Error.Nothing()
+
+        # 3. コンパイル後のチェックを行う
+        postbuilt_result = await self._exec_checker_async(testcase_list=self.postbuilt_testcases, initial_volume=working_volume, container_name="checker-lang-gcc", timeoutSec=CHECKER_TIMEOUT_SEC, memoryLimitMB=CHECKER_MEMORY_LIMIT_MB)
+        self.submission_record.postbuilt_result = postbuilt_result
+        if postbuilt_result is not JudgeSummaryStatus.AC:
+            self.submission_record.progress = SubmissionProgressStatus.DONE
+            await asyncio.to_thread(self._update_submission)
+            return Error.Nothing()
+
+        # 4. ジャッジを行う
+        judge_result = await self._exec_checker_async(testcase_list=self.judge_testcases, initial_volume=working_volume, container_name="binary-runner", timeoutSec=self.problem_record.timeMS / 1000.0, memoryLimitMB=self.problem_record.memoryMB, outputLimitByte=self.problem_record.outputLimitKB * 1024, batch=True, parallel=True, fail_fast=self._fail_fast())
+
+        # ジャッジ結果を登録
+        self.submission_record.progress = SubmissionProgressStatus.DONE
+        self.submission_record.judge_result = judge_result
+        await asyncio.to_thread(self._update_submission)
         return Error.Nothing()
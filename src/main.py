@@ -1,100 +1,268 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File
+from fastapi.responses import StreamingResponse
+from fastapi.encoders import jsonable_encoder
+import json
 from contextlib import asynccontextmanager
 import logging
-from concurrent.futures import ThreadPoolExecutor, Future
 import asyncio
 from db.crud import *
 from db.models import *
 from db.database import SessionLocal
 from sandbox.my_error import Error
-from judge import JudgeInfo
+from upload import MultipartUpload
+from progress import EVENT_SUBMISSION, EVENT_TESTCASE, DatabaseRelay, batch_topic, progress_bus, submission_topic
+from worker import JUDGE_POLL_MAX_SEC, dispatch_signal, start_worker, stop_worker, wake_up_workers
+from sandbox.ccache import ccacheStats
+from dotenv import load_dotenv
+from pathlib import Path
+import uuid
+import time
+import os
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("uvicorn")
 
+load_dotenv()
 
-class WorkerPool:
-    max_workers: int
-    executor: ThreadPoolExecutor
-    active_jobs: dict
+# trueなら、このプロセスでもジャッジを実行する(falseなら提出の受付・結果の取得のみを行い、ジャッジはworker.pyで実行する)
+JUDGE_EMBEDDED_WORKER = os.getenv("JUDGE_EMBEDDED_WORKER", "true").lower() == "true"
+# JUDGE_EMBEDDED_WORKER=falseの場合に、ジャッジの進み具合をDBから読む間隔[秒]
+JUDGE_PROGRESS_RELAY_SEC = float(os.getenv("JUDGE_PROGRESS_RELAY_SEC", "1"))
+# GET /submissions/{id}?wait=で、ジャッジの完了を待つ時間の上限[秒]
+JUDGE_LONG_POLL_MAX_SEC = float(os.getenv("JUDGE_LONG_POLL_MAX_SEC", "60"))
+# Server-Sent Eventsで、イベントが無い間に接続を保つためのコメントを送る間隔[秒]
+JUDGE_EVENTS_HEARTBEAT_SEC = float(os.getenv("JUDGE_EVENTS_HEARTBEAT_SEC", "15"))
 
-    def __init__(self, max_workers: int):
-        self.max_workers = max_workers
-        self.executor = ThreadPoolExecutor(max_workers=max_workers)
-        self.active_jobs = {}
+RESOURCE_DIR = Path(os.getenv("RESOURCE_PATH", "/resource"))
+# 提出されたファイルを置くディレクトリ(RESOURCE_PATHからの相対パス)
+UPLOAD_DIR = Path("submissions")
 
-    def available_workers(self) -> int:
-        return self.max_workers - len(self.active_jobs)
 
-    def collect_completed_jobs(self) -> list:
-        now_completed = [job for job, future in self.active_jobs.items() if future.done()]
-        completed_jobrecord = [(job[0], job[1], future.result()) for job, future in self.active_jobs.items() if future.done()]
-        for job in now_completed:
-            self.active_jobs.pop(job)
-        return completed_jobrecord
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logger.info("LIFESPAN LOGIC INITIALIZED...")
+    progress_bus.bind(asyncio.get_running_loop())
+    if JUDGE_EMBEDDED_WORKER:
+        # このプロセスでもジャッジを実行する
+        tasks = await start_worker()
+    else:
+        # ジャッジはworker.pyのプロセスで実行されるので、その結果をDBから読んで配信する
+        tasks = [asyncio.create_task(relay_progress())]
+    yield
+    logger.info("LIFESPAN LOGIC DEACTIVATED...")
+    if JUDGE_EMBEDDED_WORKER:
+        await stop_worker(tasks)
+    else:
+        for task in tasks:
+            task.cancel()
 
-    def submit_job(self, job: str, func, *args, **kwargs):
-        if self.available_workers() > 0:
-            future = self.executor.submit(func, *args, **kwargs)
-            self.active_jobs[(job, datetime.now())] = future
-            return True
-        return False
-    
-worker_pool = WorkerPool(max_workers=50)
-
-def process_one_judge_request(submission: SubmissionRecord) -> Error:
-    logger.info(f"JudgeInfo(submission_id={submission.id}, lecture_id={submission.lecture_id}, assignment_id={submission.assignment_id}, for_evaluation={submission.for_evaluation}) will be created...")
-    judge_info = JudgeInfo(submission)
-    logger.info("START JUDGE...")
-    err = judge_info.judge()
-    logger.info("END JUDGE")
-    
-    return err
-
-async def process_judge_requests():
+
+# ジャッジを別のプロセスで実行する場合に、購読されている提出・バッチの進み具合をDBから読んで配信する
+async def relay_progress():
+    relay = DatabaseRelay(progress_bus)
     while True:
         try:
-            completed_jobrecord_list = worker_pool.collect_completed_jobs()
-            for completed_jobrecord in completed_jobrecord_list:
-                logger.info(f"job: \"{completed_jobrecord[0]}\", date: {completed_jobrecord[1]}, result: {completed_jobrecord[2]}")
+            await asyncio.to_thread(relay.poll)
+        except Exception as e:
+            logger.error(f"ジャッジの進み具合の配信に失敗しました: {type(e).__name__}: {str(e)}")
+        await asyncio.sleep(JUDGE_PROGRESS_RELAY_SEC)
+
+app = FastAPI(lifespan=lifespan)
+
+
+# コンパイラキャッシュ(ccache)の統計情報(ヒット数・ミス数・キャッシュの大きさ等)
+@app.get("/stats/ccache")
+async def get_ccache_stats():
+    stats, err = await asyncio.to_thread(ccacheStats)
+    if not err.silence():
+        raise HTTPException(status_code=503, detail=err.message)
+    return stats
+
+
+# ジャッジを実行するワーカーに、すぐにキューを見に行くように知らせる
+# (JUDGE_EMBEDDED_WORKER=falseの場合は、worker.pyのワーカーのホストにUDPで知らせる)
+async def notify_workers() -> None:
+    if JUDGE_EMBEDDED_WORKER:
+        dispatch_signal.notify()
+        return
+    try:
+        await asyncio.to_thread(wake_up_workers)
+    except Exception as e:
+        logger.error(f"ワーカーへの通知に失敗しました: {type(e).__name__}: {str(e)}")
+
+
+# ジャッジリクエストを登録した(progressを"queued"にした)クライアントが呼ぶと、すぐにキューを見に行く
+# 呼ばれなくても、JUDGE_POLL_MAX_SEC秒以内には見に行く
+@app.post("/judge/wakeup", status_code=202)
+async def wakeup_dispatcher():
+    await notify_workers()
+    return {"status": "accepted"}
+
+
+def _parse_bool(fields: dict[str, str], name: str, default: bool | None) -> bool | None:
+    value = fields.get(name, "").strip().lower()
+    if value == "":
+        return default
+    if value in ("true", "1"):
+        return True
+    if value in ("false", "0"):
+        return False
+    raise HTTPException(status_code=400, detail=f"{name} must be true or false")
+
+
+def _parse_int(fields: dict[str, str], name: str, required: bool = True) -> int | None:
+    value = fields.get(name, "").strip()
+    if value == "":
+        if required:
+            raise HTTPException(status_code=400, detail=f"{name} is required")
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be an integer")
+
+
+# 提出を受け付ける(multipart/form-data)
+# フィールド: student_id, lecture_id, assignment_id, for_evaluation(省略時false),
+#             batch_id(省略可), fail_fast(省略時は課題の設定に従う), 提出するファイル(名前は任意、複数可)
+# ファイルはRESOURCE_PATH/submissions/<ランダムなID>/に書き込み、ジャッジリクエストの登録とキューへの追加は
+# 1つのトランザクションで行う
+@app.post("/submissions", status_code=201)
+async def submit(request: Request):
+    upload = MultipartUpload(RESOURCE_DIR / UPLOAD_DIR / uuid.uuid4().hex)
+    err = await upload.receive(request.headers.get("content-type", ""), request.stream())
+    if not err.silence():
+        raise HTTPException(status_code=400, detail=err.message)
+
+    try:
+        student_id = upload.fields.get("student_id", "").strip()
+        if student_id == "":
+            raise HTTPException(status_code=400, detail="student_id is required")
+        if len(upload.files) == 0:
+            raise HTTPException(status_code=400, detail="no files are uploaded")
+        lecture_id = _parse_int(upload.fields, "lecture_id")
+        assignment_id = _parse_int(upload.fields, "assignment_id")
+        for_evaluation = _parse_bool(upload.fields, "for_evaluation", False)
+
+        def register() -> SubmissionRecord | None:
             with SessionLocal() as db:
-                num_available_workers = worker_pool.available_workers()
-                queued_submissions = fetch_queued_judge_and_change_status_to_running(db, num_available_workers)
-            if queued_submissions:
-                logger.info(
-                    f"{len(queued_submissions)}件のジャッジリクエストを取得しました。"
+                if fetch_problem(db, lecture_id, assignment_id, for_evaluation) is None:
+                    return None
+                return register_and_enqueue_judge_request(
+                    db=db,
+                    batch_id=_parse_int(upload.fields, "batch_id", required=False),
+                    student_id=student_id,
+                    lecture_id=lecture_id,
+                    assignment_id=assignment_id,
+                    for_evaluation=for_evaluation,
+                    paths=[path.relative_to(RESOURCE_DIR) for path in upload.files],
+                    fail_fast=_parse_bool(upload.fields, "fail_fast", None),
                 )
-                # スレッドプールを使用して各ジャッジリクエストを処理
-                for submission in queued_submissions:
-                    logger.info(f"submission: {submission}")
-                    logger.info("throw judge request to thread pool...")
-                    worker_pool.submit_job(f"submission-{submission.id}", process_one_judge_request, submission)
-            else:
-                logger.info("キューにジャッジリクエストはありません。")
-        except Exception as e:
-            import traceback
-            logger.error(f"例外が発生しました: {type(e).__name__}: {str(e)}")
-            logger.error(f"スタックトレース:\n{traceback.format_exc()}")
-            logger.info("データベースに接続できない可能性があります。準備ができていない可能性があります。")
 
-        await asyncio.sleep(5)  # 5秒待機
+        submission = await asyncio.to_thread(register)
+        if submission is None:
+            raise HTTPException(status_code=404, detail="problem not found")
+    except BaseException:
+        upload.discard()
+        raise
 
+    await notify_workers()
+    return submission
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    logger.info("LIFESPAN LOGIC INITIALIZED...")
-    task = asyncio.create_task(process_judge_requests())
-    yield
-    task.cancel()
-    logger.info("LIFESPAN LOGIC DEACTIVATED...")
-    # 現在実行しているジャッジリクエストを最後まで実行し、保留状態のものは破棄する
-    worker_pool.executor.shutdown(wait=True, cancel_futures=True)
-    completed_jobrecord_list = worker_pool.collect_completed_jobs()
-    for completed_jobrecord in completed_jobrecord_list:
-        logger.info(f"job: \"{completed_jobrecord[0]}\", date: {completed_jobrecord[1]}, result: {completed_jobrecord[2]}")
-    # statusをrunningにしてしまっているタスクをqueuedに戻す
-    # そして途中結果を削除する
+
+# 提出の状態とジャッジ結果を返す
+# waitを指定すると、ジャッジが完了するまで最大wait秒(JUDGE_LONG_POLL_MAX_SEC秒まで)待ってから返す
+# このサーバーで実行したジャッジは提出の状態が更新された時点でDBを確認し、
+# 他のサーバーで実行したジャッジはJUDGE_POLL_MAX_SEC秒ごとにDBを確認する
+@app.get("/submissions/{submission_id}")
+async def get_submission(submission_id: int, wait: float = 0):
+    deadline = time.monotonic() + min(max(wait, 0), JUDGE_LONG_POLL_MAX_SEC)
+
+    # DBを確認する前に購読しておけば、確認した後に完了しても取りこぼさない
+    with progress_bus.subscribe(submission_topic(submission_id)) as events:
+        while True:
+            submission, results = await asyncio.to_thread(_fetch_submission_and_results, submission_id, False)
+            if submission is None:
+                raise HTTPException(status_code=404, detail="submission not found")
+            remaining = deadline - time.monotonic()
+            if submission.progress == SubmissionProgressStatus.DONE or remaining <= 0:
+                return {"submission": submission, "results": results}
+            await _wait_for_event(events, EVENT_SUBMISSION, min(remaining, JUDGE_POLL_MAX_SEC))
+
+
+def _fetch_submission_and_results(submission_id: int, partial: bool) -> tuple[SubmissionRecord | None, list[JudgeResultRecord]]:
+    # partialがFalseなら、ジャッジが完了していない提出の途中結果は返さない
     with SessionLocal() as db:
-        undo_running_submissions(db)
+        submission = fetch_submission_record(db, submission_id)
+        if submission is None or (not partial and submission.progress != SubmissionProgressStatus.DONE):
+            return submission, []
+        return submission, fetch_judge_results(db, submission_id)
 
-app = FastAPI(lifespan=lifespan)
+
+# eventの種類のイベントが来るか、timeoutSec秒経つまで待つ
+async def _wait_for_event(events: asyncio.Queue, event: str, timeoutSec: float) -> None:
+    deadline = time.monotonic() + timeoutSec
+    while (remaining := deadline - time.monotonic()) > 0:
+        try:
+            if (await asyncio.wait_for(events.get(), timeout=remaining)).event == event:
+                return
+        except TimeoutError:
+            return
+
+
+def _sse(event: str, data: str) -> str:
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+# イベントをServer-Sent Eventsとして送る。submission_idを指定した場合は、その提出のジャッジが完了したら終わる
+async def _stream_events(events: asyncio.Queue, submission_id: int | None = None):
+    while True:
+        try:
+            event = await asyncio.wait_for(events.get(), timeout=JUDGE_EVENTS_HEARTBEAT_SEC)
+        except TimeoutError:
+            yield ": heartbeat\n\n"
+            continue
+        yield _sse(event.event, event.data)
+        if submission_id is not None and event.event == EVENT_SUBMISSION and json.loads(event.data)["progress"] == SubmissionProgressStatus.DONE.value:
+            return
+
+
+# 提出のジャッジの進み具合をServer-Sent Eventsで送る
+# 最初に現在の状態(submission)と登録済みの結果(testcase)を送り、その後はテストケースの結果が登録されるたびに
+# testcase、提出の状態が更新されるたびにsubmissionを送る。ジャッジが完了したら接続を閉じる
+# (購読してから現在の状態を読むので、同じテストケースの結果が2回送られることはある。
+# ジャッジを別のプロセスで実行する場合、複数のワーカーの結果はIDの順にコミットされるとは限らないので、
+# DatabaseRelayは直近JUDGE_PROGRESS_RESCAN_SEC秒に登録された結果を読み直して配信する。
+# それより遅れてコミットされた結果は送られないので、全ての結果はGET /submissions/{id}で取得する)
+@app.get("/submissions/{submission_id}/events")
+async def stream_submission_events(submission_id: int):
+    def exists() -> bool:
+        with SessionLocal() as db:
+            return fetch_submission_record(db, submission_id) is not None
+
+    if not await asyncio.to_thread(exists):
+        raise HTTPException(status_code=404, detail="submission not found")
+
+    async def stream():
+        with progress_bus.subscribe(submission_topic(submission_id)) as events:
+            submission, results = await asyncio.to_thread(_fetch_submission_and_results, submission_id, True)
+            yield _sse(EVENT_SUBMISSION, json.dumps(jsonable_encoder(submission)))
+            for result in results:
+                yield _sse(EVENT_TESTCASE, json.dumps(jsonable_encoder(result)))
+            if submission.progress == SubmissionProgressStatus.DONE:
+                return
+            async for chunk in _stream_events(events, submission_id):
+                yield chunk
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+# バッチに属する全ての提出のジャッジの進み具合をServer-Sent Eventsで送る(接続してから後のイベントのみ)
+@app.get("/batches/{batch_id}/events")
+async def stream_batch_events(batch_id: int):
+    async def stream():
+        with progress_bus.subscribe(batch_topic(batch_id)) as events:
+            async for chunk in _stream_events(events):
+                yield chunk
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
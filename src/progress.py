@@ -0,0 +1,202 @@
+"""
+このプログラムでは、ジャッジの進み具合をこのプロセス内で配信するpub/subを実装する。
+* テストケースの結果・提出の状態を、提出ごと・バッチごとの購読者に配信するクラスProgressBus
+* ジャッジを別のプロセス(worker.py)で実行する場合に、DBに登録された結果を配信するクラスDatabaseRelay
+
+JudgeInfoはテストケースの結果をDBに登録するたびにpublishし、Server-Sent Eventsのエンドポイント
+(main.py)はsubscribeしたキューからイベントを読んでクライアントに送る。
+イベントはpublishの時点で1回だけJSONにするので、購読者が何人いてもDBへの問い合わせやエンコードは増えない。
+ジャッジが別のプロセスで実行される場合は、DatabaseRelayが購読されている提出・バッチの分だけをまとめてDBから読む。
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+from dotenv import load_dotenv
+from fastapi.encoders import jsonable_encoder
+
+from db.crud import (
+    SubmissionProgressStatus,
+    SubmissionRecord,
+    fetch_judge_results_after,
+    fetch_max_judge_result_id,
+    fetch_submission_records,
+)
+from db.database import SessionLocal
+
+load_dotenv()
+
+# 購読者ごとに溜めておくイベントの数の上限(読むのが遅い購読者の分は古いものから捨てる)
+PROGRESS_QUEUE_SIZE = int(os.getenv("JUDGE_PROGRESS_QUEUE_SIZE", "256"))
+# DatabaseRelayが、最後に配信したIDより小さいジャッジ結果も読み直す期間[秒]
+# (別のワーカーのトランザクションが遅れてコミットした結果を取りこぼさないため)
+PROGRESS_RESCAN_SEC = int(os.getenv("JUDGE_PROGRESS_RESCAN_SEC", "10"))
+
+# イベントの種類
+EVENT_TESTCASE = "testcase"  # テストケースの結果(JudgeResultRecord)が登録された
+EVENT_SUBMISSION = "submission"  # 提出の状態(SubmissionRecord)が更新された
+
+
+@dataclass
+class ProgressEvent:
+    event: str  # イベントの種類
+    data: str  # JSONにエンコードした内容
+
+
+def submission_topic(submission_id: int) -> tuple[str, int]:
+    return "submission", submission_id
+
+
+def batch_topic(batch_id: int) -> tuple[str, int]:
+    return "batch", batch_id
+
+
+class ProgressBus:
+    _loop: asyncio.AbstractEventLoop | None
+    _subscribers: dict[tuple[str, int], set[asyncio.Queue]]
+    _lock: threading.Lock
+
+    def __init__(self):
+        self._loop = None
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def bind(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+
+    def topics(self) -> list[tuple[str, int]]:
+        """
+        購読者がいるtopicのリストを返します。
+        """
+        with self._lock:
+            return list(self._subscribers)
+
+    def _deliver(self, topics: list[tuple[str, int]], event: ProgressEvent) -> None:
+        for topic in topics:
+            for queue in self._subscribers.get(topic, ()):
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait(event)
+
+    def publish(self, submission: SubmissionRecord, event: str, data: object) -> None:
+        """
+        提出と、提出が属するバッチの購読者にイベントを配信します。どのスレッドからでも呼べます。
+        """
+        loop = self._loop
+        if loop is None:
+            return
+        topics = [submission_topic(submission.id)]
+        if submission.batch_id is not None:
+            topics.append(batch_topic(submission.batch_id))
+        # 購読者がいなければエンコードもしない
+        with self._lock:
+            if not any(topic in self._subscribers for topic in topics):
+                return
+
+        progress_event = ProgressEvent(event=event, data=json.dumps(jsonable_encoder(data)))
+        try:
+            loop.call_soon_threadsafe(self._deliver, topics, progress_event)
+        except RuntimeError:
+            # イベントループが既に閉じている(シャットダウン中)
+            pass
+
+    @contextmanager
+    def subscribe(self, topic: tuple[str, int]):
+        """
+        topicに配信されたイベントが入るasyncio.Queueを返します。イベントループのスレッドで呼んでください。
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=PROGRESS_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(topic, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            with self._lock:
+                queues = self._subscribers[topic]
+                queues.discard(queue)
+                if not queues:
+                    del self._subscribers[topic]
+
+
+progress_bus = ProgressBus()
+
+
+class DatabaseRelay:
+    bus: ProgressBus
+    _lastResultId: int  # 配信したジャッジ結果の最大のID
+    _published: dict[int, float]  # 読み直す期間内に配信したジャッジ結果のIDと、配信した時刻(同じ結果を2回配信しない)
+    _states: dict[int, tuple]  # 提出ごとの、最後に配信した状態
+    _running: set[int]  # 購読されているバッチに属し、前回実行中だった提出のID
+
+    def __init__(self, bus: ProgressBus):
+        self.bus = bus
+        self._lastResultId = 0
+        self._published = {}
+        self._states = {}
+        self._running = set()
+
+    def poll(self) -> None:
+        """
+        まだ配信していないジャッジ結果と、状態が変わった提出を配信します。DBを読むので別スレッドで呼んでください。
+        購読されている提出・バッチの数に関わらず、1回の呼び出しでの問い合わせは2回以下です。
+        """
+        topics = self.bus.topics()
+        submission_ids = {topic_id for kind, topic_id in topics if kind == "submission"}
+        batch_ids = {topic_id for kind, topic_id in topics if kind == "batch"}
+
+        with SessionLocal() as db:
+            if not topics:
+                # 購読者がいない間の結果は配信しない(購読した時点の状態はエンドポイントがDBから読んで送る)
+                self._lastResultId = fetch_max_judge_result_id(db)
+                self._published = {}
+                self._states = {}
+                self._running = set()
+                return
+            results = fetch_judge_results_after(
+                db, self._lastResultId, submission_ids, batch_ids, recent_sec=PROGRESS_RESCAN_SEC
+            )
+            results = [result for result in results if result.id not in self._published]
+            # 結果が増えた提出と、前回実行中だった提出(結果を登録せずに終わる場合がある)の状態も読む
+            ids = submission_ids | self._running | {result.submission_id for result in results}
+            submissions = {
+                submission.id: submission
+                for submission in fetch_submission_records(db, ids, batch_ids)
+            }
+
+        # 読み直す期間を過ぎた結果はもう読まれないので、配信済みの記録から消す
+        now = time.monotonic()
+        self._published = {
+            result_id: published_at
+            for result_id, published_at in self._published.items()
+            if now - published_at <= 2 * PROGRESS_RESCAN_SEC
+        }
+        for result in results:
+            self._lastResultId = max(self._lastResultId, result.id)
+            self._published[result.id] = now
+            submission = submissions.get(result.submission_id)
+            if submission is not None:
+                self.bus.publish(submission, EVENT_TESTCASE, result)
+
+        states: dict[int, tuple] = {}
+        for submission in submissions.values():
+            state = (
+                submission.progress,
+                submission.prebuilt_result,
+                submission.postbuilt_result,
+                submission.judge_result,
+                submission.message,
+            )
+            if self._states.get(submission.id) != state:
+                self.bus.publish(submission, EVENT_SUBMISSION, submission)
+            states[submission.id] = state
+        self._states = states
+        self._running = {
+            submission.id
+            for submission in submissions.values()
+            if submission.batch_id in batch_ids and submission.progress == SubmissionProgressStatus.RUNNING
+        }
@@ -0,0 +1,288 @@
+"""
+このプログラムでは、Docker Engine APIとのasyncioによる通信部分を実装する。
+* UNIXソケットにasyncioで接続し、HTTPリクエストを送るクライアントAsyncDockerClient
+* コンテナにattachして標準入出力をやり取りするクラスAsyncAttachedStream
+* コンテナの起動前に終了待ちを登録するクラスAsyncExitWaiter
+
+docker_client.pyと同じことを、スレッドをブロックせずにイベントループ上で行うためのもの。
+docker-pyはasyncioに対応していないので、必要なAPIだけを最小限のHTTP/1.1で実装する。
+"""
+
+import asyncio
+import json
+import os
+import time
+from typing import Callable
+from urllib.parse import quote, urlencode
+
+from docker.errors import APIError, NotFound
+
+from .docker_client import (
+    DEFAULT_DOCKER_HOST,
+    _CHUNK_SIZE,
+    _FRAME_HEADER,
+    _STREAM_STDERR,
+    _STREAM_STDOUT,
+)
+
+# リクエストに使うAPIのバージョン(Docker Engine 20.10以降が対応している)
+DOCKER_API_VERSION = os.getenv("DOCKER_API_VERSION", "1.41")
+
+
+def _socket_path() -> str:
+    host = os.getenv("DOCKER_HOST", DEFAULT_DOCKER_HOST)
+    if not host.startswith("unix://"):
+        raise ValueError(f"asyncio client supports only unix socket: {host}")
+    return host[len("unix://") :]
+
+
+class AsyncDockerClient:
+    socketPath: str
+
+    def __init__(self, socketPath: str | None = None):
+        self.socketPath = socketPath if socketPath is not None else _socket_path()
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        params: dict | None = None,
+        body: bytes | None = None,
+        jsonBody: object = None,
+        headers: dict[str, str] | None = None,
+    ) -> bytes:
+        """
+        APIにリクエストを送り、レスポンスのボディを返します。
+        ステータスコードが400以上の場合は、docker-pyと同じ例外(NotFound, APIError)を送出します。
+        """
+        headers = dict(headers or {})
+        if jsonBody is not None:
+            body = json.dumps(jsonBody).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+
+        reader, writer = await asyncio.open_unix_connection(self.socketPath)
+        try:
+            await _send_request(writer, method, path, params, body, headers)
+            status, responseHeaders = await _read_head(reader)
+            data = await _read_body(reader, responseHeaders, status)
+        finally:
+            writer.close()
+
+        if status >= 400:
+            explanation = data.decode("utf-8", errors="replace")
+            try:
+                explanation = json.loads(explanation).get("message", explanation)
+            except (ValueError, AttributeError):
+                pass
+            message = f"{status} Client Error for {method} {path}"
+            if status == 404:
+                raise NotFound(message, explanation=explanation)
+            raise APIError(message, explanation=explanation)
+        return data
+
+    async def requestJSON(self, method: str, path: str, **kwargs) -> dict:
+        data = await self.request(method, path, **kwargs)
+        return json.loads(data) if data else {}
+
+    async def attach(self, containerID: str) -> "AsyncAttachedStream":
+        # コンテナを起動する前にattachしておくことで、出力を取りこぼさないようにする
+        reader, writer = await asyncio.open_unix_connection(self.socketPath)
+        try:
+            await _send_request(
+                writer,
+                "POST",
+                f"/containers/{quote(containerID)}/attach",
+                {"stream": 1, "stdin": 1, "stdout": 1, "stderr": 1},
+                None,
+                {"Connection": "Upgrade", "Upgrade": "tcp"},
+            )
+            status, _ = await _read_head(reader)
+        except BaseException:
+            writer.close()
+            raise
+        if status not in (101, 200):
+            writer.close()
+            raise APIError(f"{status} Client Error for attach {containerID}")
+        # 以降はこの接続が標準入出力のストリームになる
+        return AsyncAttachedStream(reader, writer)
+
+    async def openWait(self, containerID: str, condition: str = "next-exit") -> "AsyncExitWaiter":
+        # ExitWaiter.openと同じく、レスポンスヘッダを受け取った時点で終了待ちが登録されている
+        reader, writer = await asyncio.open_unix_connection(self.socketPath)
+        try:
+            await _send_request(
+                writer,
+                "POST",
+                f"/containers/{quote(containerID)}/wait",
+                {"condition": condition},
+                None,
+                {},
+            )
+            status, headers = await _read_head(reader)
+        except BaseException:
+            writer.close()
+            raise
+        if status >= 400:
+            writer.close()
+            message = f"{status} Client Error for wait {containerID}"
+            if status == 404:
+                raise NotFound(message)
+            raise APIError(message)
+        return AsyncExitWaiter(reader, writer, headers)
+
+
+# attachしたコンテナの標準入出力(AttachedStreamのasyncio版)
+class AsyncAttachedStream:
+    _reader: asyncio.StreamReader
+    _writer: asyncio.StreamWriter
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+
+    async def communicate(
+        self,
+        stdin: bytes,
+        deadline: float | None,
+        watchers: list[tuple[int, Callable[[], None]]] | None = None,
+        outputLimitByte: int | None = None,
+    ) -> tuple[bytes, bytes, bool, bool]:
+        """
+        AttachedStream.communicateと同じ。締め切りはtime.monotonic()基準。
+        watchersのファイルディスクリプタはイベントループで監視する。
+        """
+        loop = asyncio.get_running_loop()
+        stdout = bytearray()
+        stderr = bytearray()
+
+        for fd, callback in watchers or []:
+            loop.add_reader(fd, callback)
+        writing = asyncio.create_task(self.__write_stdin(stdin))
+        try:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.monotonic(), 0)
+            try:
+                outputExceeded = await asyncio.wait_for(
+                    self.__read_output(stdout, stderr, outputLimitByte), timeout
+                )
+            except asyncio.TimeoutError:
+                return bytes(stdout), bytes(stderr), True, False
+            return bytes(stdout), bytes(stderr), False, outputExceeded
+        finally:
+            writing.cancel()
+            await asyncio.gather(writing, return_exceptions=True)
+            for fd, _ in watchers or []:
+                loop.remove_reader(fd)
+
+    def close(self) -> None:
+        self._writer.close()
+
+    async def __write_stdin(self, stdin: bytes) -> None:
+        try:
+            for i in range(0, len(stdin), _CHUNK_SIZE):
+                self._writer.write(stdin[i : i + _CHUNK_SIZE])
+                await self._writer.drain()
+            # 書き込み側だけ閉じてEOFを伝える(コンテナはStdinOnceで作成されている)
+            if self._writer.can_write_eof():
+                self._writer.write_eof()
+        except (BrokenPipeError, ConnectionResetError):
+            # プログラムが標準入力を読まずに終了した
+            pass
+
+    async def __read_output(
+        self, stdout: bytearray, stderr: bytearray, outputLimitByte: int | None
+    ) -> bool:
+        while True:
+            try:
+                header = await self._reader.readexactly(_FRAME_HEADER.size)
+                stream, size = _FRAME_HEADER.unpack(header)
+                payload = await self._reader.readexactly(size)
+            except (asyncio.IncompleteReadError, ConnectionResetError):
+                # コンテナが終了した
+                return False
+            if stream == _STREAM_STDOUT:
+                stdout += payload
+            elif stream == _STREAM_STDERR:
+                stderr += payload
+            if outputLimitByte is not None and len(stdout) + len(stderr) > outputLimitByte:
+                del stdout[outputLimitByte:]
+                del stderr[max(outputLimitByte - len(stdout), 0) :]
+                return True
+
+
+# コンテナの終了待ち(ExitWaiterのasyncio版)
+class AsyncExitWaiter:
+    _reader: asyncio.StreamReader
+    _writer: asyncio.StreamWriter
+    _headers: dict[str, str]
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, headers: dict[str, str]):
+        self._reader = reader
+        self._writer = writer
+        self._headers = headers
+
+    async def result(self) -> int:
+        # コンテナが終了するまで待ち、終了コードを返す
+        try:
+            data = await _read_body(self._reader, self._headers, 200)
+            return int(json.loads(data)["StatusCode"])
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+async def _send_request(
+    writer: asyncio.StreamWriter,
+    method: str,
+    path: str,
+    params: dict | None,
+    body: bytes | None,
+    headers: dict[str, str],
+) -> None:
+    target = f"/v{DOCKER_API_VERSION}{path}"
+    if params:
+        target += "?" + urlencode(params)
+    lines = [f"{method} {target} HTTP/1.1", "Host: docker"]
+    if "Connection" not in headers:
+        lines.append("Connection: close")
+    lines += [f"{key}: {value}" for key, value in headers.items()]
+    lines.append(f"Content-Length: {len(body) if body is not None else 0}")
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+    if body:
+        writer.write(body)
+    await writer.drain()
+
+
+async def _read_head(reader: asyncio.StreamReader) -> tuple[int, dict[str, str]]:
+    raw = await reader.readuntil(b"\r\n\r\n")
+    statusLine, *headerLines = raw.decode("latin-1").split("\r\n")
+    status = int(statusLine.split(" ")[1])
+    headers = {}
+    for line in headerLines:
+        key, sep, value = line.partition(":")
+        if sep:
+            headers[key.strip().lower()] = value.strip()
+    return status, headers
+
+
+async def _read_body(
+    reader: asyncio.StreamReader, headers: dict[str, str], status: int
+) -> bytes:
+    if status in (204, 304):
+        return b""
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            sizeLine = await reader.readuntil(b"\r\n")
+            size = int(sizeLine.split(b";")[0], 16)
+            if size == 0:
+                await reader.readuntil(b"\r\n")
+                return b"".join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+    if "content-length" in headers:
+        return await reader.readexactly(int(headers["content-length"]))
+    return await reader.read()
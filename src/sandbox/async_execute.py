@@ -0,0 +1,403 @@
+"""
+このプログラムでは、execute.pyのsandbox操作のasyncio版を実装する。
+* Dockerボリュームの作成・削除・ファイルのコピー・スナップショットを行うクラスAsyncVolume
+* Dockerコンテナの作成・削除・起動を行うクラスAsyncContainerInfo
+* TaskInfoをイベントループ上で実行する関数runTask
+
+スレッドを1つも専有せずにsandboxを操作できるので、多数のジャッジを1つのイベントループで並行に処理できる。
+リソース制限・計測・結果の意味はexecute.pyのものと同じ。
+"""
+
+import asyncio
+import os
+import time
+import uuid
+from pathlib import Path
+from urllib.parse import quote
+
+from docker.errors import DockerException, NotFound
+from docker.types import ContainerConfig, HostConfig
+
+from .my_error import Error
+from .async_docker_client import AsyncDockerClient, DOCKER_API_VERSION
+from .docker_client import _FRAME_HEADER
+from .labels import resource_labels
+from .namespace import runInNamespace
+from .execute import (
+    ContainerInfo,
+    TaskInfo,
+    TaskResult,
+    Volume,
+    VolumeMountInfo,
+    _host_config_args,
+    _make_tar_archive,
+    test_logger,
+)
+
+_client: AsyncDockerClient | None = None
+
+
+def get_async_client() -> AsyncDockerClient:
+    global _client
+    if _client is None:
+        _client = AsyncDockerClient()
+    return _client
+
+
+# Dockerボリュームの管理クラス(Volumeのasyncio版)
+class AsyncVolume:
+    volume: Volume  # コンテナにマウントする際はこちらを使う
+
+    def __init__(self, volume: Volume):
+        self.volume = volume
+
+    @property
+    def name(self) -> str:
+        return self.volume.name
+
+    @classmethod
+    async def create(cls, driverOpts: dict | None = None) -> tuple["AsyncVolume", Error]:
+        volumeName = "volume-" + str(uuid.uuid4())
+        body = {"Name": volumeName, "Labels": resource_labels()}
+        if driverOpts is not None:
+            body.update({"Driver": "local", "DriverOpts": driverOpts})
+        try:
+            await get_async_client().request("POST", "/volumes/create", jsonBody=body)
+        except (DockerException, OSError) as e:
+            return AsyncVolume(Volume("")), Error(f"Failed to create volume: {e}")
+
+        test_logger.info(f"volumeName: {volumeName}")
+        return AsyncVolume(Volume(volumeName)), Error("")
+
+    async def remove(self) -> Error:
+        err = ""
+        try:
+            await get_async_client().request("DELETE", f"/volumes/{quote(self.name)}")
+        except (DockerException, OSError) as e:
+            err = f"Failed to remove volume: {e}"
+
+        # overlayボリュームの場合、上位層・作業用のボリュームも削除する
+        for layer in self.volume.layers:
+            layerErr = await AsyncVolume(layer).remove()
+            if layerErr.message != "":
+                err += ("\n" if err != "" else "") + layerErr.message
+
+        return Error(err)
+
+    async def copyFiles(
+        self, filePathsFromClient: list[Path], DirPathInVolume: Path = Path("./")
+    ) -> Error:
+        if DirPathInVolume.is_absolute():
+            DirPathInVolume = Path(".") / DirPathInVolume.relative_to("/")
+        try:
+            archive = _make_tar_archive(
+                [
+                    (PathInClient, os.path.normpath(DirPathInVolume / PathInClient.name))
+                    for PathInClient in filePathsFromClient
+                ]
+            )
+        except OSError as e:
+            return Error(f"Failed to copy files: {e}")
+        return await self.extractArchive(archive)
+
+    # tarアーカイブをボリューム内に展開する(起動しないコンテナを経由する。Volume.extractArchiveを参照)
+    async def extractArchive(self, archive: bytes, DirPathInVolume: Path = Path("./")) -> Error:
+        if DirPathInVolume.is_absolute():
+            DirPathInVolume = Path(".") / DirPathInVolume.relative_to("/")
+
+        ci = AsyncContainerInfo(ContainerInfo(""))
+        err = await ci.create(
+            containerName="ubuntu",
+            arguments=["true"],
+            workDir="/workdir/",
+            volumeMountInfo=[VolumeMountInfo(path="/workdir/", volume=self.volume)],
+        )
+        if err.message != "":
+            return err
+
+        err = await ci.extractArchive(archive, Path("/workdir") / DirPathInVolume)
+        await ci.remove()
+        return err
+
+    # Volume.snapshotと同じく、このボリュームを下位層とするoverlayボリュームを作る
+    async def snapshot(self) -> tuple["AsyncVolume", Error]:
+        client = get_async_client()
+
+        upper, err = await AsyncVolume.create()
+        if err.message != "":
+            return AsyncVolume(Volume("")), err
+        work, err = await AsyncVolume.create()
+        if err.message != "":
+            await upper.remove()
+            return AsyncVolume(Volume("")), err
+
+        try:
+            lowerdir, upperdir, workdir = [
+                (await client.requestJSON("GET", f"/volumes/{quote(name)}"))["Mountpoint"]
+                for name in [self.name, upper.name, work.name]
+            ]
+        except (DockerException, OSError, KeyError) as e:
+            await upper.remove()
+            await work.remove()
+            return AsyncVolume(Volume("")), Error(f"Failed to create snapshot volume: {e}")
+
+        volume, err = await AsyncVolume.create(
+            driverOpts={
+                "type": "overlay",
+                "device": "overlay",
+                "o": f"lowerdir={lowerdir},upperdir={upperdir},workdir={workdir}",
+            }
+        )
+        if err.message != "":
+            await upper.remove()
+            await work.remove()
+            return AsyncVolume(Volume("")), err
+
+        volume.volume.layers = [upper.volume, work.volume]
+        return volume, Error("")
+
+    async def clone(self) -> tuple["AsyncVolume", Error]:
+        new_volume, err = await AsyncVolume.create()
+        if err.message != "":
+            return AsyncVolume(Volume("")), Error(f"新しいボリュームの作成に失敗しました: {err.message}")
+
+        ci = AsyncContainerInfo(ContainerInfo(""))
+        err = await ci.create(
+            containerName="ubuntu",
+            arguments=["cp", "-a", "/src/.", "/dst/"],
+            workDir="/",
+            volumeMountInfo=[
+                VolumeMountInfo(path="/src", volume=self.volume),
+                VolumeMountInfo(path="/dst", volume=new_volume.volume),
+            ],
+        )
+        if err.message != "":
+            await new_volume.remove()
+            return AsyncVolume(Volume("")), Error(f"コンテナの作成に失敗しました: {err.message}")
+
+        exit_code, stderr, err = await ci.startAndWait()
+        await ci.remove()
+        if err.message != "" or exit_code != 0:
+            await new_volume.remove()
+            return AsyncVolume(Volume("")), Error(f"ボリュームのコピーに失敗しました: {err.message}{stderr}")
+
+        return new_volume, Error("")
+
+
+# Dockerコンテナの管理クラス(ContainerInfoのasyncio版)
+class AsyncContainerInfo:
+    containerInfo: ContainerInfo
+
+    def __init__(self, containerInfo: ContainerInfo):
+        self.containerInfo = containerInfo
+
+    @property
+    def containerID(self) -> str:
+        return self.containerInfo.containerID
+
+    async def create(
+        self,
+        containerName: str,
+        arguments: list[str],
+        workDir: str = "/workdir/",
+        environment: dict[str, str] | None = None,
+        **hostConfigArgs,
+    ) -> Error:
+        client = get_async_client()
+        config = ContainerConfig(
+            DOCKER_API_VERSION,
+            containerName,
+            arguments,
+            working_dir=workDir,
+            environment=environment or None,
+            stdin_open=True,
+            labels=resource_labels(),
+            host_config=HostConfig(DOCKER_API_VERSION, **_host_config_args(**hostConfigArgs)),
+        )
+
+        try:
+            try:
+                result = await client.requestJSON("POST", "/containers/create", jsonBody=config)
+            except NotFound:
+                # docker createと同様に、イメージが無ければpullしてから再作成する
+                image, _, tag = containerName.partition(":")
+                await client.request(
+                    "POST", "/images/create", params={"fromImage": image, "tag": tag or "latest"}
+                )
+                result = await client.requestJSON("POST", "/containers/create", jsonBody=config)
+        except (DockerException, OSError) as e:
+            return Error(f"Failed to create container: {e}")
+
+        self.containerInfo.containerID = result["Id"]
+        test_logger.info(f"containerID: {self.containerID}")
+        return Error("")
+
+    async def remove(self) -> Error:
+        try:
+            await get_async_client().request(
+                "DELETE", f"/containers/{quote(self.containerID)}", params={"force": 1}
+            )
+        except (DockerException, OSError) as e:
+            return Error(f"Failed to remove container: {e}")
+        return Error("")
+
+    async def wait(self) -> int:
+        result = await get_async_client().requestJSON(
+            "POST", f"/containers/{quote(self.containerID)}/wait"
+        )
+        return result["StatusCode"]
+
+    async def startAndWait(self) -> tuple[int, str, Error]:
+        client = get_async_client()
+        try:
+            await client.request("POST", f"/containers/{quote(self.containerID)}/start")
+            exit_code = await self.wait()
+            stderr = await client.request(
+                "GET",
+                f"/containers/{quote(self.containerID)}/logs",
+                params={"stdout": 0, "stderr": 1},
+            )
+        except (DockerException, OSError) as e:
+            return -1, "", Error(f"Failed to run container: {e}")
+        # ログも多重化されているので、フレームのヘッダを取り除く
+        return exit_code, _demultiplex(stderr).decode("utf-8", errors="replace"), Error("")
+
+    async def extractArchive(self, archive: bytes, dstDirInContainer: Path) -> Error:
+        try:
+            await get_async_client().request(
+                "PUT",
+                f"/containers/{quote(self.containerID)}/archive",
+                params={"path": str(dstDirInContainer)},
+                body=archive,
+                headers={"Content-Type": "application/x-tar"},
+            )
+        except (DockerException, OSError) as e:
+            return Error(f"Failed to copy file: {e}")
+        return Error("")
+
+
+async def runTask(task: TaskInfo) -> tuple[TaskResult, Error]:
+    """
+    TaskInfo.run()のasyncio版。作成・attach・終了待ちの登録・起動をイベントループ上で行います。
+    """
+    if task.backendName() == "namespace":
+        # ns-sandboxの子プロセスの管理はスレッドで行う
+        return await asyncio.to_thread(runInNamespace, task)
+
+    client = get_async_client()
+    containerInfo = AsyncContainerInfo(ContainerInfo(""))
+
+    arguments, volumeMountInfo, tmpfs, extraFilesDir = task._containerSpec()
+    err = await containerInfo.create(
+        containerName=task.name,
+        arguments=arguments,
+        workDir=task.workDir,
+        environment=task.environment,
+        cpus=task.cpus,
+        memoryLimitMB=task.memoryLimitMB,
+        stackLimitKB=task.stackLimitKB,
+        pidsLimit=task.pidsLimit,
+        enableNetwork=task.enableNetwork,
+        enableLoggingDriver=task.enableLoggingDriver,
+        volumeMountInfo=volumeMountInfo,
+        tmpfs=tmpfs,
+        cpuTimeLimitSec=task.cpuTimeLimitSec(),
+        cpusetCpus=task.cpusetCpus,
+    )
+    if err.message != "":
+        return TaskResult(), err
+
+    archive, err = task._extraFilesArchive(extraFilesDir)
+    if err.message == "" and archive is not None:
+        err = await containerInfo.extractArchive(archive, Path("/"))
+    if err.message != "":
+        await containerInfo.remove()
+        return TaskResult(), err
+
+    task.taskMonitor.containerInfo = containerInfo.containerInfo
+    return await _start(task, containerInfo, client)
+
+
+# TaskInfo.__startと同じく、終了待ちを登録してから起動し、終了コードはそのレスポンスから受け取る。
+# コンテナは結果(cgroupの統計、OOM killの記録)を読み終えてからここで削除する。
+async def _start(
+    task: TaskInfo, containerInfo: AsyncContainerInfo, client: AsyncDockerClient
+) -> tuple[TaskResult, Error]:
+    containerPath = f"/containers/{quote(containerInfo.containerID)}"
+    try:
+        stream = await client.attach(containerInfo.containerID)
+    except (DockerException, OSError) as e:
+        await containerInfo.remove()
+        return TaskResult(), Error(f"Failed to attach container: {e}")
+
+    try:
+        waiter = await client.openWait(containerInfo.containerID, condition="next-exit")
+    except (DockerException, OSError) as e:
+        stream.close()
+        await containerInfo.remove()
+        return TaskResult(), Error(f"Failed to wait container: {e}")
+
+    try:
+        task.taskMonitor.start()
+        await client.request("POST", f"{containerPath}/start")
+        task.taskMonitor.attach()
+        stdout, stderr, timedOut, outputExceeded = await stream.communicate(
+            task.Stdin.encode("utf-8"),
+            deadline=time.monotonic() + task.wallTimeout(),
+            watchers=task.taskMonitor.watchers(),
+            outputLimitByte=task.outputLimitByte if task.outputLimitByte > 0 else None,
+        )
+    except (DockerException, OSError) as e:
+        task.taskMonitor.end()
+        waiter.close()
+        await containerInfo.remove()
+        return TaskResult(), Error(f"Failed to start container: {e}")
+    except asyncio.CancelledError:
+        # ジャッジが中断された場合も、実行中のコンテナを残さない
+        task.taskMonitor.end()
+        waiter.close()
+        await asyncio.shield(containerInfo.remove())
+        raise
+    finally:
+        stream.close()
+
+    task.taskMonitor.end()
+    result = task._result(stdout, stderr, timedOut, outputExceeded)
+
+    if timedOut or outputExceeded:
+        # まだ実行中なので、停止させる。
+        test_logger.info(f"kill container: {containerInfo.containerID}")
+        try:
+            await client.request("POST", f"{containerPath}/kill")
+        except (DockerException, OSError):
+            # 止める前に終了していた
+            pass
+
+    try:
+        result.exitCode = await waiter.result()
+        if not task.taskMonitor.is_attached():
+            # 起動直後に終了してcgroupを読めなかった場合は、DockerがOOM killを記録しているかで判定する
+            try:
+                state = (await client.requestJSON("GET", f"{containerPath}/json"))["State"]
+                result.MLE = result.MLE or bool(state.get("OOMKilled", False))
+            except (DockerException, OSError, ValueError, KeyError) as e:
+                test_logger.info(f"Failed to inspect OOMKilled: {e}")
+    except (DockerException, OSError, ValueError, KeyError) as e:
+        return result, Error(f"Failed to inspect exit code: {e}")
+    finally:
+        # ジャッジが中断された場合も、終了したコンテナを残さない
+        await asyncio.shield(containerInfo.remove())
+
+    return result, Error("")
+
+
+# 多重化されたストリーム(ヘッダ付きのフレームの列)から中身だけを取り出す
+def _demultiplex(data: bytes) -> bytes:
+    out = bytearray()
+    offset = 0
+    while offset + _FRAME_HEADER.size <= len(data):
+        _, size = _FRAME_HEADER.unpack_from(data, offset)
+        offset += _FRAME_HEADER.size
+        out += data[offset : offset + size]
+        offset += size
+    return bytes(out)
@@ -0,0 +1,183 @@
+"""
+このプログラムでは、以下のような機能を実装する。
+* 1つのコンテナ内で実行するテストケースの情報BatchCase
+* 複数のテストケースを1つのコンテナで順番に実行するタスクBatchTaskInfo
+
+コンテナ内のjudge-harness(langs/judge-harness.c)にテストケースのマニフェストを標準入力で渡し、
+テストケースごとに独立した子プロセスで実行させる。結果はテストケースごとに1行ずつ返ってくるので、
+それをTaskInfo.run()と同じ形式のTaskResultに変換する。
+作業ディレクトリはテストケースごとに最初の内容に戻されるが、メモリのcgroupは全てのテストケースで共有するので、
+最大メモリ使用量はcgroupのmemory.peakではなく子プロセスのru_maxrssになる。
+"""
+
+import base64
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from .my_error import Error
+from .async_execute import runTask
+from .execute import (
+    DEFAULT_OUTPUT_LIMIT_BYTE,
+    TaskInfo,
+    TaskResult,
+    Volume,
+    VolumeMountInfo,
+)
+
+# コンテナイメージ内のハーネスのパス
+HARNESS_PATH = "/usr/local/bin/judge-harness"
+
+# ハーネス自体の起動・結果の出力にかかる時間の余裕
+_HARNESS_OVERHEAD_SEC = 5.0
+
+# 結果の1行のうち、標準出力・標準エラー出力以外の部分の大きさの上限
+_RESULT_LINE_OVERHEAD_BYTE = 128
+
+
+@dataclass
+class BatchCase:
+    arguments: list[str]  # 実行するコマンド
+    Stdin: str = ""  # 標準入力
+    timeoutSec: float = 0.0  # タイムアウト時間(CPU時間)
+    outputLimitByte: int = DEFAULT_OUTPUT_LIMIT_BYTE  # 標準出力・標準エラー出力の合計の上限(0なら無制限)
+
+
+# 複数のテストケースをまとめて実行するタスク
+@dataclass
+class BatchTaskInfo:
+    name: str  # コンテナイメージ名
+    cases: list[BatchCase] = field(default_factory=list)
+    cpus: int = 0  # CPUの割り当て数
+    cpusetCpus: str = ""  # 実行に使うコア(e.g., "0,1")。空なら指定しない
+    memoryLimitMB: int = 0  # メモリ制限
+    stackLimitKB: int = 0  # リカージョンの深さを制限
+    pidsLimit: int = 0  # プロセス数の制限
+    enableNetwork: bool = False
+    workDir: str = "/workdir/"  # コンテナ内での作業ディレクトリ
+    volumeMountInfo: list[VolumeMountInfo] = field(default_factory=list)
+    extraFiles: list[tuple[Path, Path]] = field(default_factory=list)
+    tmpfsWorkDirMB: int = 0
+    tmpfsSeedVolume: Volume | None = None
+
+    def run(self) -> tuple[list[TaskResult], Error]:
+        result, err = self.__task().run()
+        if not err.silence():
+            return [], err
+        return self.__results(result)
+
+    # run()のasyncio版
+    async def runAsync(self) -> tuple[list[TaskResult], Error]:
+        result, err = await runTask(self.__task())
+        if not err.silence():
+            return [], err
+        return self.__results(result)
+
+    # ハーネスを実行するタスク
+    def __task(self) -> TaskInfo:
+        return TaskInfo(
+            name=self.name,
+            arguments=[HARNESS_PATH],
+            timeoutSec=self.__total_timeout_sec(),
+            outputLimitByte=self.__total_output_limit_byte(),
+            cpus=self.cpus,
+            cpusetCpus=self.cpusetCpus,
+            memoryLimitMB=self.memoryLimitMB,
+            stackLimitKB=self.stackLimitKB,
+            pidsLimit=self.pidsLimit,
+            enableNetwork=self.enableNetwork,
+            workDir=self.workDir,
+            volumeMountInfo=self.volumeMountInfo,
+            extraFiles=self.extraFiles,
+            tmpfsWorkDirMB=self.tmpfsWorkDirMB,
+            tmpfsSeedVolume=self.tmpfsSeedVolume,
+            Stdin=self.__manifest(),
+        )
+
+    # ハーネスの実行結果を、テストケースごとの結果に変換する
+    def __results(self, result: TaskResult) -> tuple[list[TaskResult], Error]:
+        lines = result.stdout.splitlines()
+        if (
+            result.TLE
+            or result.OLE
+            or result.exitCode != 0
+            or len(lines) != len(self.cases)
+        ):
+            return [], Error(
+                f"judge-harness failed (exit code: {result.exitCode}): {result.stderr}"
+            )
+
+        results = []
+        for case, line in zip(self.cases, lines):
+            caseResult, err = self.__parse_result(case, line)
+            if not err.silence():
+                return [], err
+            results.append(caseResult)
+        return results, Error.Nothing()
+
+    # テストケースごとの制限時間に余裕を持たせたものの合計
+    def __total_timeout_sec(self) -> float:
+        return (
+            sum(self.__task_of(case).wallTimeout() for case in self.cases)
+            + _HARNESS_OVERHEAD_SEC
+        )
+
+    # ハーネスの出力(base64でエンコードされた各テストケースの出力)の上限
+    def __total_output_limit_byte(self) -> int:
+        if any(case.outputLimitByte <= 0 for case in self.cases):
+            return 0
+        return sum(
+            (case.outputLimitByte + 2) // 3 * 4 + _RESULT_LINE_OVERHEAD_BYTE
+            for case in self.cases
+        )
+
+    # 制限時間の扱いはTaskInfoと同じにする(実時間の制限で強制終了、TLEはCPU時間で判定)
+    @staticmethod
+    def __task_of(case: BatchCase) -> TaskInfo:
+        return TaskInfo(name="", arguments=case.arguments, timeoutSec=case.timeoutSec)
+
+    def __manifest(self) -> str:
+        def field_of(text: str) -> str:
+            # 長さはUTF-8でエンコードしたバイト数(TaskInfoは標準入力をUTF-8で渡す)
+            return f"{len(text.encode('utf-8'))}\n{text}"
+
+        manifest = [f"{len(self.cases)}\n"]
+        for case in self.cases:
+            task = self.__task_of(case)
+            timeoutMS = int(task.wallTimeout() * 1000)
+            cpuLimitSec = max(task.cpuTimeLimitSec(), 0)
+            outputLimitByte = max(case.outputLimitByte, 0)
+            manifest.append(
+                f"{timeoutMS} {cpuLimitSec} {outputLimitByte} {len(case.arguments)}\n"
+            )
+            manifest += [field_of(argument) for argument in case.arguments]
+            manifest.append(field_of(case.Stdin))
+        return "".join(manifest)
+
+    @classmethod
+    def __parse_result(cls, case: BatchCase, line: str) -> tuple[TaskResult, Error]:
+        # <終了コード> <TLE> <OLE> <MLE> <実行時間[ms]> <CPU時間[ms]> <最大メモリ使用量[KB]> <標準出力> <標準エラー出力>
+        try:
+            exitCode, killed, outputExceeded, oomKilled, timeMS, cpuTimeMS, memoryKB, stdout, stderr = (
+                line.split(" ")
+            )
+
+            def decode(encoded: str) -> str:
+                if encoded == "-":
+                    return ""
+                return base64.b64decode(encoded).decode("utf-8", errors="replace")
+
+            result = TaskResult(
+                exitCode=int(exitCode),
+                stdout=decode(stdout),
+                stderr=decode(stderr),
+                timeMS=int(timeMS),
+                memoryByte=int(memoryKB) * 1024,
+                TLE=killed == "1"
+                or cls.__task_of(case).isTLE(int(cpuTimeMS), int(timeMS)),
+                MLE=oomKilled == "1",
+                cpuTimeMS=int(cpuTimeMS),
+                OLE=outputExceeded == "1",
+            )
+        except ValueError as e:
+            return TaskResult(), Error(f"broken judge-harness output: {e}")
+        return result, Error.Nothing()
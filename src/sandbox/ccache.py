@@ -0,0 +1,109 @@
+"""
+このプログラムでは、コンパイル用コンテナで共有するコンパイラキャッシュ(ccache)を実装する。
+* キャッシュを置くDockerボリュームを用意する関数ccacheVolume
+* コンパイルのタスクにキャッシュのボリュームと環境変数を設定する関数withCcache
+* キャッシュのヒット率等の統計情報を取得する関数ccacheStats
+
+checker-lang-gccイメージではgcc, g++, ccがccache経由で呼ばれる(langs/Dockerfile.GCC)。
+キャッシュはジャッジをまたいで残るので、問題ごとに配置されるソースコード等は初回以降コンパイルされない。
+"""
+
+import os
+import threading
+
+from docker.errors import DockerException
+from dotenv import load_dotenv
+
+from .my_error import Error
+from .docker_client import get_client
+from .execute import TaskInfo, Volume, VolumeMountInfo
+
+load_dotenv()
+
+# キャッシュを置くボリューム名。空ならccacheを使わない
+CCACHE_VOLUME = os.getenv("SANDBOX_CCACHE_VOLUME", "dsa-judge-ccache")
+# キャッシュの大きさの上限(ccacheのmax_sizeと同じ形式。e.g., "5G")
+CCACHE_MAX_SIZE = os.getenv("SANDBOX_CCACHE_MAX_SIZE", "5G")
+# コンテナ内でのキャッシュのパス
+CCACHE_MOUNT_PATH = "/ccache"
+
+_volume: Volume | None = None
+_volume_lock = threading.Lock()
+
+
+def ccacheEnabled() -> bool:
+    return CCACHE_VOLUME != ""
+
+
+def ccacheVolume() -> tuple[Volume, Error]:
+    """
+    キャッシュを置くボリュームを返します。無ければ作成します。
+    このボリュームはジャッジに属さないので、ラベルを付けない(reaperの削除対象にしない)。
+    """
+    global _volume
+    with _volume_lock:
+        if _volume is not None:
+            return _volume, Error("")
+        try:
+            # 同じ名前のボリュームが既にあれば、それがそのまま返ってくる
+            get_client().create_volume(name=CCACHE_VOLUME)
+        except DockerException as e:
+            return Volume(""), Error(f"Failed to create ccache volume: {e}")
+        _volume = Volume(CCACHE_VOLUME)
+        return _volume, Error("")
+
+
+def ccacheEnvironment() -> dict[str, str]:
+    return {
+        "CCACHE_DIR": CCACHE_MOUNT_PATH,
+        "CCACHE_MAXSIZE": CCACHE_MAX_SIZE,
+        # 作業ディレクトリ以下のパスを相対パスとして扱い、デバッグ情報のディレクトリもキーに含めない
+        # (作業ディレクトリの場所が変わってもキャッシュが当たるようにする)
+        "CCACHE_BASEDIR": "/workdir",
+        "CCACHE_NOHASHDIR": "true",
+        # イメージによって実行ユーザが違っても、同じキャッシュを読み書きできるようにする
+        "CCACHE_UMASK": "000",
+    }
+
+
+def withCcache(task: TaskInfo) -> Error:
+    """
+    タスクにキャッシュのボリュームと環境変数を設定します。ccacheを使わない場合は何もしません。
+    """
+    if not ccacheEnabled():
+        return Error("")
+    volume, err = ccacheVolume()
+    if err.message != "":
+        return err
+    task.volumeMountInfo = task.volumeMountInfo + [
+        VolumeMountInfo(path=CCACHE_MOUNT_PATH, volume=volume)
+    ]
+    task.environment = {**task.environment, **ccacheEnvironment()}
+    return Error("")
+
+
+def ccacheStats(containerName: str = "checker-lang-gcc") -> tuple[dict[str, int], Error]:
+    """
+    キャッシュの統計情報(ccache --print-statsの出力)を返します。
+    e.g., {"direct_cache_hit": 120, "cache_miss": 30, "cache_size_kibibyte": 51200, ...}
+    """
+    if not ccacheEnabled():
+        return {}, Error("ccache is disabled")
+
+    task = TaskInfo(name=containerName, arguments=["ccache", "--print-stats"], timeoutSec=5.0)
+    err = withCcache(task)
+    if err.message != "":
+        return {}, err
+    result, err = task.run()
+    if err.message != "":
+        return {}, err
+    if result.exitCode != 0:
+        return {}, Error(f"ccache --print-stats failed: {result.stderr}")
+
+    # 1行に1つずつ、"<名前>\t<値>"の形式で出力される
+    stats: dict[str, int] = {}
+    for line in result.stdout.splitlines():
+        key, sep, value = line.partition("\t")
+        if sep and value.strip().isdigit():
+            stats[key] = int(value)
+    return stats, Error("")
@@ -0,0 +1,181 @@
+"""
+このプログラムでは、コンテナのcgroup v2から資源の使用量を読み取る機能を実装する。
+* コンテナIDからcgroupのディレクトリを求める関数container_cgroup_path
+* memory.peak, memory.events, cpu.statの値を保持するクラスCgroupStats
+* memory.events, cgroup.eventsの変更をinotifyで通知するクラスCgroupWatcher
+
+cgroupのイベントファイル(memory.events, cgroup.events)は値が変わるとIN_MODIFYが通知されるので、
+ポーリングせずにOOM killやプロセスの終了(populated 0)を検出できる。
+"""
+
+import ctypes
+import ctypes.util
+import os
+import struct
+from dataclasses import dataclass
+from pathlib import Path
+
+# ホストの/sys/fs/cgroupのマウント先(compose.yamlで/sys-hostにマウントしている)
+CGROUP_ROOT = Path(os.getenv("SANDBOX_CGROUP_ROOT", "/sys-host/fs/cgroup"))
+
+_IN_MODIFY = 0x00000002
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = os.O_CLOEXEC
+# struct inotify_event(wd, mask, cookie, len)
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+
+def container_cgroup_path(containerID: str) -> Path | None:
+    """
+    コンテナのcgroupのディレクトリを返します。
+    cgroupドライバがsystemdの場合とcgroupfsの場合の両方を探します。
+
+    Returns:
+        Path | None: cgroupのディレクトリ。コンテナが起動していなければNone
+    """
+    for path in [
+        CGROUP_ROOT / "system.slice" / f"docker-{containerID}.scope",
+        CGROUP_ROOT / "docker" / containerID,
+    ]:
+        if path.is_dir():
+            return path
+    return None
+
+
+@dataclass
+class CgroupStats:
+    memoryPeakByte: int = 0  # 最大メモリ使用量[Byte]
+    oomKill: int = 0  # OOM killerにkillされたプロセスの数
+    cpuUserUSec: int = 0  # ユーザ空間でのCPU時間[us]
+    cpuSystemUSec: int = 0  # カーネル空間でのCPU時間[us]
+
+
+# cgroupの統計ファイルを開いたままにしておき、必要な時に読み直す
+class CgroupStatsReader:
+    _memoryPeak: int | None  # memory.peak(無ければmemory.current)のファイルディスクリプタ
+    _memoryEvents: int | None
+    _cpuStat: int | None
+    stats: CgroupStats  # 最後に読めた値
+    peakResetFailed: bool  # memory.peakのリセットを求められたが、できなかったかどうか
+
+    def __init__(self, cgroupPath: Path, resetPeak: bool = False):
+        self.stats = CgroupStats()
+        self.peakResetFailed = False
+        self._memoryPeak = None
+        if resetPeak:
+            # Linux 6.12以降では、memory.peakに書き込むとこのファイルディスクリプタで読める値がリセットされる
+            self._memoryPeak = _open(cgroupPath / "memory.peak", os.O_RDWR)
+            if self._memoryPeak is not None:
+                try:
+                    os.write(self._memoryPeak, b"reset\n")
+                except OSError:
+                    os.close(self._memoryPeak)
+                    self._memoryPeak = None
+            self.peakResetFailed = self._memoryPeak is None
+        if self._memoryPeak is None:
+            # それより前のカーネルではmemory.peakは読み込み専用(0444)で、書き込み用には開けない
+            # その場合、読める値にはこれまでの実行での最大値が含まれる
+            self._memoryPeak = _open(cgroupPath / "memory.peak", os.O_RDONLY)
+        if self._memoryPeak is None:
+            self._memoryPeak = _open(cgroupPath / "memory.current", os.O_RDONLY)
+        self._memoryEvents = _open(cgroupPath / "memory.events", os.O_RDONLY)
+        self._cpuStat = _open(cgroupPath / "cpu.stat", os.O_RDONLY)
+        self.read()
+
+    def read(self) -> CgroupStats:
+        # cgroupが削除された後は読めないので、最後に読めた値を残しておく
+        memory = _read_int(self._memoryPeak)
+        if memory is not None:
+            self.stats.memoryPeakByte = max(self.stats.memoryPeakByte, memory)
+
+        events = _read_keyed(self._memoryEvents)
+        if "oom_kill" in events:
+            self.stats.oomKill = events["oom_kill"]
+
+        cpu = _read_keyed(self._cpuStat)
+        if "user_usec" in cpu:
+            self.stats.cpuUserUSec = cpu["user_usec"]
+        if "system_usec" in cpu:
+            self.stats.cpuSystemUSec = cpu["system_usec"]
+        return self.stats
+
+    def close(self) -> None:
+        for fd in [self._memoryPeak, self._memoryEvents, self._cpuStat]:
+            if fd is not None:
+                os.close(fd)
+        self._memoryPeak = self._memoryEvents = self._cpuStat = None
+
+
+# cgroupのイベントファイルの変更をinotifyで受け取る
+class CgroupWatcher:
+    _fd: int
+
+    def __init__(self, cgroupPath: Path):
+        self._fd = _libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        for name in ["memory.events", "cgroup.events"]:
+            # 監視できなくても、終了時に読み直すので致命的ではない
+            _libc.inotify_add_watch(
+                self._fd, str(cgroupPath / name).encode(), _IN_MODIFY
+            )
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def drain(self) -> None:
+        # 溜まっているイベントを読み捨てる(内容に関わらず統計を読み直すため)
+        while True:
+            try:
+                if len(os.read(self._fd, 64 * _INOTIFY_EVENT.size)) == 0:
+                    return
+            except (BlockingIOError, OSError):
+                return
+
+    def close(self) -> None:
+        try:
+            os.close(self._fd)
+        except OSError:
+            pass
+
+
+def _open(path: Path, flags: int) -> int | None:
+    try:
+        return os.open(path, flags | os.O_CLOEXEC)
+    except OSError:
+        return None
+
+
+def _read(fd: int | None) -> str | None:
+    if fd is None:
+        return None
+    try:
+        return os.pread(fd, 4096, 0).decode()
+    except OSError:
+        return None
+
+
+def _read_int(fd: int | None) -> int | None:
+    text = _read(fd)
+    if text is None:
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        return None
+
+
+# "key value"形式の行からなるファイルを読む
+def _read_keyed(fd: int | None) -> dict[str, int]:
+    text = _read(fd)
+    if text is None:
+        return {}
+    values = {}
+    for line in text.splitlines():
+        key, _, value = line.partition(" ")
+        if value.isdigit():
+            values[key] = int(value)
+    return values
@@ -0,0 +1,202 @@
+"""
+このプログラムでは、コンパイル結果のキャッシュを実装する。
+* コンパイルの入力からキャッシュのキーを計算する関数compileCacheKey
+* コンパイル後の作業ディレクトリをtarアーカイブとして保存・復元するクラスCompileCache
+
+キーは提出ファイル・配置ファイル・ビルドスクリプトの内容と、コンパイラのイメージのIDから計算する。
+同じ入力の再提出や再ジャッジでは、コンパイル用のコンテナを起動せずに保存したアーカイブを展開する。
+保存したアーカイブの合計が上限を超えたら、最後に使われてから長いものから削除する(LRU)。
+"""
+
+import hashlib
+import io
+import os
+import tarfile
+import threading
+import uuid
+from pathlib import Path
+
+from docker.errors import DockerException
+from dotenv import load_dotenv
+
+from .my_error import Error
+from .docker_client import get_client
+from .execute import Volume, test_logger
+
+load_dotenv()
+
+_CHUNK_SIZE = 64 * 1024
+
+
+def imageID(image: str) -> tuple[str, Error]:
+    # タグが同じでもイメージを作り直したらキーが変わるように、タグではなくIDを使う
+    try:
+        return get_client().inspect_image(image)["Id"], Error("")
+    except DockerException as e:
+        return "", Error(f"Failed to inspect image: {e}")
+
+
+def compileCacheKey(
+    image: str,
+    inputFiles: list[Path],
+    buildScript: Path | None = None,
+    kind: str = "compile",
+) -> tuple[str, Error]:
+    """
+    コンパイルの入力からキャッシュのキー(sha256の16進数表記)を計算します。
+    inputFilesは作業ディレクトリの直下にファイル名でコピーされるので、ファイル名も含めます。
+    kindは保存するものの種類で、入力が同じでも種類が違えば別のキーになります。
+    """
+    image_id, err = imageID(image)
+    if err.message != "":
+        return "", err
+
+    digest = hashlib.sha256()
+
+    def update(label: str, path: Path) -> None:
+        digest.update(f"{label}\0{path.name}\0".encode("utf-8"))
+        with open(path, mode="rb") as f:
+            while chunk := f.read(_CHUNK_SIZE):
+                digest.update(hashlib.sha256(chunk).digest())
+        digest.update(b"\0")
+
+    try:
+        digest.update(f"kind\0{kind}\0image\0{image_id}\0".encode("utf-8"))
+        if buildScript is not None:
+            update("build-script", buildScript)
+        # 同じファイルの集合なら、渡された順番に関わらず同じキーになるようにする
+        for path in sorted(inputFiles, key=lambda path: path.name):
+            update("input", path)
+    except OSError as e:
+        return "", Error(f"Failed to read compile inputs: {e}")
+
+    return digest.hexdigest(), Error("")
+
+
+# アーカイブ内のパスの先頭の"workdir/"を取り除き、作業ディレクトリ直下に展開できる形にする
+# keepを指定した場合は、その名前(作業ディレクトリからの相対パス)のものだけを残す
+def _strip_top_directory(archive: bytes, keep: set[str] | None = None) -> bytes:
+    output = io.BytesIO()
+    with tarfile.open(fileobj=io.BytesIO(archive)) as src, tarfile.open(
+        fileobj=output, mode="w"
+    ) as dst:
+        for member in src:
+            _, sep, rest = member.name.partition("/")
+            if not sep or rest == "":
+                continue
+            if keep is not None and rest not in keep:
+                continue
+            member.name = rest
+            dst.addfile(member, src.extractfile(member) if member.isfile() else None)
+    return output.getvalue()
+
+
+class CompileCache:
+    directory: Path  # アーカイブを保存するディレクトリ
+    maxBytes: int  # 保存するアーカイブの合計の上限(0なら無効)
+    _lock: threading.Lock
+
+    def __init__(self, directory: Path, maxBytes: int):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "CompileCache":
+        return cls(
+            Path(os.getenv("SANDBOX_COMPILE_CACHE_DIR", "/var/lib/dsa-judge/compile-cache")),
+            maxBytes=int(os.getenv("SANDBOX_COMPILE_CACHE_MAX_MB", "1024")) * 1024 * 1024,
+        )
+
+    def enabled(self) -> bool:
+        return self.maxBytes > 0
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.tar"
+
+    def lookup(self, key: str) -> bytes | None:
+        """
+        キーに対応するアーカイブを返します。無ければNoneを返します。
+        """
+        path = self._path(key)
+        try:
+            with open(path, mode="rb") as f:
+                archive = f.read()
+            # 最後に使われた時刻として更新時刻を使う
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            test_logger.info(f"failed to read compile cache {path}: {e}")
+            return None
+        return archive
+
+    def store(self, key: str, archive: bytes) -> Error:
+        path = self._path(key)
+        # 書き込み途中のファイルを読まないように、別名で書いてから置き換える
+        tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            with open(tmp, mode="wb") as f:
+                f.write(archive)
+            os.replace(tmp, path)
+        except OSError as e:
+            tmp.unlink(missing_ok=True)
+            return Error(f"Failed to store compile cache: {e}")
+
+        self.evict()
+        return Error("")
+
+    def evict(self) -> None:
+        # 合計がmaxBytes以下になるまで、最後に使われた時刻が古いものから削除する
+        with self._lock:
+            try:
+                entries = []
+                for path in self.directory.glob("*.tar"):
+                    stat = path.stat()
+                    entries.append((stat.st_mtime, stat.st_size, path))
+            except OSError as e:
+                test_logger.info(f"failed to list compile cache: {e}")
+                return
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+                if total <= self.maxBytes:
+                    break
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    test_logger.info(f"failed to evict compile cache {path}: {e}")
+                    continue
+                total -= size
+
+    def save(self, key: str, volume: Volume) -> Error:
+        """
+        コンパイル後のボリュームの内容を保存します。
+        """
+        archive, err = volume.archive("/workdir/")
+        if err.message != "":
+            return err
+        try:
+            archive = _strip_top_directory(archive)
+        except tarfile.TarError as e:
+            return Error(f"Failed to read volume archive: {e}")
+        return self.store(key, archive)
+
+    def restore(self, key: str, volume: Volume) -> bool:
+        """
+        キーに対応するアーカイブがあれば、ボリュームに展開してTrueを返します。
+        """
+        archive = self.lookup(key)
+        if archive is None:
+            return False
+        err = volume.extractArchive(archive)
+        if err.message != "":
+            test_logger.info(f"failed to restore compile cache: {err.message}")
+            return False
+        return True
+
+
+compile_cache = CompileCache.from_env()
@@ -0,0 +1,168 @@
+"""
+このプログラムでは、ジャッジにCPUコアを専有させるためのコア割り当てを実装する。
+* CPUリスト("0-3,6"のような形式)を解釈する関数parse_cpu_list
+* ジャッジごとにコアを割り当て、空きが無ければ待たせるクラスCpusetAllocator
+
+割り当てたコアはTaskInfo.cpusetCpusとしてコンテナのcpusetに設定する。
+同時に実行するジャッジが同じコアを取り合わないので、実行時間の計測が安定する。
+"""
+
+import asyncio
+import os
+import threading
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def parse_cpu_list(text: str) -> list[int]:
+    """
+    "0-3,6"のようなCPUリスト(cpuset.cpusと同じ形式)を、コア番号のリストに変換します。
+    """
+    cores: list[int] = []
+    for part in text.split(","):
+        part = part.strip()
+        if part == "":
+            continue
+        first, sep, last = part.partition("-")
+        if sep:
+            cores.extend(range(int(first), int(last) + 1))
+        else:
+            cores.append(int(first))
+    return sorted(set(cores))
+
+
+def format_cpu_list(cores: list[int]) -> str:
+    return ",".join(str(core) for core in sorted(cores))
+
+
+# コアの割り当てを待っているジャッジ
+class _Waiter:
+    cores: list[int] | None
+    _wake: Callable[[], None]
+
+    def __init__(self, wake: Callable[[], None]):
+        self.cores = None
+        self._wake = wake
+
+    def grant(self, cores: list[int]) -> None:
+        self.cores = cores
+        self._wake()
+
+
+# ジャッジごとにcoresPerJob個のコアを割り当てる(空きが無ければ先に待っていたものから順に割り当てる)
+class CpusetAllocator:
+    cores: list[int]  # 割り当てに使うコア
+    coresPerJob: int  # 1つのジャッジに割り当てるコア数
+    _free: list[int]
+    _waiters: deque[_Waiter]
+    _lock: threading.Lock
+
+    def __init__(self, cores: list[int], coresPerJob: int = 1):
+        self.cores = list(cores)
+        self.coresPerJob = max(coresPerJob, 1)
+        self._free = list(cores)
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "CpusetAllocator":
+        # SANDBOX_CPUSETが空なら無効(コアを割り当てない)
+        return cls(
+            parse_cpu_list(os.getenv("SANDBOX_CPUSET", "")),
+            coresPerJob=int(os.getenv("SANDBOX_CPUS_PER_JOB", "1")),
+        )
+
+    def enabled(self) -> bool:
+        return self.capacity() > 0
+
+    def capacity(self) -> int:
+        # 同時に割り当てられるジャッジの数
+        return len(self.cores) // self.coresPerJob
+
+    def acquire(self) -> list[int]:
+        """
+        コアを割り当てます。空きが無ければ、他のジャッジが解放するまで待ちます。
+        """
+        event = threading.Event()
+        waiter = self.__enqueue(event.set)
+        if waiter.cores is None:
+            event.wait()
+        return waiter.cores
+
+    async def acquireAsync(self) -> list[int]:
+        # acquire()のasyncio版(待っている間もイベントループを止めない)
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[None] = loop.create_future()
+
+        def wake() -> None:
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = self.__enqueue(wake)
+        if waiter.cores is None:
+            try:
+                await future
+            except asyncio.CancelledError:
+                self.__cancel(waiter)
+                raise
+        return waiter.cores
+
+    def release(self, cores: list[int]) -> None:
+        with self._lock:
+            self._free.extend(cores)
+            self.__grant_waiters()
+
+    @contextmanager
+    def allocated(self):
+        """
+        ブロック内で使うコアを割り当て、"0,1"のような文字列で返します。無効なら空文字列を返します。
+        """
+        if not self.enabled():
+            yield ""
+            return
+        cores = self.acquire()
+        try:
+            yield format_cpu_list(cores)
+        finally:
+            self.release(cores)
+
+    @asynccontextmanager
+    async def allocatedAsync(self):
+        if not self.enabled():
+            yield ""
+            return
+        cores = await self.acquireAsync()
+        try:
+            yield format_cpu_list(cores)
+        finally:
+            self.release(cores)
+
+    def __enqueue(self, wake: Callable[[], None]) -> _Waiter:
+        waiter = _Waiter(wake)
+        with self._lock:
+            self._waiters.append(waiter)
+            self.__grant_waiters()
+        return waiter
+
+    def __cancel(self, waiter: _Waiter) -> None:
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                return
+        # 待っている間に割り当てられていた場合は返す
+        if waiter.cores is not None:
+            self.release(waiter.cores)
+
+    def __grant_waiters(self) -> None:
+        # self._lockを取った状態で呼ぶ
+        while self._waiters and len(self._free) >= self.coresPerJob:
+            self._free.sort()
+            cores, self._free = self._free[: self.coresPerJob], self._free[self.coresPerJob :]
+            self._waiters.popleft().grant(cores)
+
+
+cpuset_allocator = CpusetAllocator.from_env()
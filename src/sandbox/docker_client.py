@@ -0,0 +1,226 @@
+"""
+このプログラムでは、Docker Engine APIとの通信部分を実装する。
+* UNIXソケット(/var/run/docker.sock)に直接HTTPで接続するクライアントget_client
+  (接続はkeep-aliveでプールされ、全スレッドで共有される)
+* コンテナにattachして標準入出力をやり取りするクラスAttachedStream
+* コンテナの起動前に終了待ちを登録し、終了コードを受け取るクラスExitWaiter
+
+dockerコマンドを使うと、操作ごとにCLIプロセスの起動と初期化(数十ms)が発生するため、
+sandboxの各操作はこのクライアントを経由してDockerデーモンと直接通信する。
+"""
+
+import os
+import selectors
+import socket
+import struct
+import threading
+import time
+import logging
+from typing import Callable
+
+import docker
+from docker.utils import kwargs_from_env
+
+# ロガーの設定
+logging.basicConfig(level=logging.INFO)
+test_logger = logging.getLogger("uvicorn")
+
+DEFAULT_DOCKER_HOST = "unix:///var/run/docker.sock"
+
+# コネクションプールの大きさ(WorkerPoolのスレッド数より大きくしておく)
+DOCKER_MAX_POOL_SIZE = int(os.getenv("DOCKER_MAX_POOL_SIZE", "64"))
+
+# attach時に一度に読み書きするバイト数
+_CHUNK_SIZE = 64 * 1024
+
+# attachストリームのフレームヘッダ(stream種別: 1byte, padding: 3byte, サイズ: 4byte)
+_FRAME_HEADER = struct.Struct(">BxxxL")
+_STREAM_STDOUT = 1
+_STREAM_STDERR = 2
+
+_client: docker.APIClient | None = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> docker.APIClient:
+    """
+    プロセス全体で共有するDocker Engine APIクライアントを返します。
+    接続先はDOCKER_HOST環境変数で指定され、未指定ならunix:///var/run/docker.sockになります。
+
+    Returns:
+        docker.APIClient: keep-alive接続をプールしているAPIクライアント
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                kwargs = kwargs_from_env()
+                kwargs.setdefault("base_url", DEFAULT_DOCKER_HOST)
+                _client = docker.APIClient(
+                    version="auto", max_pool_size=DOCKER_MAX_POOL_SIZE, **kwargs
+                )
+    return _client
+
+
+# attachしたコンテナの標準入出力
+class AttachedStream:
+    _response_socket: object  # レスポンスを保持しておくためのソケットオブジェクト
+    _sock: socket.socket  # 実際に読み書きするソケット
+
+    def __init__(self, response_socket: object):
+        self._response_socket = response_socket
+        self._sock = getattr(response_socket, "_sock", response_socket)
+        self._sock.setblocking(False)
+
+    @classmethod
+    def open(cls, containerID: str) -> "AttachedStream":
+        # コンテナを起動する前にattachしておくことで、出力を取りこぼさないようにする
+        sock = get_client().attach_socket(
+            containerID,
+            params={"stdin": 1, "stdout": 1, "stderr": 1, "stream": 1},
+        )
+        return cls(sock)
+
+    def communicate(
+        self,
+        stdin: bytes,
+        deadline: float | None,
+        watchers: list[tuple[int, Callable[[], None]]] | None = None,
+        outputLimitByte: int | None = None,
+    ) -> tuple[bytes, bytes, bool, bool]:
+        """
+        標準入力を書き込みながら、標準出力・標準エラー出力をEOFまで読み込みます。
+
+        Args:
+            stdin: コンテナに渡す標準入力
+            deadline: time.monotonic()基準の締め切り時刻。Noneなら無制限
+            watchers: 読み込み可能になった時に呼び出すコールバックと、そのファイルディスクリプタ
+            outputLimitByte: 標準出力・標準エラー出力の合計の上限。超えたらそこで読み込みをやめる
+
+        Returns:
+            tuple[bytes, bytes, bool, bool]: 標準出力、標準エラー出力、締め切りを過ぎたかどうか、
+            出力の上限を超えたかどうか(超えた場合、出力は上限までの先頭部分になる)
+        """
+        stdout = bytearray()
+        stderr = bytearray()
+        buffer = bytearray()
+        pending = memoryview(stdin)
+
+        selector = selectors.DefaultSelector()
+        selector.register(self._sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        for fd, callback in watchers or []:
+            selector.register(fd, selectors.EVENT_READ, callback)
+        writing = True
+        if len(pending) == 0:
+            writing = self.__close_stdin(selector)
+
+        try:
+            while True:
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        return bytes(stdout), bytes(stderr), True, False
+
+                for key, events in selector.select(timeout):
+                    if key.data is not None:
+                        key.data()
+                        continue
+
+                    if writing and events & selectors.EVENT_WRITE:
+                        try:
+                            sent = self._sock.send(pending[:_CHUNK_SIZE])
+                            pending = pending[sent:]
+                        except BrokenPipeError:
+                            # プログラムが標準入力を読まずに終了した
+                            pending = pending[:0]
+                        except BlockingIOError:
+                            pass
+                        if len(pending) == 0:
+                            writing = self.__close_stdin(selector)
+
+                    if events & selectors.EVENT_READ:
+                        try:
+                            chunk = self._sock.recv(_CHUNK_SIZE)
+                        except BlockingIOError:
+                            continue
+                        except ConnectionResetError:
+                            chunk = b""
+                        if not chunk:
+                            # コンテナが終了した
+                            return bytes(stdout), bytes(stderr), False, False
+                        buffer += chunk
+                        self.__demultiplex(buffer, stdout, stderr)
+                        if (
+                            outputLimitByte is not None
+                            and len(stdout) + len(stderr) > outputLimitByte
+                        ):
+                            # 無限に出力し続けるプログラムをメモリに溜め込まないように、ここで打ち切る
+                            del stdout[outputLimitByte:]
+                            del stderr[max(outputLimitByte - len(stdout), 0) :]
+                            return bytes(stdout), bytes(stderr), False, True
+        finally:
+            selector.close()
+
+    def close(self) -> None:
+        try:
+            self._sock.close()
+        except OSError:
+            pass
+
+    def __close_stdin(self, selector: selectors.BaseSelector) -> bool:
+        # 書き込み側だけ閉じてEOFを伝える(コンテナはStdinOnceで作成されている)
+        try:
+            self._sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        selector.modify(self._sock, selectors.EVENT_READ)
+        return False
+
+    @staticmethod
+    def __demultiplex(buffer: bytearray, stdout: bytearray, stderr: bytearray) -> None:
+        # 受信済みのデータから、完結しているフレームを全て取り出す
+        while len(buffer) >= _FRAME_HEADER.size:
+            stream, size = _FRAME_HEADER.unpack_from(buffer)
+            end = _FRAME_HEADER.size + size
+            if len(buffer) < end:
+                return
+            if stream == _STREAM_STDOUT:
+                stdout += buffer[_FRAME_HEADER.size : end]
+            elif stream == _STREAM_STDERR:
+                stderr += buffer[_FRAME_HEADER.size : end]
+            del buffer[:end]
+
+
+# コンテナの終了待ち(POST /containers/{id}/wait)
+# デーモンは待ちを登録した時点でレスポンスヘッダを返し、終了した時にボディ(StatusCode)を返す。
+# 起動前にヘッダまで受け取っておけば、すぐに終了するコンテナでも終了コードを取りこぼさない。
+class ExitWaiter:
+    _response: object  # ボディを読み終えていないレスポンス
+
+    def __init__(self, response: object):
+        self._response = response
+
+    @classmethod
+    def open(cls, containerID: str, condition: str = "next-exit") -> "ExitWaiter":
+        client = get_client()
+        response = client._post(
+            client._url("/containers/{0}/wait", containerID),
+            params={"condition": condition},
+            timeout=None,
+            stream=True,
+        )
+        client._raise_for_status(response)
+        return cls(response)
+
+    def result(self) -> int:
+        """
+        コンテナが終了するまで待ち、終了コードを返します。
+        """
+        try:
+            return int(self._response.json()["StatusCode"])
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        self._response.close()
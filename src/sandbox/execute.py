@@ -8,18 +8,26 @@
 
 # 外部定義モジュールのインポート
 import uuid
-import subprocess
-import threading
 from dataclasses import dataclass, field
 from dataclasses import replace
 import time  # 実行時間の計測に使用
-import re
+import math
+import io
+import os
+import tarfile
 from pathlib import Path
 from typing import Callable
 import logging
 
+from docker.errors import DockerException, ImageNotFound
+from docker.types import LogConfig, Ulimit
+from dotenv import load_dotenv
+
 # 内部定義モジュールのインポート
 from .my_error import Error
+from .docker_client import get_client, AttachedStream, ExitWaiter
+from .labels import resource_labels
+from .cgroup import CgroupStatsReader, CgroupWatcher, container_cgroup_path
 
 # ロガーの設定
 logging.basicConfig(level=logging.INFO)
@@ -29,24 +37,22 @@ test_logger = logging.getLogger("uvicorn")
 # Dockerボリュームの管理クラス
 class Volume:
     name: str  # ボリューム名
+    layers: list["Volume"]  # overlayボリュームの場合、上位層・作業用のボリューム
 
-    def __init__(self, name: str):
+    def __init__(self, name: str, layers: list["Volume"] | None = None):
         self.name = name
+        self.layers = layers if layers is not None else []
 
     @classmethod
     def create(cls) -> tuple["Volume", Error]:
         volumeName = "volume-" + str(uuid.uuid4())
 
-        args = ["volume", "create"]
-        args += ["--name", volumeName]
-
         # Dockerボリュームの作成
-        cmd = ["docker"] + args
         err = ""
 
         try:
-            subprocess.run(cmd, check=True)
-        except subprocess.CalledProcessError as e:
+            get_client().create_volume(name=volumeName, labels=resource_labels())
+        except DockerException as e:
             err = f"Failed to create volume: {e}"
 
         if err != "":
@@ -56,70 +62,77 @@ class Volume:
         return Volume(volumeName), Error("")
 
     def remove(self) -> Error:
-        args = ["volume", "rm", self.name]
-
-        cmd = ["docker"] + args
         err = ""
 
         try:
-            subprocess.run(cmd, check=True)
-        except subprocess.CalledProcessError as e:
+            get_client().remove_volume(self.name)
+        except DockerException as e:
             err = f"Failed to remove volume: {e}"
 
+        # overlayボリュームの場合、上位層・作業用のボリュームも削除する
+        for layer in self.layers:
+            layerErr = layer.remove()
+            if layerErr.message != "":
+                err += ("\n" if err != "" else "") + layerErr.message
+
         return Error(err)
 
     def copyFile(self, filePathFromClient: Path, filePathInVolume: Path) -> Error:
-        ci = ContainerInfo("")
-
-        err = ci.create(
-            containerName="ubuntu",
-            arguments=["echo", "Hello, World!"],
-            workDir="/workdir/",
-            volumeMountInfo=[VolumeMountInfo(path="/workdir/", volume=self)],
-        )
-        if err.message != "":
-            return err
-        
         # filePathInVolumeが絶対パスの場合、相対パスに変換
         if filePathInVolume.is_absolute():
             filePathInVolume = Path(".") / filePathInVolume.relative_to("/")
 
-        dstInContainer = Path("/workdir") / filePathInVolume
-        err = ci.copyFile(filePathFromClient, dstInContainer)
-
-        ci.remove()
-        return err
+        try:
+            archive = _make_tar_archive(
+                [(filePathFromClient, os.path.normpath(filePathInVolume))]
+            )
+        except OSError as e:
+            return Error(f"Failed to copy file: {e}")
+        return self.extractArchive(archive)
 
     def copyFiles(
         self, filePathsFromClient: list[Path], DirPathInVolume: Path = Path("./")
     ) -> Error:
-        ci = ContainerInfo("")
+        # DirPathInVolumeが絶対パスの場合、相対パスに変換
+        if DirPathInVolume.is_absolute():
+            DirPathInVolume = Path(".") / DirPathInVolume.relative_to("/")
 
+        # 全てのファイルを1つのtarアーカイブにまとめ、1回の転送でボリュームに展開する
+        try:
+            archive = _make_tar_archive(
+                [
+                    (PathInClient, os.path.normpath(DirPathInVolume / PathInClient.name))
+                    for PathInClient in filePathsFromClient
+                ]
+            )
+        except OSError as e:
+            return Error(f"Failed to copy files: {e}")
+        return self.extractArchive(archive)
+
+    # tarアーカイブをボリューム内のDirPathInVolumeに展開する
+    def extractArchive(self, archive: bytes, DirPathInVolume: Path = Path("./")) -> Error:
+        # DirPathInVolumeが絶対パスの場合、相対パスに変換
+        if DirPathInVolume.is_absolute():
+            DirPathInVolume = Path(".") / DirPathInVolume.relative_to("/")
+
+        # アーカイブの展開先としてボリュームをマウントしたコンテナを作成する。
+        # Docker Engine APIではコンテナ経由でしかボリュームに書き込めないが、
+        # このコンテナは起動しないので、プロセスは一切実行されない。
+        ci = ContainerInfo("")
         err = ci.create(
             containerName="ubuntu",
-            arguments=["echo", "Hello, World!"],
+            arguments=["true"],
             workDir="/workdir/",
             volumeMountInfo=[VolumeMountInfo(path="/workdir/", volume=self)],
         )
-
         if err.message != "":
             return err
-        
-        # DirPathInVolumeが絶対パスの場合、相対パスに変換
-        if DirPathInVolume.is_absolute():
-            DirPathInVolume = Path(".") / DirPathInVolume.relative_to("/")
 
-        for PathInClient in filePathsFromClient:
-            dstInContainer = (
-                Path("/workdir") / DirPathInVolume / PathInClient.name
-            ).resolve()
-            err = ci.copyFile(PathInClient, str(dstInContainer))
-            if err.message != "":
-                ci.remove()
-                return err
+        dstInContainer = Path("/workdir") / DirPathInVolume
+        err = ci.extractArchive(archive, dstInContainer)
 
         ci.remove()
-        return Error("")
+        return err
 
     def removeFiles(self, filePathsInVolume: list[Path]) -> Error:
         arguments = ["rm"]
@@ -142,26 +155,59 @@ class Volume:
         if err.message != "":
             return err
 
-        command = ["docker", "start", ci.containerID]
-
-        result = subprocess.run(command, capture_output=True, text=True, check=False)
-
-        err.message = result.stderr
-
-        if err.message != "":
-            return err
-
-        exit_code, err = inspectExitCode(ci.containerID)
+        exit_code, stderr, err = ci.startAndWait()
 
         if err.message != "":
+            ci.remove()
             return err
 
         if exit_code != 0:
-            return Error(f"Failed to remove files: {result.stderr}")
+            ci.remove()
+            return Error(f"Failed to remove files: {stderr}")
 
         ci.remove()
         return Error("")
     
+    # このボリュームを読み取り専用の下位層とし、書き込み可能な上位層を重ねた
+    # overlayボリュームを作成する。clone()と違って中身をコピーしないので、
+    # ボリュームの大きさに関わらず一定時間で作成できる。
+    # 注) 作成したボリュームを使っている間は、このボリュームを変更してはいけない
+    def snapshot(self) -> tuple["Volume", Error]:
+        client = get_client()
+
+        # 上位層とoverlayfsの作業ディレクトリには、空のボリュームのディレクトリを使う
+        upper, err = Volume.create()
+        if err.message != "":
+            return Volume(""), err
+        work, err = Volume.create()
+        if err.message != "":
+            upper.remove()
+            return Volume(""), err
+
+        volumeName = "volume-" + str(uuid.uuid4())
+        try:
+            lowerdir = client.inspect_volume(self.name)["Mountpoint"]
+            upperdir = client.inspect_volume(upper.name)["Mountpoint"]
+            workdir = client.inspect_volume(work.name)["Mountpoint"]
+            # localドライバのボリュームは、コンテナにマウントされる時にmountされる
+            client.create_volume(
+                name=volumeName,
+                driver="local",
+                driver_opts={
+                    "type": "overlay",
+                    "device": "overlay",
+                    "o": f"lowerdir={lowerdir},upperdir={upperdir},workdir={workdir}",
+                },
+                labels=resource_labels(),
+            )
+        except DockerException as e:
+            upper.remove()
+            work.remove()
+            return Volume(""), Error(f"Failed to create snapshot volume: {e}")
+
+        test_logger.info(f"volumeName: {volumeName} (snapshot of {self.name})")
+        return Volume(volumeName, layers=[upper, work]), Error("")
+
     def clone(self) -> tuple["Volume", Error]:
         # 新しいDockerボリュームを作成
         new_volume, err = Volume.create()
@@ -183,11 +229,11 @@ class Volume:
             return Volume(""), Error(f"コンテナの作成に失敗しました: {err.message}")
 
         # コンテナを起動してコピーを実行
-        command = ["docker", "start", "-a", ci.containerID]
-        result = subprocess.run(command, capture_output=True, text=True, check=False)
-        
-        if result.returncode != 0:
-            return Volume(""), Error(f"ボリュームのコピーに失敗しました: {result.stderr}")
+        exit_code, stderr, err = ci.startAndWait()
+
+        if err.message != "" or exit_code != 0:
+            ci.remove()
+            return Volume(""), Error(f"ボリュームのコピーに失敗しました: {err.message}{stderr}")
 
         # コンテナを削除
         ci.remove()
@@ -195,10 +241,36 @@ class Volume:
         return new_volume, Error("")
 
 
+    # ボリュームの内容をtarアーカイブとして取り出す
+    # アーカイブ内のパスは、mountPathの最後の要素(e.g., "workdir/...")から始まる
+    def archive(self, mountPath: str = "/workdir/") -> tuple[bytes, Error]:
+        ci = ContainerInfo("")
+        err = ci.create(
+            containerName="ubuntu",
+            arguments=["true"],
+            workDir="/",
+            volumeMountInfo=[VolumeMountInfo(path=mountPath, volume=self)],
+        )
+        if err.message != "":
+            return b"", err
+
+        # 起動していないコンテナからでも、マウントしたボリュームの内容を取り出せる
+        data = b""
+        try:
+            stream, _ = get_client().get_archive(ci.containerID, mountPath.rstrip("/"))
+            data = b"".join(stream)
+        except DockerException as e:
+            err = Error(f"Failed to archive volume: {e}")
+
+        ci.remove()
+        return data, err
+
+
 @dataclass
 class VolumeMountInfo:
     path: str  # コンテナ内のマウント先のパス
     volume: Volume  # マウントするボリュームの情報
+    readOnly: bool = False  # 読み取り専用でマウントするかどうか
 
 
 # Dockerコンテナの管理クラス
@@ -221,64 +293,52 @@ class ContainerInfo:
         enableLoggingDriver: bool = True,
         workDir: str = "/workdir/",
         volumeMountInfo: list[VolumeMountInfo] = None,
+        tmpfs: dict[str, str] | None = None,
+        cpuTimeLimitSec: int = -1,
+        cpusetCpus: str = "",
+        environment: dict[str, str] | None = None,
     ) -> Error:
-        # docker create ...
-        args = ["create"]
-
-        # enable interactive
-        args += ["-i"]
-
-        args += ["--init"]
-
-        # CPUの割り当て数
-        if cpus > 0:
-            args += [f"--cpus={cpus}"]
-
-        # メモリ制限
-        if memoryLimitMB > 0:
-            args += [f"--memory={memoryLimitMB}m"]
-            args += [f"--memory-swap={memoryLimitMB}m"]
-
-        # スタックサイズの制限
-        if stackLimitKB > 0:
-            args += ["--ulimit", f"stack={stackLimitKB}:{stackLimitKB}"]
-
-        # プロセス数の制限
-        if pidsLimit > 0:
-            args += ["--pids-limit", str(pidsLimit)]
-
-        # ネットワークの有効化
-        if not enableNetwork:
-            args += ["--network", "none"]
-
-        # ロギングドライバの有効化
-        if not enableLoggingDriver:
-            args += ["--log-driver", "none"]
-
-        # 作業ディレクトリ
-        args += ["--workdir", workDir]
-
-        for volumeMountInfo in volumeMountInfo:
-            args += ["-v", f"{volumeMountInfo.volume.name}:{volumeMountInfo.path}"]
-
-        # コンテナイメージ名
-        args += [containerName]
-
-        # コンテナ内で実行するコマンド
-        args += arguments
-
-        # Dockerコンテナの作成コマンド
-        cmd = ["docker"] + args
+        client = get_client()
+
+        hostConfigArgs = _host_config_args(
+            cpus=cpus,
+            memoryLimitMB=memoryLimitMB,
+            stackLimitKB=stackLimitKB,
+            pidsLimit=pidsLimit,
+            enableNetwork=enableNetwork,
+            enableLoggingDriver=enableLoggingDriver,
+            volumeMountInfo=volumeMountInfo,
+            tmpfs=tmpfs,
+            cpuTimeLimitSec=cpuTimeLimitSec,
+            cpusetCpus=cpusetCpus,
+        )
 
-        test_logger.info(f"docker create command: {cmd}")
+        test_logger.info(
+            f"create container: image={containerName}, arguments={arguments}, hostConfig={hostConfigArgs}"
+        )
 
         # Dockerコンテナの作成
         containerID = ""
         err = ""
         try:
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-            containerID = result.stdout.strip()
-        except subprocess.CalledProcessError as e:
+            createArgs = dict(
+                image=containerName,
+                command=arguments,
+                working_dir=workDir,
+                environment=environment or None,
+                # enable interactive(detach=Falseなので、StdinOnceも有効になり、attachが切れたら標準入力が閉じられる)
+                stdin_open=True,
+                host_config=client.create_host_config(**hostConfigArgs),
+                labels=resource_labels(),
+            )
+            try:
+                result = client.create_container(**createArgs)
+            except ImageNotFound:
+                # docker createと同様に、イメージが無ければpullしてから再作成する
+                client.pull(containerName)
+                result = client.create_container(**createArgs)
+            containerID = result["Id"]
+        except DockerException as e:
             err = f"Failed to create container: {e}"
 
         test_logger.info(f'containerID: {containerID}, err: "{err}"')
@@ -290,164 +350,269 @@ class ContainerInfo:
 
         return Error("")
 
-    def remove(self) -> Error:
-        args = ["container", "rm", str(self.containerID)]
-
-        cmd = ["docker"] + args
-
+    def remove(self, force: bool = False) -> Error:
         err = ""
 
-        test_logger.info(f"remove container command: {cmd}")
+        test_logger.info(f"remove container: {self.containerID}")
 
         try:
-            subprocess.run(cmd, check=True)
-        except subprocess.CalledProcessError as e:
+            get_client().remove_container(self.containerID, force=force)
+        except DockerException as e:
             err = f"Failed to remove container: {e}"
 
         return Error(err)
 
+    # コンテナを起動し、終了するまで待つ(標準入出力のやり取りが不要な補助コンテナ用)
+    def startAndWait(self) -> tuple[int, str, Error]:
+        client = get_client()
+        try:
+            client.start(self.containerID)
+            exit_code = client.wait(self.containerID, timeout=None)["StatusCode"]
+            stderr = client.logs(self.containerID, stdout=False, stderr=True)
+        except DockerException as e:
+            return -1, "", Error(f"Failed to run container: {e}")
+        return exit_code, stderr.decode("utf-8", errors="replace"), Error("")
+
     # ファイルのコピー
     def copyFile(self, srcInHost: Path, dstInContainer: Path) -> Error:
-        args = ["cp", str(srcInHost), f"{self.containerID}:{str(dstInContainer)}"]
-
-        cmd = ["docker"] + args
+        dstInContainer = Path(dstInContainer)
+        try:
+            archive = _make_tar_archive([(Path(srcInHost), dstInContainer.name)])
+        except OSError as e:
+            return Error(f"Failed to copy file: {e}")
+        return self.extractArchive(archive, dstInContainer.parent)
 
+    # tarアーカイブをコンテナ内のディレクトリに展開する
+    def extractArchive(self, archive: bytes, dstDirInContainer: Path) -> Error:
         err = ""
-        
-        test_logger.info(f"copy container command: {cmd}")
+
+        test_logger.info(
+            f"extract archive ({len(archive)} bytes) -> {self.containerID}:{dstDirInContainer}"
+        )
 
         try:
-            subprocess.run(cmd, check=True)
-        except subprocess.CalledProcessError as e:
+            get_client().put_archive(self.containerID, str(dstDirInContainer), archive)
+        except DockerException as e:
             err = f"Failed to copy file: {e}"
 
         return Error(err)
 
 
-__MEM_USAGE_PATTERN = re.compile(r"^(\d+(\.\d+)?)([KMG]i?)B")
+# docker createのHostConfigに渡す引数(リソース制限・マウント)を組み立てる
+def _host_config_args(
+    cpus: int = -1,
+    memoryLimitMB: int = -1,
+    stackLimitKB: int = -1,
+    pidsLimit: int = -1,
+    enableNetwork: bool = False,
+    enableLoggingDriver: bool = True,
+    volumeMountInfo: list[VolumeMountInfo] = None,
+    tmpfs: dict[str, str] | None = None,
+    cpuTimeLimitSec: int = -1,
+    cpusetCpus: str = "",
+) -> dict:
+    # 各種リソース制限(docker create -i --init ... と同等)
+    hostConfigArgs = {"init": True}
+
+    # CPUの割り当て数
+    if cpus > 0:
+        hostConfigArgs["nano_cpus"] = int(cpus * 1e9)
+
+    # 実行に使うコアの指定(e.g., "0,1")
+    if cpusetCpus != "":
+        hostConfigArgs["cpuset_cpus"] = cpusetCpus
+
+    # メモリ制限
+    if memoryLimitMB > 0:
+        hostConfigArgs["mem_limit"] = f"{memoryLimitMB}m"
+        hostConfigArgs["memswap_limit"] = f"{memoryLimitMB}m"
+
+    # スタックサイズの制限
+    ulimits = []
+    if stackLimitKB > 0:
+        ulimits.append(Ulimit(name="stack", soft=stackLimitKB, hard=stackLimitKB))
+
+    # プロセスごとのCPU時間の制限(softでSIGXCPU、hardでSIGKILL)
+    if cpuTimeLimitSec > 0:
+        ulimits.append(
+            Ulimit(name="cpu", soft=cpuTimeLimitSec, hard=cpuTimeLimitSec + 1)
+        )
+
+    if ulimits:
+        hostConfigArgs["ulimits"] = ulimits
+
+    # プロセス数の制限
+    if pidsLimit > 0:
+        hostConfigArgs["pids_limit"] = pidsLimit
+
+    # ネットワークの有効化
+    if not enableNetwork:
+        hostConfigArgs["network_mode"] = "none"
+
+    # ロギングドライバの有効化
+    if not enableLoggingDriver:
+        hostConfigArgs["log_config"] = LogConfig(type=LogConfig.types.NONE)
+
+    # ボリュームのマウント
+    hostConfigArgs["binds"] = [
+        f"{volumeMountInfo.volume.name}:{volumeMountInfo.path}"
+        + (":ro" if volumeMountInfo.readOnly else "")
+        for volumeMountInfo in volumeMountInfo or []
+    ]
+
+    # tmpfsのマウント(マウント先のパス → マウントオプション)
+    if tmpfs:
+        hostConfigArgs["tmpfs"] = tmpfs
+
+    return hostConfigArgs
+
+
+# ホスト上のファイルを、(ホスト上のパス, アーカイブ内の名前)の組のリストからtarアーカイブにまとめる
+def _make_tar_archive(entries: list[tuple[Path, str]]) -> bytes:
+    def reset_owner(tarinfo: tarfile.TarInfo) -> tarfile.TarInfo:
+        # docker cpと同様に、コンテナ内ではrootの所有とする
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname = tarinfo.gname = "root"
+        return tarinfo
+
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for srcInHost, nameInArchive in entries:
+            tar.add(str(srcInHost), arcname=nameInArchive, filter=reset_owner)
+    return buffer.getvalue()
 
 
 # 時間・メモリ計測用のモニター
 class TaskMonitor:
     startTime: int
     endTime: int
-    maxUsedMemory: int  # 最大使用メモリ量[Byte]
     containerInfo: ContainerInfo  # モニタリング対象のコンテナ情報
-    _monitoring: bool  # モニタリング中かどうか
-    _monitor_thread: threading.Thread  # モニタリングスレッド
+    _reader: CgroupStatsReader | None  # cgroupの統計ファイル
+    _watcher: CgroupWatcher | None  # cgroupのイベントの通知
+    _oomKillAtAttach: int  # 監視を始めた時点でのOOM killの回数
+    _cpuUSecAtAttach: int  # 監視を始めた時点でのCPU時間[us]
+
+    '''
+    Dockerコンテナのメモリの取得方法は3つある
+    1. docker statsコマンドを使って取得する
+    2. /sys/fs/cgroup/system.slice/docker-xxxxxx.scope/memory.currentから取得する
+    3. psコマんドで取得する
+         * docker inspect -f '{{.State.Pid}}' <container id> でコンテナIDに対応するPIDを取得
+         * ps -p <pid> -o pid,comm,rss でRSSを取得
+    1の手法は遅い。
+    2の手法は早いが、Linuxでしか使えない。
+    3の手法の場合、ユーザ空間のプロセスのRSSを取得するため、全体のメモリ使用量を取得できない。
+    ref: https://unix.stackexchange.com/questions/686814/cgroup-and-process-memory-statistics-mismatch
+
+    2の手法でも、memory.currentをポーリングすると短いピークを取りこぼす上に、タスクごとにスレッドが必要になる。
+    そこで、カーネルが記録している最大値(memory.peak)とOOM killの回数(memory.events)、
+    CPU時間(cpu.stat)を読む。cgroupはコンテナの終了後に削除されるので、
+    memory.eventsとcgroup.events(populated 0)の変更をinotifyで受け取った時点と、終了時に読み直す。
+    '''
 
     def __init__(self, containerInfo: ContainerInfo):
         self.startTime = 0
         self.endTime = 0
-        self.maxUsedMemory = 0
         self.containerInfo = containerInfo
-        self._monitoring = False
+        self._reader = None
+        self._watcher = None
+        self._oomKillAtAttach = 0
+        self._cpuUSecAtAttach = 0
 
     def start(self):
         self.startTime = time.time_ns()
-        # containerInfo.containerIDを使ってコンテナのメモリ使用量を取得する
-        # 取得はdocker statsコマンドを使い、1msごとに取得する
-        # 取得したメモリ使用量からmaxUsedMemoryを更新する
-        self._monitoring = True
-        # TODO: docker statsは遅いので、/sys/fs/cgroupからメモリ使用量を取得する方法を検討する
-        self._monitor_thread = threading.Thread(
-            target=self.__monitor_memory_usage_by_cgroup
-        )
-        self._monitor_thread.start()
+
+    def attach(self, resetPeak: bool = False) -> None:
+        """
+        コンテナのcgroupの監視を始めます。cgroupはコンテナの起動時に作られるので、起動直後に呼び出します。
+
+        Args:
+            resetPeak: 既に動いているコンテナ(コンテナプール)で、これまでの最大メモリ使用量をリセットするかどうか
+        """
+        cgroupPath = container_cgroup_path(self.containerInfo.containerID)
+        if cgroupPath is None:
+            # 既に終了して削除されたか、cgroup v2が使えない
+            test_logger.info(f"cgroup not found: {self.containerInfo.containerID}")
+            return
+        self._reader = CgroupStatsReader(cgroupPath, resetPeak=resetPeak)
+        self._oomKillAtAttach = self._reader.stats.oomKill
+        if resetPeak:
+            # 既に動いているコンテナでは、これまでに使ったCPU時間を差し引く
+            self._cpuUSecAtAttach = (
+                self._reader.stats.cpuUserUSec + self._reader.stats.cpuSystemUSec
+            )
+        try:
+            self._watcher = CgroupWatcher(cgroupPath)
+        except OSError as e:
+            test_logger.info(f"failed to watch cgroup events: {e}")
+
+    # AttachedStream.communicateに渡す、イベントの通知先
+    def watchers(self) -> list[tuple[int, Callable[[], None]]]:
+        if self._watcher is None:
+            return []
+        return [(self._watcher.fileno(), self.notify)]
+
+    def notify(self) -> None:
+        if self._watcher is not None:
+            self._watcher.drain()
+        if self._reader is not None:
+            self._reader.read()
 
     def end(self):
         self.endTime = time.time_ns()
-        self._monitoring = False
-        self._monitor_thread.join()
+        if self._reader is not None:
+            self._reader.read()
+            self._reader.close()
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
 
     def get_elapsed_time_ms(self) -> float:
         return (self.endTime - self.startTime) / 1e6
 
     def get_used_memory_byte(self) -> int:
-        return self.maxUsedMemory
+        if self._reader is None:
+            return 0
+        return self._reader.stats.memoryPeakByte
+
+    # CPU時間(user+system)[ms]。cgroupが読めなかった場合は-1
+    def get_cpu_time_ms(self) -> int:
+        if self._reader is None:
+            return -1
+        stats = self._reader.stats
+        return (stats.cpuUserUSec + stats.cpuSystemUSec - self._cpuUSecAtAttach) // 1000
+
+    # cgroupの統計を読めているかどうか
+    def is_attached(self) -> bool:
+        return self._reader is not None
+
+    # attach(resetPeak=True)で最大メモリ使用量をリセットできなかったかどうか
+    # (get_used_memory_byteにはこれまでの実行での最大値が含まれる)
+    def peak_reset_failed(self) -> bool:
+        return self._reader is not None and self._reader.peakResetFailed
+
+    def is_oom_killed(self) -> bool:
+        return (
+            self._reader is not None
+            and self._reader.stats.oomKill > self._oomKillAtAttach
+        )
 
-    '''
-    Dockerコンテナのメモリの取得方法は3つある
-    1. docker statsコマンドを使って取得する
-    2. /sys/fs/cgroup/system.slice/docker-xxxxxx.scope/memory.currentから取得する
-    3. psコマんドで取得する
-         * docker inspect -f '{{.State.Pid}}' <container id> でコンテナIDに対応するPIDを取得
-         * ps -p <pid> -o pid,comm,rss でRSSを取得
-    1の手法は遅い。
-    2の手法は早いが、Linuxでしか使えない。
-    3の手法の場合、ユーザ空間のプロセスのRSSを取得するため、全体のメモリ使用量を取得できない。
-    ref: https://unix.stackexchange.com/questions/686814/cgroup-and-process-memory-statistics-mismatch
-    '''
 
-    def __monitor_memory_usage_by_docker_stats(self) -> None:
-        while self._monitoring:
-            # docker statsコマンドを使ってコンテナのメモリ使用量を取得する
-            result = subprocess.run(
-                [
-                    "docker",
-                    "stats",
-                    "--no-stream",
-                    "--format",
-                    "{{.MemUsage}}",
-                    self.containerInfo.containerID,
-                ],
-                capture_output=True,
-                text=True,
-                check=False,
-            )
+load_dotenv()
 
-            test_logger.info(f"docker stats: {result.stdout}")
-
-            # result.stdout = "1.23GiB / 2.00GiB"といった形式でメモリ使用量が取得できる
-            # この値をパースしてmaxUsedMemoryを更新する
-            if result.returncode == 0:
-                mem_usage = result.stdout.strip()
-                used_memory = self.__parse_memory_usage_docker_stats(mem_usage)
-                if used_memory > self.maxUsedMemory:
-                    self.maxUsedMemory = used_memory
-                time.sleep(0.001)  # 1ms待つ
-
-    def __parse_memory_usage_docker_stats(self, mem_usage: str) -> int:
-        # "1.23 GiB / 2.00 GiB" -> 1.23 -> 1.23 * 1024 * 1024 * 1024
-        match = __MEM_USAGE_PATTERN.match(mem_usage)
-        if match:
-            # __MEM_USAGE_PATTERN.match("1.23 GiB / 2.00 GiB")
-            # match.group(1) = "1.23"
-            # match.group(2) = ".23"
-            # match.group(3) = "Gi"
-            value = float(match.group(1))
-            unit = match.group(3)
-            if unit == "Ki":
-                return int(value * 1024)
-            elif unit == "Mi":
-                return int(value * 1024 * 1024)
-            else:
-                assert unit == "Gi"
-                return int(value * 1024 * 1024 * 1024)
-        return 0
-
-    def __monitor_memory_usage_by_cgroup(self) -> None:
-        # /sys/fs/cgroup/system.slice/docker-xxxxxx.scope/memory.current
-        # からメモリ使用量をバイト単位で取得する
-        cgroup_path = (
-            Path("/sys-host/fs/cgroup/system.slice/")
-            / f"docker-{self.containerInfo.containerID}.scope"
-            / "memory.current"
-        )
-        while self._monitoring:
-            try:
-                if cgroup_path.exists():
-                    with cgroup_path.open("r") as f:
-                        mem_usage = int(f.read())
-                        if mem_usage > self.maxUsedMemory:
-                            self.maxUsedMemory = mem_usage
-            except FileNotFoundError:
-                # test_logger.info(f"Cgroup Path not exists: {cgroup_path}")
-                pass
-            except OSError:
-                # test_logger.info(f"Failed to read cgroup file: {cgroup_path}")
-                pass
-            time.sleep(0.001)
+# タスクを実行するバックエンド
+# "docker": Dockerコンテナで実行する
+# "namespace": Dockerデーモンを使わず、namespace等で隔離して実行する(namespace.pyを参照)
+SANDBOX_BACKEND = os.getenv("SANDBOX_BACKEND", "docker")
+
+
+# tmpfsの作業ディレクトリを使う場合の、初期内容のマウント先とextraFilesのコピー先
+_TMPFS_SEED_PATH = "/.seed"
+_TMPFS_EXTRA_FILES_PATH = "/.seed-extra"
+
+
+# 出力の上限の既定値(ワーカーのメモリを使い切らないようにするためのもの)
+DEFAULT_OUTPUT_LIMIT_BYTE = 64 * 1024 * 1024
 
 
 @dataclass
@@ -458,6 +623,9 @@ class TaskResult:
     timeMS: int = -1
     memoryByte: int = -1
     TLE: bool = True  # 制限時間を超えたかどうか
+    MLE: bool = False  # OOM killerにkillされたかどうか
+    cpuTimeMS: int = -1  # CPU時間(user+system)[ms]。取得できなければ-1
+    OLE: bool = False  # 出力が上限を超えたかどうか(stdout, stderrは上限までの先頭部分)
 
 
 # タスクの実行情報
@@ -465,13 +633,20 @@ class TaskResult:
 class TaskInfo:
     name: str  # コンテナイメージ名
     arguments: list[str] = field(default_factory=list)  # コンテナ内で実行するコマンド
-    timeoutSec: float = 0.0  # タイムアウト時間
+    timeoutSec: float = 0.0  # タイムアウト時間(CPU時間)
+    # 実時間の制限。sleep等でCPUを使わずに止まっているプログラムを打ち切るためのもの。
+    # 0ならtimeoutSecの2倍+500ms(timeoutSecも0なら30秒)
+    wallTimeoutSec: float = 0.0
+    # 標準出力・標準エラー出力の合計の上限[Byte]。超えたらコンテナを止めてOLEとする(0なら無制限)
+    outputLimitByte: int = DEFAULT_OUTPUT_LIMIT_BYTE
     cpus: int = 0  # CPUの割り当て数
+    cpusetCpus: str = ""  # 実行に使うコア(e.g., "0,1")。空なら指定しない
     memoryLimitMB: int = 0  # メモリ制限
     stackLimitKB: int = 0  # リカージョンの深さを制限
     pidsLimit: int = 0  # プロセス数の制限
     enableNetwork: bool = False
-    enableLoggingDriver: bool = True
+    # 出力はattachで受け取るので、デーモンにログとして書き込ませる必要は無い
+    enableLoggingDriver: bool = False
     workDir: str = "/workdir/"  # コンテナ内での作業ディレクトリ
     # cgroupをいじるにはroot権限が必要なので、現状は使わない
     # cgroupParent: str  # cgroupの親ディレクトリ
@@ -481,19 +656,136 @@ class TaskInfo:
     taskMonitor: TaskMonitor = field(
         default_factory=lambda: TaskMonitor(ContainerInfo(""))
     )
+    # コンテナ作成後・起動前に作業ディレクトリにコピーするファイル
+    # (ホスト上のパス, 作業ディレクトリからの相対パス)のリスト
+    extraFiles: list[tuple[Path, Path]] = field(default_factory=list)
+    # 0より大きければ、作業ディレクトリをこの大きさ[MB]のtmpfsにする。
+    # tmpfsに書き込んだ分はコンテナのメモリ使用量に計上されるため、memoryLimitMBに含まれる
+    tmpfsWorkDirMB: int = 0
+    tmpfsSeedVolume: Volume | None = None  # tmpfsの作業ディレクトリの初期内容となるボリューム
+    environment: dict[str, str] = field(default_factory=dict)  # コマンドに追加で渡す環境変数
+
+    backend: str = ""  # 実行に使うバックエンド("docker" / "namespace")。空ならSANDBOX_BACKEND
 
     Stdin: str = ""  # 標準入力
     Stdout: str = ""  # 標準出力
     Stderr: str = ""  # 標準エラー出力
 
+    def backendName(self) -> str:
+        return self.backend if self.backend != "" else SANDBOX_BACKEND
+
+    # 実時間の制限[秒]
+    def wallTimeout(self) -> float:
+        if self.wallTimeoutSec != 0.0:
+            return self.wallTimeoutSec
+        if self.timeoutSec != 0.0:
+            return self.timeoutSec * 2 + 0.5
+        return 30.0  # デフォルトは30秒
+
+    # RLIMIT_CPUに設定する値[秒]。CPUを使い続けるプログラムを実時間の制限より早く止める
+    def cpuTimeLimitSec(self) -> int:
+        if self.timeoutSec == 0.0:
+            return -1
+        return math.ceil(self.timeoutSec) + 1
+
+    # 制限時間を超えたかどうか(CPU時間が取得できなければ実時間で判定する)
+    def isTLE(self, cpuTimeMS: int, elapsedMS: float) -> bool:
+        if self.timeoutSec == 0.0:
+            return False
+        if cpuTimeMS >= 0:
+            return self.timeoutSec < cpuTimeMS / 1000
+        return self.timeoutSec < elapsedMS / 1000
+
+    # Dockerコンテナの作成
+    # コンテナに渡すコマンド・マウント情報・tmpfs、extraFilesのコピー先(コンテナ内の絶対パス)を求める
+    def _containerSpec(
+        self,
+    ) -> tuple[list[str], list[VolumeMountInfo], dict[str, str] | None, Path]:
+        arguments = self.arguments
+        volumeMountInfo = self.volumeMountInfo
+        tmpfs = None
+        # extraFilesのコピー先(コンテナ内の絶対パス)
+        extraFilesDir = Path(self.workDir)
+
+        if self.tmpfsWorkDirMB > 0:
+            # tmpfsはコンテナの起動時にマウントされるので、起動前には書き込めない。
+            # そこで初期内容を読み取り専用でマウントしておき、起動直後にtmpfsへコピーしてから
+            # 本来のコマンドをexecする。
+            sizeMB = self.tmpfsWorkDirMB
+            if self.memoryLimitMB > 0:
+                sizeMB = min(sizeMB, self.memoryLimitMB)
+            tmpfs = {self.workDir: f"rw,exec,nosuid,size={sizeMB}m"}
+            if self.tmpfsSeedVolume is not None:
+                volumeMountInfo = volumeMountInfo + [
+                    VolumeMountInfo(
+                        path=_TMPFS_SEED_PATH,
+                        volume=self.tmpfsSeedVolume,
+                        readOnly=True,
+                    )
+                ]
+            extraFilesDir = Path(_TMPFS_EXTRA_FILES_PATH)
+            arguments = [
+                "sh",
+                "-c",
+                f"for d in {_TMPFS_SEED_PATH} {_TMPFS_EXTRA_FILES_PATH}; do "
+                'if [ -d "$d" ]; then cp -a "$d/." . || exit 125; fi; done; exec "$@"',
+                "sh",
+            ] + self.arguments
+
+        return arguments, volumeMountInfo, tmpfs, extraFilesDir
+
+    # extraFilesをまとめたtarアーカイブ(コンテナのルートに展開する)。extraFilesが無ければNone
+    def _extraFilesArchive(self, extraFilesDir: Path) -> tuple[bytes | None, Error]:
+        if len(self.extraFiles) == 0:
+            return None, Error("")
+        # コピー先のディレクトリが無くても展開できるように、ルートからの相対パスでまとめる
+        try:
+            archive = _make_tar_archive(
+                [
+                    (src, os.path.normpath(extraFilesDir.relative_to("/") / dst))
+                    for src, dst in self.extraFiles
+                ]
+            )
+        except OSError as e:
+            return None, Error(f"Failed to copy file: {e}")
+        return archive, Error("")
+
+    # 実行中に取得した出力と計測値から実行結果を作る(戻り値は呼び出し側で設定する)
+    def _result(
+        self, stdout: bytes, stderr: bytes, timedOut: bool, outputExceeded: bool
+    ) -> TaskResult:
+        self.Stdout = stdout.decode("utf-8", errors="replace")
+        self.Stderr = stderr.decode("utf-8", errors="replace")
+
+        cpuTimeMS = self.taskMonitor.get_cpu_time_ms()
+        elapsedMS = self.taskMonitor.get_elapsed_time_ms()
+        if timedOut or outputExceeded:
+            # 途中で止めた場合、TLEは実時間の制限で止めたかどうか
+            TLE = timedOut
+        else:
+            TLE = self.isTLE(cpuTimeMS, elapsedMS)
+
+        return TaskResult(
+            stdout=self.Stdout,
+            stderr=self.Stderr,
+            timeMS=int(elapsedMS),
+            memoryByte=self.taskMonitor.get_used_memory_byte(),
+            TLE=TLE,
+            MLE=self.taskMonitor.is_oom_killed(),
+            cpuTimeMS=cpuTimeMS,
+            OLE=outputExceeded,
+        )
+
     # Dockerコンテナの作成
     def __create(self) -> tuple[ContainerInfo, Error]:
         # docker create ...
         containerInfo = ContainerInfo("")
 
+        arguments, volumeMountInfo, tmpfs, extraFilesDir = self._containerSpec()
+
         err = containerInfo.create(
             containerName=self.name,
-            arguments=self.arguments,
+            arguments=arguments,
             cpus=self.cpus,
             memoryLimitMB=self.memoryLimitMB,
             stackLimitKB=self.stackLimitKB,
@@ -501,7 +793,11 @@ class TaskInfo:
             enableNetwork=self.enableNetwork,
             enableLoggingDriver=self.enableLoggingDriver,
             workDir=self.workDir,
-            volumeMountInfo=self.volumeMountInfo,
+            volumeMountInfo=volumeMountInfo,
+            tmpfs=tmpfs,
+            cpuTimeLimitSec=self.cpuTimeLimitSec(),
+            cpusetCpus=self.cpusetCpus,
+            environment=self.environment,
         )
 
         # Dockerコンテナの作成
@@ -512,113 +808,107 @@ class TaskInfo:
         if err.message != "":
             return ContainerInfo(""), err
 
+        archive, err = self._extraFilesArchive(extraFilesDir)
+        if err.message == "" and archive is not None:
+            err = containerInfo.extractArchive(archive, Path("/"))
+        if err.message != "":
+            containerInfo.remove()
+            return ContainerInfo(""), err
+
         # モニターにコンテナ情報を設定
         self.taskMonitor.containerInfo = containerInfo
 
         return containerInfo, Error("")
 
-    # docker start ... を実行して、コンテナを起動する。
-    # これにより、docker createで指定したコマンド(コンパイル、プログラムの実行等)が実行される。
+    # コンテナにattachしてから起動する(docker start -i と同等)。
+    # これにより、コンテナ作成時に指定したコマンド(コンパイル、プログラムの実行等)が実行される。
+    # 終了コードは起動前に登録した終了待ちのレスポンスから受け取る。
+    # AutoRemoveではcgroupの統計やOOM killの記録を読む前に削除されることがあるので、
+    # コンテナは結果を読み終えてからここで削除する。
     def __start(self, containerInfo: ContainerInfo) -> tuple[TaskResult, Error]:
-        # docker start
-        args = ["start"]
+        client = get_client()
 
-        # enable interactive
-        args += ["-i"]
+        test_logger.info(f"start container: {containerInfo.containerID}")
 
-        # コンテナID
-        args += [containerInfo.containerID]
+        # CPU時間はcgroupで計測し、実時間の制限はここで打ち切る
+        timeout = self.wallTimeout()
 
-        # Dockerコンテナの起動コマンド
-        cmd = ["docker"] + args
-
-        test_logger.info(f"docker start command: {cmd}")
-
-        # self.timeout + 500msの制限時間を設定
-        timeout = 30.0  # デフォルトは30秒
-        if self.timeoutSec != 0.0:
-            timeout = self.timeoutSec + 0.5
+        try:
+            stream = AttachedStream.open(containerInfo.containerID)
+        except DockerException as e:
+            containerInfo.remove(force=True)
+            return TaskResult(), Error(f"Failed to attach container: {e}")
 
-        # モニターを開始
-        self.taskMonitor.start()
+        try:
+            waiter = ExitWaiter.open(containerInfo.containerID, condition="next-exit")
+        except DockerException as e:
+            stream.close()
+            containerInfo.remove(force=True)
+            return TaskResult(), Error(f"Failed to wait container: {e}")
 
-        # Dockerコンテナの起動
-        TLE = False
         try:
-            ProcessResult = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=timeout,
-                input=self.Stdin,
-                check=False,
+            # モニターを開始
+            self.taskMonitor.start()
+
+            # Dockerコンテナの起動
+            client.start(containerInfo.containerID)
+            self.taskMonitor.attach()
+            stdout, stderr, timedOut, outputExceeded = stream.communicate(
+                self.Stdin.encode("utf-8"),
+                deadline=time.monotonic() + timeout,
+                watchers=self.taskMonitor.watchers(),
+                outputLimitByte=self.outputLimitByte if self.outputLimitByte > 0 else None,
             )
-        except subprocess.TimeoutExpired:
-            # タイムアウトした場合
-            # モニターを終了(これをしないとtaskMonitorのスレッドが終了しない)
+        except (DockerException, OSError) as e:
             self.taskMonitor.end()
-
-            # まだ実行中の場合があるので、docker stop...で停止させる。
-            stop_cmd = ["docker", "stop", containerInfo.containerID]
-            test_logger.info(stop_cmd)
-            resultForStop = subprocess.run(stop_cmd, check=False)
-            if resultForStop.returncode != 0:
-                message = f"failed to stop docker: {containerInfo.containerID}"
-                test_logger.info(message)
-                return TaskResult(
-                    TLE=True,
-                    timeMS=int(self.taskMonitor.get_elapsed_time_ms()),
-                    memoryByte=self.taskMonitor.get_used_memory_byte(),
-                ), Error(message)
-            # 戻り値を検出
-            exit_code, err = inspectExitCode(containerId=containerInfo.containerID)
-            if err.message != "":
-                return (
-                    TaskResult(
-                        TLE=True,
-                        timeMS=int(self.taskMonitor.get_elapsed_time_ms()),
-                        memoryByte=self.taskMonitor.get_used_memory_byte(),
-                    ),
-                    err,
-                )
-            return TaskResult(
-                exitCode=exit_code,
-                TLE=True,
-                timeMS=int(self.taskMonitor.get_elapsed_time_ms()),
-                memoryByte=self.taskMonitor.get_used_memory_byte(),
-            ), Error("")
-
-        test_logger.info(ProcessResult)
+            waiter.close()
+            containerInfo.remove(force=True)
+            return TaskResult(), Error(f"Failed to start container: {e}")
+        finally:
+            stream.close()
 
         # モニターを終了
         self.taskMonitor.end()
 
-        self.Stdout = ProcessResult.stdout
-        self.Stderr = ProcessResult.stderr
+        result = self._result(stdout, stderr, timedOut, outputExceeded)
 
-        # タイムアウトしたかどうか
-        if (
-            self.timeoutSec != 0.0
-            and self.timeoutSec < self.taskMonitor.get_elapsed_time_ms() / 1000
-        ):
-            TLE = True
+        if timedOut or outputExceeded:
+            # タイムアウトした場合、もしくは出力が上限を超えた場合
+            # まだ実行中なので、停止させる。
+            test_logger.info(f"kill container: {containerInfo.containerID}")
+            try:
+                client.kill(containerInfo.containerID)
+            except DockerException as e:
+                # 止める前に終了していた
+                test_logger.info(f"failed to kill container: {containerInfo.containerID}: {e}")
 
-        exit_code, err = inspectExitCode(containerId=containerInfo.containerID)
-        if err.message != "":
-            return TaskResult(), err
+        # 出力のEOFとコンテナの終了は同時とは限らないので、終了を待ってから戻り値を取得する
+        try:
+            result.exitCode = waiter.result()
+        except (DockerException, OSError, ValueError, KeyError) as e:
+            containerInfo.remove(force=True)
+            return result, Error(f"Failed to inspect exit code: {e}")
 
-        return TaskResult(
-            exitCode=exit_code,
-            stdout=self.Stdout,
-            stderr=self.Stderr,
-            timeMS=int(self.taskMonitor.get_elapsed_time_ms()),
-            memoryByte=self.taskMonitor.get_used_memory_byte(),
-            TLE=TLE,
-        ), Error("")
+        if not self.taskMonitor.is_attached():
+            # 起動直後に終了してcgroupを読めなかった場合は、DockerがOOM killを記録しているかで判定する
+            oomKilled, err = inspectOOMKilled(containerInfo.containerID)
+            if not err.silence():
+                test_logger.info(err.message)
+            result.MLE = result.MLE or oomKilled
+
+        containerInfo.remove(force=True)
+        return result, Error("")
 
     def run(self) -> tuple[TaskResult, Error]:
-        # コンテナ作成から起動までの処理を行う
-        # 途中で失敗したら、作成したコンテナの削除を行い、エラーを返す
+        if self.backendName() == "namespace":
+            # namespace.pyはこのモジュールを参照するので、使う時に読み込む
+            from .namespace import runInNamespace
+
+            return runInNamespace(self)
+
+        # コンテナ作成から起動までの処理を行う(docker run -i --rm と同等)
+        # 作成・attach・終了待ちの登録・起動の後、終了待ちのレスポンスで終了コードを受け取る。
+        # コンテナは結果を読み終えてから削除する。
         containerInfo, err = self.__create()
         test_logger.info(
             f'containerID: {containerInfo.containerID}, err: "{err.message}"'
@@ -629,28 +919,24 @@ class TaskInfo:
         test_logger.info(f"containerID: {containerInfo.containerID}")
 
         test_logger.info("start container")
-        result, err = self.__start(containerInfo)
-
-        # コンテナの削除
-        err2 = containerInfo.remove()
-        if err2.message != "":
-            err.message += "\n" + err2.message
-
-        return result, err
+        return self.__start(containerInfo)
 
 
 def inspectExitCode(containerId: str) -> tuple[int, Error]:
-    args = ["inspect", "--format={{.State.ExitCode}}", containerId]
+    try:
+        state = get_client().inspect_container(containerId)["State"]
+    except DockerException as e:
+        return -1, Error(f"Failed to inspect exit code: {e}")
 
-    cmd = ["docker"] + args
+    test_logger.info(f"inspect exit code: {state}")
 
-    result = subprocess.run(cmd, capture_output=True, text=True, check=False)
+    return int(state["ExitCode"]), Error("")
 
-    test_logger.info(f"inspect exit code: {result}")
 
-    err = ""
-    if result.returncode != 0:
-        err = f"Failed to inspect exit code: {result.stderr}"
-        return -1, Error(err)
+def inspectOOMKilled(containerId: str) -> tuple[bool, Error]:
+    try:
+        state = get_client().inspect_container(containerId)["State"]
+    except DockerException as e:
+        return False, Error(f"Failed to inspect OOMKilled: {e}")
 
-    return int(result.stdout), Error(err)
+    return bool(state.get("OOMKilled", False)), Error("")
@@ -0,0 +1,57 @@
+"""
+このプログラムでは、sandboxが作成するDockerリソース(コンテナ・ボリューム)に付けるラベルを実装する。
+* どの提出のためのリソースかを設定するコンテキストマネージャowned_by
+* 作成するリソースに付けるラベルを返す関数resource_labels
+
+ラベルにはプロセスごとのインスタンスID、提出ID、作成時刻(UNIX時間)を記録する。
+ワーカーが途中で落ちて削除されなかったリソースは、reaper.pyがこれらのラベルを元に削除する。
+"""
+
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# このsandboxが作成したリソースであることを示すラベル
+LABEL_MANAGED = "dsa-judge.managed"
+# 作成したプロセスのインスタンスID
+LABEL_INSTANCE = "dsa-judge.instance"
+# リソースを使っている提出のID(提出に属さないリソースは空文字列)
+LABEL_SUBMISSION = "dsa-judge.submission-id"
+# 作成時刻(UNIX時間[秒])
+LABEL_CREATED_AT = "dsa-judge.created-at"
+
+# プロセスごとに一意なID(プロセスが再起動したら変わる)
+INSTANCE_ID = uuid.uuid4().hex
+
+# 現在の処理がどの提出のためのものか(スレッド・asyncioのタスクごとに独立している)
+_submission_id: ContextVar[str] = ContextVar("sandbox_submission_id", default="")
+
+
+@contextmanager
+def owned_by(submissionId: str | int):
+    """
+    このブロック内で作成したリソースに、提出IDのラベルを付けます。
+    空文字列を渡すと、提出に属さないリソース(コンテナプール等)として作成します。
+    """
+    token = _submission_id.set(str(submissionId))
+    try:
+        yield
+    finally:
+        _submission_id.reset(token)
+
+
+def current_submission_id() -> str:
+    return _submission_id.get()
+
+
+def resource_labels() -> dict[str, str]:
+    """
+    これから作成するリソースに付けるラベルを返します。
+    """
+    return {
+        LABEL_MANAGED: "true",
+        LABEL_INSTANCE: INSTANCE_ID,
+        LABEL_SUBMISSION: _submission_id.get(),
+        LABEL_CREATED_AT: str(int(time.time())),
+    }
@@ -0,0 +1,305 @@
+"""
+このプログラムでは、Dockerデーモンを使わずにタスクを実行するバックエンドを実装する。
+* コンテナイメージのルートファイルシステムを展開しておく関数prepareRootfs
+* TaskInfoをns-sandbox(langs/ns-sandbox.c)で実行する関数runInNamespace
+
+ns-sandboxはnamespace・cgroup v2・rlimit・seccompでコマンドを隔離し、展開したルートファイルシステムに
+chrootして実行する。コンテナの作成・起動・削除のAPI呼び出しが無いので、1回の実行の待ち時間が短い。
+リソース制限・計測・結果の意味はTaskInfo.run()(Dockerバックエンド)と同じ。
+
+このバックエンドを使うには、judge-serverが以下を満たす必要がある。
+* CAP_SYS_ADMIN等の権限(compose.yamlでprivileged: true)
+* 書き込み可能なcgroup v2のディレクトリ(SANDBOX_NAMESPACE_CGROUP)
+* Dockerボリュームの実体(/var/lib/docker/volumes)がホストと同じパスで見えること
+"""
+
+import json
+import os
+import selectors
+import signal
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from docker.errors import DockerException, ImageNotFound
+from dotenv import load_dotenv
+
+from .my_error import Error
+from .docker_client import get_client
+from .labels import resource_labels
+from .execute import TaskInfo, TaskResult, VolumeMountInfo, test_logger
+
+load_dotenv()
+
+# ns-sandboxの実行ファイル(Dockerfileでビルドしてコピーしている)
+NAMESPACE_HELPER_PATH = os.getenv("SANDBOX_NAMESPACE_HELPER", "/usr/local/bin/ns-sandbox")
+# イメージごとのルートファイルシステムを展開しておくディレクトリ
+NAMESPACE_ROOTFS_DIR = Path(
+    os.getenv("SANDBOX_NAMESPACE_ROOTFS_DIR", "/var/lib/dsa-judge/rootfs")
+)
+# 実行ごとのcgroupを作るディレクトリ。空ならcgroupを使わない(メモリ・プロセス数の制限が無くなる)
+NAMESPACE_CGROUP = os.getenv("SANDBOX_NAMESPACE_CGROUP", "/sys/fs/cgroup/dsa-judge")
+
+# ns-sandbox自体が実時間の制限を守れなかった場合に、こちらから止めるまでの余裕
+_HELPER_GRACE_SEC = 5.0
+
+_CHUNK_SIZE = 64 * 1024
+
+_rootfs_locks: dict[str, threading.Lock] = {}
+_rootfs_locks_lock = threading.Lock()
+
+
+def _rootfs_path(image: str) -> Path:
+    return NAMESPACE_ROOTFS_DIR / image.replace("/", "_").replace(":", "_")
+
+
+def prepareRootfs(image: str) -> tuple[Path, list[str], Error]:
+    """
+    イメージのルートファイルシステムを展開したディレクトリと、イメージの環境変数を返します。
+    初回はイメージから作ったコンテナをexportして展開します(以降は展開済みのものを使います)。
+
+    Returns:
+        tuple[Path, list[str], Error]: ルートファイルシステム、"KEY=VALUE"形式の環境変数、エラー
+    """
+    rootfs = _rootfs_path(image)
+    # 環境変数のファイルは展開が終わってから書くので、これがあれば展開済み
+    envFile = Path(str(rootfs) + ".env.json")
+
+    with _rootfs_locks_lock:
+        lock = _rootfs_locks.setdefault(image, threading.Lock())
+
+    with lock:
+        if envFile.exists():
+            return rootfs, json.loads(envFile.read_text()), Error("")
+
+        client = get_client()
+        try:
+            try:
+                config = client.inspect_image(image)
+            except ImageNotFound:
+                client.pull(image)
+                config = client.inspect_image(image)
+            env = config["Config"].get("Env") or []
+
+            container = client.create_container(image, command=["true"], labels=resource_labels())
+            try:
+                staging = rootfs.with_name(f"{rootfs.name}.tmp-{uuid.uuid4().hex}")
+                staging.mkdir(parents=True)
+                with tempfile.TemporaryFile() as archive:
+                    for chunk in client.export(container["Id"]):
+                        archive.write(chunk)
+                    archive.seek(0)
+                    with tarfile.open(fileobj=archive) as tar:
+                        # デバイスファイルはサンドボックス側で用意するので展開しない
+                        members = [
+                            member
+                            for member in tar
+                            if not (member.ischr() or member.isblk() or member.isfifo())
+                        ]
+                        tar.extractall(staging, members=members, numeric_owner=True, filter="tar")
+                os.rename(staging, rootfs)
+            finally:
+                client.remove_container(container["Id"], force=True)
+        except (DockerException, OSError, tarfile.TarError) as e:
+            return rootfs, [], Error(f"Failed to prepare rootfs of {image}: {e}")
+
+        envFile.write_text(json.dumps(env))
+        test_logger.info(f"prepared rootfs of {image}: {rootfs}")
+        return rootfs, env, Error("")
+
+
+# Dockerボリュームをns-sandboxのマウント指定に変換する
+def _volume_mount_args(volumeMountInfo: VolumeMountInfo) -> list[str]:
+    volume = get_client().inspect_volume(volumeMountInfo.volume.name)
+    options = volume.get("Options") or {}
+    if options.get("type") == "overlay":
+        # Volume.snapshot()で作ったボリュームは、コンテナと同じくマウントする時にoverlayを組み立てる
+        return ["--overlay", f"{volumeMountInfo.path}:{options['o']}"]
+    return [
+        "--bind",
+        f"{volume['Mountpoint']}:{volumeMountInfo.path}"
+        + (":ro" if volumeMountInfo.readOnly else ""),
+    ]
+
+
+def _helper_args(
+    task: TaskInfo, rootfs: Path, env: list[str], statusFd: int
+) -> tuple[list[str], Error]:
+    arguments, volumeMountInfo, tmpfs, extraFilesDir = task._containerSpec()
+
+    args = [NAMESPACE_HELPER_PATH, "--rootfs", str(rootfs), "--workdir", task.workDir]
+    # 後に指定したものが優先されるので、イメージの環境変数の後にタスクの環境変数を渡す
+    for variable in env + [f"{key}={value}" for key, value in task.environment.items()]:
+        args += ["--env", variable]
+
+    try:
+        for mount in volumeMountInfo:
+            args += _volume_mount_args(mount)
+    except DockerException as e:
+        return [], Error(f"Failed to inspect volume: {e}")
+    for path, options in (tmpfs or {}).items():
+        args += ["--tmpfs", f"{path}:{options}"]
+    for src, dst in task.extraFiles:
+        args += ["--copy-file", f"{Path(src).resolve()}:{extraFilesDir / dst}"]
+
+    if NAMESPACE_CGROUP != "":
+        args += ["--cgroup", NAMESPACE_CGROUP]
+    if task.memoryLimitMB > 0:
+        args += ["--memory", str(task.memoryLimitMB * 1024 * 1024)]
+    if task.pidsLimit > 0:
+        args += ["--pids", str(task.pidsLimit)]
+    if task.cpus > 0:
+        args += ["--cpus", str(task.cpus)]
+    if task.cpusetCpus != "":
+        args += ["--cpuset", task.cpusetCpus]
+    if task.cpuTimeLimitSec() > 0:
+        args += ["--cpu-sec", str(task.cpuTimeLimitSec())]
+    if task.stackLimitKB > 0:
+        args += ["--stack", str(task.stackLimitKB)]
+    args += ["--wall-ms", str(int(task.wallTimeout() * 1000))]
+    if task.enableNetwork:
+        args.append("--network")
+
+    args += ["--status-fd", str(statusFd), "--"] + arguments
+    return args, Error("")
+
+
+# 標準入力を書き込みながら、標準出力・標準エラー出力をEOFまで読み込む(AttachedStream.communicateと同じ)
+def _communicate(
+    proc: subprocess.Popen, stdin: bytes, deadline: float, outputLimitByte: int | None
+) -> tuple[bytes, bytes, bool]:
+    outputs = {proc.stdout.fileno(): bytearray(), proc.stderr.fileno(): bytearray()}
+    pending = memoryview(stdin)
+
+    selector = selectors.DefaultSelector()
+    for fd in outputs:
+        selector.register(fd, selectors.EVENT_READ)
+    stdinFd = proc.stdin.fileno()
+    os.set_blocking(stdinFd, False)
+    if len(pending) > 0:
+        selector.register(stdinFd, selectors.EVENT_WRITE)
+    else:
+        proc.stdin.close()
+
+    open_fds = len(outputs)
+    try:
+        while open_fds > 0:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                # ns-sandboxが止まらない場合は、こちらから止める
+                proc.send_signal(signal.SIGTERM)
+                break
+            for key, _ in selector.select(timeout):
+                if key.fd == stdinFd:
+                    try:
+                        sent = os.write(stdinFd, pending[:_CHUNK_SIZE])
+                        pending = pending[sent:]
+                    except BlockingIOError:
+                        continue
+                    except BrokenPipeError:
+                        # プログラムが標準入力を読まずに終了した
+                        pending = pending[:0]
+                    if len(pending) == 0:
+                        selector.unregister(stdinFd)
+                        proc.stdin.close()
+                    continue
+
+                chunk = os.read(key.fd, _CHUNK_SIZE)
+                if not chunk:
+                    selector.unregister(key.fd)
+                    open_fds -= 1
+                    continue
+                outputs[key.fd] += chunk
+                stdout = outputs[proc.stdout.fileno()]
+                stderr = outputs[proc.stderr.fileno()]
+                if outputLimitByte is not None and len(stdout) + len(stderr) > outputLimitByte:
+                    # 出力が上限を超えたので、サンドボックス内のプロセスを止める
+                    del stdout[outputLimitByte:]
+                    del stderr[max(outputLimitByte - len(stdout), 0) :]
+                    proc.send_signal(signal.SIGTERM)
+                    return bytes(stdout), bytes(stderr), True
+    finally:
+        selector.close()
+        if not proc.stdin.closed:
+            proc.stdin.close()
+
+    return bytes(outputs[proc.stdout.fileno()]), bytes(outputs[proc.stderr.fileno()]), False
+
+
+def runInNamespace(task: TaskInfo) -> tuple[TaskResult, Error]:
+    """
+    TaskInfo.run()と同じタスクを、Dockerデーモンを使わずにns-sandboxで実行します。
+    """
+    rootfs, env, err = prepareRootfs(task.name)
+    if err.message != "":
+        return TaskResult(), err
+
+    statusRead, statusWrite = os.pipe()
+    try:
+        args, err = _helper_args(task, rootfs, env, statusWrite)
+        if err.message != "":
+            return TaskResult(), err
+
+        test_logger.info(f"run in namespace: image={task.name}, arguments={task.arguments}")
+        try:
+            proc = subprocess.Popen(
+                args,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                pass_fds=(statusWrite,),
+            )
+        except OSError as e:
+            return TaskResult(), Error(f"Failed to start sandbox: {e}")
+        os.close(statusWrite)
+        statusWrite = -1
+
+        try:
+            stdout, stderr, outputExceeded = _communicate(
+                proc,
+                task.Stdin.encode("utf-8"),
+                deadline=time.monotonic() + task.wallTimeout() + _HELPER_GRACE_SEC,
+                outputLimitByte=task.outputLimitByte if task.outputLimitByte > 0 else None,
+            )
+        finally:
+            proc.wait()
+            proc.stdout.close()
+            proc.stderr.close()
+
+        with os.fdopen(statusRead, "r") as statusFile:
+            statusRead = -1
+            status = statusFile.read().strip()
+    finally:
+        for fd in [statusRead, statusWrite]:
+            if fd >= 0:
+                os.close(fd)
+
+    if proc.returncode != 0 or status == "" or status.startswith("error"):
+        message = status or stderr.decode("utf-8", errors="replace")
+        return TaskResult(), Error(f"Failed to run sandbox: {message}")
+
+    exitCode, timedOut, elapsedMS, cpuTimeMS, memoryByte, oomKill = map(int, status.split())
+
+    task.Stdout = stdout.decode("utf-8", errors="replace")
+    task.Stderr = stderr.decode("utf-8", errors="replace")
+    if timedOut or outputExceeded:
+        # 途中で止めた場合、TLEは実時間の制限で止めたかどうか
+        TLE = bool(timedOut)
+    else:
+        TLE = task.isTLE(cpuTimeMS, elapsedMS)
+
+    return TaskResult(
+        exitCode=exitCode,
+        stdout=task.Stdout,
+        stderr=task.Stderr,
+        timeMS=elapsedMS,
+        memoryByte=memoryByte,
+        TLE=TLE,
+        MLE=oomKill > 0,
+        cpuTimeMS=cpuTimeMS,
+        OLE=outputExceeded,
+    ), Error("")
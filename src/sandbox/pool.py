@@ -0,0 +1,510 @@
+"""
+このプログラムでは、以下のような機能を実装する。
+* 作成・起動済みで、リソース制限もかけてあるコンテナを保持するコンテナプールContainerPool
+* イメージとリソース制限の組ごとにコンテナプールを管理するContainerPoolManager
+  (課題ごとに制限が異なるとプールが増え続けるので、しばらく使われていないものや古いものから破棄する)
+
+TaskInfo.runはテストケースごとにコンテナの作成→起動→終了待ち→削除を行うため、
+短いテストケースではコンテナの起動時間が実行時間の大半を占める。
+コンテナプールを使う場合、テストケースは待機中のコンテナにexecで投入され、
+実行後はコンテナ内の作業ディレクトリ等を掃除してから再利用する。
+"""
+
+import os
+import threading
+import time
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from docker.errors import DockerException
+from dotenv import load_dotenv
+
+from .my_error import Error
+from .docker_client import get_client, AttachedStream
+from .execute import SANDBOX_BACKEND, ContainerInfo, TaskInfo, TaskMonitor, TaskResult
+from .labels import owned_by
+
+# ロガーの設定
+logging.basicConfig(level=logging.INFO)
+test_logger = logging.getLogger("uvicorn")
+
+load_dotenv()
+
+# 待機中のコンテナで実行し続けるコマンド
+_KEEP_ALIVE_COMMAND = ["sleep", "infinity"]
+
+# 実行後に掃除する、作業ディレクトリ以外の書き込み可能なディレクトリ
+_SCRATCH_DIRS = ["/tmp", "/var/tmp", "/dev/shm"]
+
+
+@dataclass
+class PoolConfig:
+    size: int = 0  # イメージ・リソース制限の組ごとに待機させておくコンテナ数(0なら無効)
+    maxUses: int = 100  # この回数使われたコンテナは作り直す
+    healthCheckIntervalSec: float = 30.0  # 待機中のコンテナが生きているか確認する間隔
+    maxPools: int = 8  # 保持するプール(イメージ・リソース制限の組)の数の上限。超えたら最も長く使われていないものを破棄する
+    idleTimeoutSec: float = 600.0  # この時間使われていないプールは破棄する(0なら破棄しない)
+
+    @classmethod
+    def from_env(cls) -> "PoolConfig":
+        return cls(
+            size=int(os.getenv("SANDBOX_POOL_SIZE", "0")),
+            maxUses=int(os.getenv("SANDBOX_POOL_MAX_USES", "100")),
+            healthCheckIntervalSec=float(
+                os.getenv("SANDBOX_POOL_HEALTH_CHECK_INTERVAL_SEC", "30")
+            ),
+            maxPools=int(os.getenv("SANDBOX_POOL_MAX_KEYS", "8")),
+            idleTimeoutSec=float(os.getenv("SANDBOX_POOL_IDLE_TIMEOUT_SEC", "600")),
+        )
+
+
+# コンテナプールのキー(コンテナ作成時に決まる設定の組)
+@dataclass(frozen=True)
+class PoolKey:
+    name: str  # コンテナイメージ名
+    cpus: int
+    memoryLimitMB: int
+    stackLimitKB: int
+    pidsLimit: int
+    enableNetwork: bool
+    workDir: str
+    cpuTimeLimitSec: int  # RLIMIT_CPUはコンテナ作成時にしかかけられないので、キーに含める
+
+    @classmethod
+    def of(cls, task: TaskInfo) -> "PoolKey":
+        return cls(
+            name=task.name,
+            cpus=task.cpus,
+            memoryLimitMB=task.memoryLimitMB,
+            stackLimitKB=task.stackLimitKB,
+            pidsLimit=task.pidsLimit,
+            enableNetwork=bool(task.enableNetwork),
+            workDir=task.workDir,
+            cpuTimeLimitSec=task.cpuTimeLimitSec(),
+        )
+
+
+@dataclass
+class PooledContainer:
+    containerInfo: ContainerInfo
+    keepAlivePid: str  # 待機用プロセスのPID(掃除の際に殺さないようにする)
+    initialDiff: frozenset[str]  # 起動直後のイメージからの差分
+    cpusetCpus: str = ""  # 現在設定しているコア(空なら作成時のまま)
+    uses: int = 0
+    lastHealthCheck: float = field(default_factory=time.monotonic)
+
+
+# 同じイメージ・リソース制限のコンテナを保持するプール
+class ContainerPool:
+    key: PoolKey
+    config: PoolConfig
+    lastUsed: float  # 最後にacquireされた時刻(一度もされていなければ作成した時刻)
+    _idle: list[PooledContainer]
+    _lock: threading.Lock
+    _replenishing: bool
+    _closed: bool  # shutdown後は、返却・作成されたコンテナを保持せずに破棄する
+
+    def __init__(self, key: PoolKey, config: PoolConfig):
+        self.key = key
+        self.config = config
+        self.lastUsed = time.monotonic()
+        self._idle = []
+        self._lock = threading.Lock()
+        self._replenishing = False
+        self._closed = False
+
+    def acquire(self) -> tuple[PooledContainer | None, Error]:
+        self.lastUsed = time.monotonic()
+        while True:
+            with self._lock:
+                container = self._idle.pop() if self._idle else None
+            if container is None:
+                # 待機中のコンテナが無ければその場で作る
+                container, err = self.__spawn()
+                self.replenish()
+                return container, err
+            if self.__is_healthy(container):
+                self.replenish()
+                return container, Error.Nothing()
+            self.__discard(container)
+
+    def release(self, container: PooledContainer) -> None:
+        container.uses += 1
+        if container.uses >= self.config.maxUses or not self.__reset(container):
+            self.__discard(container)
+            self.replenish()
+            return
+        with self._lock:
+            if not self._closed and len(self._idle) < self.config.size:
+                self._idle.append(container)
+                return
+        self.__discard(container)
+
+    def discard(self, container: PooledContainer) -> None:
+        self.__discard(container)
+        self.replenish()
+
+    # 待機中のコンテナがconfig.size個になるまで、バックグラウンドで作成する
+    def replenish(self) -> None:
+        with self._lock:
+            if self._closed or self._replenishing or len(self._idle) >= self.config.size:
+                return
+            self._replenishing = True
+        threading.Thread(target=self.__replenish, daemon=True).start()
+
+    def shutdown(self) -> None:
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for container in idle:
+            self.__discard(container)
+
+    def __replenish(self) -> None:
+        try:
+            while True:
+                with self._lock:
+                    if self._closed or len(self._idle) >= self.config.size:
+                        return
+                container, err = self.__spawn()
+                if not err.silence():
+                    test_logger.info(f"failed to replenish container pool: {err}")
+                    return
+                with self._lock:
+                    if not self._closed:
+                        self._idle.append(container)
+                        continue
+                # 作成中にプールが破棄された
+                self.__discard(container)
+                return
+        finally:
+            with self._lock:
+                self._replenishing = False
+
+    def __spawn(self) -> tuple[PooledContainer | None, Error]:
+        containerInfo = ContainerInfo("")
+        # 待機コンテナは提出をまたいで使い回すので、提出に属さないリソースとして作成する
+        with owned_by(""):
+            err = containerInfo.create(
+                containerName=self.key.name,
+                arguments=_KEEP_ALIVE_COMMAND,
+                cpus=self.key.cpus,
+                memoryLimitMB=self.key.memoryLimitMB,
+                stackLimitKB=self.key.stackLimitKB,
+                pidsLimit=self.key.pidsLimit,
+                enableNetwork=self.key.enableNetwork,
+                enableLoggingDriver=False,
+                workDir=self.key.workDir,
+                volumeMountInfo=[],
+                # ulimitはexecしたプロセスにも引き継がれ、CPU時間はプロセスごとに数えられる
+                cpuTimeLimitSec=self.key.cpuTimeLimitSec,
+            )
+        if not err.silence():
+            return None, err
+
+        client = get_client()
+        try:
+            client.start(containerInfo.containerID)
+            # --initで起動しているので、PID 1はinit、その子が待機用プロセスになる
+            exit_code, output, err = _exec(
+                containerInfo, ["cat", "/proc/1/task/1/children"]
+            )
+            if not err.silence() or exit_code != 0:
+                raise DockerException(f"failed to find keep-alive process: {output}")
+            initialDiff = _diff_paths(containerInfo)
+        except DockerException as e:
+            _remove(containerInfo)
+            return None, Error(f"Failed to start pooled container: {e}")
+
+        return PooledContainer(
+            containerInfo=containerInfo,
+            keepAlivePid=output.split()[0],
+            initialDiff=initialDiff,
+        ), Error.Nothing()
+
+    def __is_healthy(self, container: PooledContainer) -> bool:
+        now = time.monotonic()
+        if now - container.lastHealthCheck < self.config.healthCheckIntervalSec:
+            return True
+        try:
+            state = get_client().inspect_container(container.containerInfo.containerID)
+        except DockerException:
+            return False
+        container.lastHealthCheck = now
+        return bool(state["State"]["Running"])
+
+    # 残っているプロセスを全て殺し、作業ディレクトリ等を空にする
+    def __reset(self, container: PooledContainer) -> bool:
+        dirs = " ".join([self.key.workDir] + _SCRATCH_DIRS)
+        script = (
+            f'keep=" 1 $$ {container.keepAlivePid} "; '
+            'for p in /proc/[0-9]*; do pid=${p#/proc/}; '
+            'case "$keep" in *" $pid "*) ;; *) kill -9 "$pid" 2>/dev/null;; esac; done; '
+            f"for d in {dirs}; do [ -d \"$d\" ] && find \"$d\" -mindepth 1 -delete; done; true"
+        )
+        exit_code, output, err = _exec(container.containerInfo, ["sh", "-c", script])
+        if not err.silence() or exit_code != 0:
+            test_logger.info(f"failed to reset pooled container: {err} {output}")
+            return False
+
+        # 掃除した場所以外に変更が残っていたら、そのコンテナは使い回さない
+        try:
+            diff = _diff_paths(container.containerInfo)
+        except DockerException:
+            return False
+        allowed = [self.key.workDir.rstrip("/")] + _SCRATCH_DIRS
+        for path in diff - container.initialDiff:
+            if not any(path == a or path.startswith(a + "/") for a in allowed):
+                test_logger.info(f"pooled container was modified outside workdir: {path}")
+                return False
+        container.lastHealthCheck = time.monotonic()
+        return True
+
+    def __discard(self, container: PooledContainer) -> None:
+        _remove(container.containerInfo)
+
+
+# イメージ・リソース制限ごとのコンテナプールを管理する
+class ContainerPoolManager:
+    _config: PoolConfig | None
+    _pools: OrderedDict[PoolKey, ContainerPool]  # 最後に使われた順(最も長く使われていないものが先頭)
+    _lock: threading.Lock
+    _peakResetWarned: bool  # memory.peakをリセットできないことを既にログに出したかどうか
+
+    def __init__(self, config: PoolConfig | None = None):
+        self._config = config
+        self._pools = OrderedDict()
+        self._lock = threading.Lock()
+        self._peakResetWarned = False
+
+    @property
+    def config(self) -> PoolConfig:
+        # 環境変数は.envの読み込み後に参照する
+        if self._config is None:
+            self._config = PoolConfig.from_env()
+        return self._config
+
+    def enabled(self) -> bool:
+        # 待機させておけるのはDockerコンテナだけなので、namespaceバックエンドでは使わない
+        return self.config.size > 0 and SANDBOX_BACKEND == "docker"
+
+    def prewarm(self, task: TaskInfo) -> None:
+        # taskと同じイメージ・リソース制限のコンテナを事前に作成しておく
+        if self.enabled():
+            self.pool(PoolKey.of(task)).replenish()
+
+    def run(
+        self,
+        task: TaskInfo,
+        workDirArchive: bytes,
+        extraFiles: list[tuple[Path, Path]] | None = None,
+    ) -> tuple[TaskResult, Error]:
+        """
+        プール内のコンテナでタスクを実行します。
+
+        Args:
+            task: 実行するタスク(volumeMountInfoは使われない)
+            workDirArchive: 作業ディレクトリに展開するtarアーカイブ(Volume.archive()の戻り値)
+            extraFiles: 追加でコピーするファイルの(ホスト上のパス, 作業ディレクトリからの相対パス)のリスト
+
+        Returns:
+            tuple[TaskResult, Error]: TaskInfo.run()と同じ形式の実行結果
+        """
+        pool = self.pool(PoolKey.of(task))
+        container, err = pool.acquire()
+        if not err.silence():
+            return TaskResult(), err
+
+        containerInfo = container.containerInfo
+        client = get_client()
+        workDir = Path(task.workDir)
+
+        try:
+            # 作業ディレクトリの内容を展開
+            client.put_archive(containerInfo.containerID, str(workDir.parent), workDirArchive)
+        except DockerException as e:
+            pool.discard(container)
+            return TaskResult(), Error(f"Failed to stage workdir: {e}")
+        for srcInHost, dstInWorkDir in extraFiles or []:
+            err = containerInfo.copyFile(srcInHost, workDir / dstInWorkDir)
+            if not err.silence():
+                pool.discard(container)
+                return TaskResult(), err
+
+        # 割り当てられたコアは実行のたびに変わるので、コンテナを作り直さずにcpusetだけ変更する
+        if task.cpusetCpus != "" and task.cpusetCpus != container.cpusetCpus:
+            try:
+                client.update_container(containerInfo.containerID, cpuset_cpus=task.cpusetCpus)
+            except DockerException as e:
+                pool.discard(container)
+                return TaskResult(), Error(f"Failed to set cpuset: {e}")
+            container.cpusetCpus = task.cpusetCpus
+
+        result, err, reusable = self.__exec_task(task, containerInfo)
+        if reusable:
+            pool.release(container)
+        else:
+            pool.discard(container)
+        return result, err
+
+    def shutdown(self) -> None:
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), OrderedDict()
+        for pool in pools:
+            pool.shutdown()
+
+    def keys(self) -> list[PoolKey]:
+        # 保持しているプールのキー(最も長く使われていないものが先頭)
+        with self._lock:
+            return list(self._pools)
+
+    def pool(self, key: PoolKey) -> ContainerPool:
+        # keyのプールを取得する(無ければ作成し、最後に使われたものとして扱う)
+        now = time.monotonic()
+        evicted: list[ContainerPool] = []
+        with self._lock:
+            if key not in self._pools:
+                self._pools[key] = ContainerPool(key, self.config)
+            self._pools.move_to_end(key)
+            pool = self._pools[key]
+
+            # 待機中のコンテナは課題の数×SANDBOX_POOL_SIZEまで増えうるので、
+            # しばらく使われていないプールと、上限を超えた分の古いプールを破棄する
+            for other in list(self._pools.values())[:-1]:
+                if (
+                    len(self._pools) > max(self.config.maxPools, 1)
+                    or 0 < self.config.idleTimeoutSec <= now - other.lastUsed
+                ):
+                    evicted.append(self._pools.pop(other.key))
+        for other in evicted:
+            test_logger.info(f"evict container pool: {other.key}")
+            other.shutdown()
+        return pool
+
+    def __exec_task(
+        self, task: TaskInfo, containerInfo: ContainerInfo
+    ) -> tuple[TaskResult, Error, bool]:
+        client = get_client()
+
+        timeout = task.wallTimeout()
+
+        taskMonitor = TaskMonitor(containerInfo)
+        try:
+            execID = client.exec_create(
+                containerInfo.containerID,
+                task.arguments,
+                stdin=True,
+                workdir=task.workDir,
+                environment=task.environment or None,
+            )["Id"]
+            # コンテナは使い回しているので、これまでの実行での最大メモリ使用量はリセットする
+            taskMonitor.start()
+            taskMonitor.attach(resetPeak=True)
+            stream = AttachedStream(client.exec_start(execID, socket=True))
+        except DockerException as e:
+            taskMonitor.end()
+            return TaskResult(), Error(f"Failed to exec in pooled container: {e}"), False
+
+        try:
+            stdout, stderr, timedOut, outputExceeded = stream.communicate(
+                task.Stdin.encode("utf-8"),
+                deadline=time.monotonic() + timeout,
+                watchers=taskMonitor.watchers(),
+                outputLimitByte=task.outputLimitByte if task.outputLimitByte > 0 else None,
+            )
+        except OSError as e:
+            taskMonitor.end()
+            return TaskResult(), Error(f"Failed to exec in pooled container: {e}"), False
+        finally:
+            stream.close()
+        taskMonitor.end()
+
+        timeMS = int(taskMonitor.get_elapsed_time_ms())
+        memoryByte = taskMonitor.get_used_memory_byte()
+        oomKilled = taskMonitor.is_oom_killed()
+        cpuTimeMS = taskMonitor.get_cpu_time_ms()
+
+        task.Stdout = stdout.decode("utf-8", errors="replace")
+        task.Stderr = stderr.decode("utf-8", errors="replace")
+
+        if timedOut or outputExceeded:
+            # execしたプロセスはAPIから止められないので、コンテナごと破棄する
+            return TaskResult(
+                stdout=task.Stdout,
+                stderr=task.Stderr,
+                TLE=timedOut,
+                OLE=outputExceeded,
+                timeMS=timeMS,
+                memoryByte=memoryByte,
+                MLE=oomKilled,
+                cpuTimeMS=cpuTimeMS,
+            ), Error.Nothing(), False
+
+        exit_code, err = _wait_exec(execID)
+        if not err.silence():
+            return TaskResult(), err, False
+
+        # memory.peakをリセットできないカーネル(Linux 6.12より前)では、次の実行で前の実行の最大値が
+        # 読めてしまうので、コンテナは1回だけ使って作り直す
+        peakResetFailed = taskMonitor.peak_reset_failed()
+        if peakResetFailed and not self._peakResetWarned:
+            self._peakResetWarned = True
+            test_logger.warning(
+                "memory.peak cannot be reset on this kernel (requires Linux 6.12+); "
+                "pooled containers are recreated after every run"
+            )
+
+        return TaskResult(
+            exitCode=exit_code,
+            stdout=task.Stdout,
+            stderr=task.Stderr,
+            timeMS=timeMS,
+            memoryByte=memoryByte,
+            TLE=task.isTLE(cpuTimeMS, timeMS),
+            MLE=oomKilled,
+            cpuTimeMS=cpuTimeMS,
+        ), Error.Nothing(), not oomKilled and not peakResetFailed
+
+
+# 標準入力無しでコマンドをexecし、戻り値と(標準出力+標準エラー出力)を返す
+def _exec(containerInfo: ContainerInfo, command: list[str]) -> tuple[int, str, Error]:
+    client = get_client()
+    try:
+        execID = client.exec_create(containerInfo.containerID, command)["Id"]
+        output = client.exec_start(execID)
+    except DockerException as e:
+        return -1, "", Error(f"Failed to exec: {e}")
+    exit_code, err = _wait_exec(execID)
+    return exit_code, output.decode("utf-8", errors="replace"), err
+
+
+# execしたプロセスの終了を待ち、戻り値を返す
+def _wait_exec(execID: str) -> tuple[int, Error]:
+    client = get_client()
+    # 出力のEOFとプロセスの終了は同時とは限らないので、終了するまで確認する
+    for _ in range(200):
+        try:
+            info = client.exec_inspect(execID)
+        except DockerException as e:
+            return -1, Error(f"Failed to inspect exec: {e}")
+        if not info["Running"]:
+            return int(info["ExitCode"]), Error.Nothing()
+        time.sleep(0.005)
+    return -1, Error(f"exec did not finish: {execID}")
+
+
+def _diff_paths(containerInfo: ContainerInfo) -> frozenset[str]:
+    changes = get_client().diff(containerInfo.containerID) or []
+    return frozenset(change["Path"] for change in changes)
+
+
+def _remove(containerInfo: ContainerInfo) -> None:
+    try:
+        get_client().remove_container(containerInfo.containerID, force=True)
+    except DockerException as e:
+        test_logger.info(f"failed to remove pooled container: {e}")
+
+
+# ジャッジサーバー全体で共有するコンテナプール
+container_pool = ContainerPoolManager()
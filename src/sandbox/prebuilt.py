@@ -0,0 +1,136 @@
+"""
+このプログラムでは、問題ごとに配置するソースコードを事前にコンパイルしておく機能を実装する。
+* 配置するソースコードのオブジェクトファイルを作り、tarアーカイブとして返す関数prebuiltObjects
+
+配置するファイル(ArrangedFiles)は問題ごとに同じなので、そのMakefileで"<名前>.o"をmakeしておく。
+提出ごとの作業ディレクトリにソースコードより新しいオブジェクトファイルを置いておけば、
+makeはそれを使い、提出されたファイルだけをコンパイルする。
+オブジェクトファイルは、配置するファイルの内容とコンパイラのイメージのIDをキーにCompileCacheに保存する。
+"""
+
+import os
+import tarfile
+import threading
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+from .my_error import Error
+from .ccache import withCcache
+from .compile_cache import CompileCache, _strip_top_directory, compileCacheKey, compile_cache
+from .execute import TaskInfo, Volume, VolumeMountInfo, test_logger
+
+load_dotenv()
+
+# trueなら、配置するソースコードを問題ごとに1回だけコンパイルしておく
+PREBUILT_OBJECTS = os.getenv("SANDBOX_PREBUILT_OBJECTS", "true").lower() == "true"
+
+# 事前にコンパイルするソースコードの拡張子
+SOURCE_SUFFIXES = {".c", ".cc", ".cpp", ".cxx"}
+# makeが読むMakefileの名前(いずれかが配置するファイルに無ければ、事前にコンパイルしない)
+MAKEFILE_NAMES = {"GNUmakefile", "makefile", "Makefile"}
+
+# ソースコード1つあたりのコンパイルの制限時間
+_TIMEOUT_SEC_PER_OBJECT = 5.0
+
+_key_locks: dict[str, threading.Lock] = {}
+_key_locks_lock = threading.Lock()
+
+
+def objectTargets(arrangedFiles: list[Path]) -> list[str]:
+    """
+    配置するファイルのうち、事前にコンパイルするもののオブジェクトファイル名のリストを返します。
+    """
+    if not any(path.name in MAKEFILE_NAMES for path in arrangedFiles):
+        return []
+    return sorted(
+        path.with_suffix(".o").name
+        for path in arrangedFiles
+        if path.suffix in SOURCE_SUFFIXES
+    )
+
+
+def _build(
+    image: str, arrangedFiles: list[Path], targets: list[str], cpusetCpus: str
+) -> tuple[bytes, Error]:
+    volume, err = Volume.create()
+    if err.message != "":
+        return b"", err
+
+    try:
+        err = volume.copyFiles(arrangedFiles)
+        if err.message != "":
+            return b"", err
+
+        # 提出されるファイルに依存してmakeできないものは作らない(提出ごとにコンパイルされる)
+        task = TaskInfo(
+            name=image,
+            arguments=[
+                "sh",
+                "-c",
+                'for target in "$@"; do make "$target" || rm -f "$target"; done',
+                "sh",
+            ]
+            + targets,
+            workDir="/workdir/",
+            volumeMountInfo=[VolumeMountInfo(path="/workdir/", volume=volume)],
+            timeoutSec=_TIMEOUT_SEC_PER_OBJECT * len(targets),
+            memoryLimitMB=512,
+            cpusetCpus=cpusetCpus,
+        )
+        err = withCcache(task)
+        if err.message != "":
+            test_logger.info(f"prebuild without ccache: {err.message}")
+        result, err = task.run()
+        if err.message != "":
+            return b"", err
+        if result.TLE or result.MLE:
+            return b"", Error(f"failed to prebuild objects: {result.stderr}")
+
+        archive, err = volume.archive("/workdir/")
+        if err.message != "":
+            return b"", err
+        try:
+            return _strip_top_directory(archive, keep=set(targets)), Error("")
+        except tarfile.TarError as e:
+            return b"", Error(f"Failed to read volume archive: {e}")
+    finally:
+        volume.remove()
+
+
+def prebuiltObjects(
+    image: str,
+    arrangedFiles: list[Path],
+    cpusetCpus: str = "",
+    cache: CompileCache = compile_cache,
+) -> tuple[bytes | None, Error]:
+    """
+    配置するソースコードをコンパイルしたオブジェクトファイルのtarアーカイブを返します。
+    (アーカイブ内のパスは作業ディレクトリからの相対パス)
+    事前にコンパイルしない場合はNoneを返します。
+    """
+    targets = objectTargets(arrangedFiles)
+    if not PREBUILT_OBJECTS or not cache.enabled() or len(targets) == 0:
+        return None, Error("")
+
+    key, err = compileCacheKey(image=image, inputFiles=arrangedFiles, kind="prebuilt-objects")
+    if err.message != "":
+        return None, err
+
+    # 同じ問題の提出が同時に来ても、コンパイルは1回だけ行う
+    with _key_locks_lock:
+        lock = _key_locks.setdefault(key, threading.Lock())
+    with lock:
+        archive = cache.lookup(key)
+        if archive is not None:
+            return archive, Error("")
+
+        archive, err = _build(image, arrangedFiles, targets, cpusetCpus)
+        if err.message != "":
+            return None, err
+        # 作れなかった場合も空のアーカイブを保存して、提出ごとに試さないようにする
+        err = cache.store(key, archive)
+        if err.message != "":
+            test_logger.info(err.message)
+        test_logger.info(f"prebuilt objects for {image}: {targets}")
+        return archive, Error("")
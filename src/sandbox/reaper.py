@@ -0,0 +1,140 @@
+"""
+このプログラムでは、削除されずに残ったsandboxのリソースを削除する機能を実装する。
+* ラベル(labels.py)を元に、生きているジャッジに属さないコンテナ・ボリュームを削除する関数reap_orphans
+
+次のいずれかに当てはまるリソースを孤児とみなす(作成からgraceSec以内のものは除く)。
+* 生きていないインスタンス(落ちた・再起動したプロセス)が作成したもの
+  生存の報告が遅れているだけのインスタンスもあるので、作成からunknownInstanceGraceSecが経ったものに限る
+* 生きているインスタンスが作成したが、既に終わった提出に属するもの(liveSubmissionIdsに無いもの)
+  ただし他のインスタンスの提出の状態は分からないので、これは自分のインスタンスのものに限る
+提出に属さないリソース(コンテナプール等)は、作成したインスタンスが生きている間は削除しない。
+"""
+
+import os
+import time
+import logging
+from dataclasses import dataclass
+
+from docker.errors import DockerException, NotFound
+from dotenv import load_dotenv
+
+from .docker_client import get_client
+from .labels import (
+    INSTANCE_ID,
+    LABEL_CREATED_AT,
+    LABEL_INSTANCE,
+    LABEL_MANAGED,
+    LABEL_SUBMISSION,
+)
+
+# ロガーの設定
+logging.basicConfig(level=logging.INFO)
+test_logger = logging.getLogger("uvicorn")
+
+load_dotenv()
+
+# 孤児を探す間隔[秒]
+REAPER_INTERVAL_SEC = float(os.getenv("SANDBOX_REAPER_INTERVAL_SEC", "300"))
+# 作成直後のリソース(ジャッジの登録前に作られたもの等)を削除しないための猶予[秒]
+REAPER_GRACE_SEC = float(os.getenv("SANDBOX_REAPER_GRACE_SEC", "60"))
+
+
+@dataclass
+class ReapResult:
+    containers: int = 0  # 削除したコンテナの数
+    volumes: int = 0  # 削除したボリュームの数
+
+
+def _is_orphan(
+    labels: dict[str, str],
+    liveSubmissionIds: set[str],
+    liveInstances: set[str],
+    now: float,
+    graceSec: float,
+    unknownInstanceGraceSec: float,
+) -> bool:
+    try:
+        createdAt = float(labels.get(LABEL_CREATED_AT, "0"))
+    except ValueError:
+        createdAt = 0.0
+    if now - createdAt < graceSec:
+        return False
+
+    instance = labels.get(LABEL_INSTANCE, "")
+    if instance not in liveInstances:
+        return now - createdAt >= unknownInstanceGraceSec
+
+    submissionId = labels.get(LABEL_SUBMISSION, "")
+    return instance == INSTANCE_ID and submissionId != "" and submissionId not in liveSubmissionIds
+
+
+def reap_orphans(
+    liveSubmissionIds: set[str],
+    liveInstances: set[str] | None = None,
+    graceSec: float = REAPER_GRACE_SEC,
+    unknownInstanceGraceSec: float | None = None,
+) -> ReapResult:
+    """
+    生きているジャッジに属さないコンテナ・ボリュームを削除します。
+
+    Args:
+        liveSubmissionIds: このプロセスで実行中の提出のID
+        liveInstances: 生きているインスタンスのID。Noneならこのプロセスだけ
+        graceSec: 作成からこの秒数以内のリソースは削除しない
+        unknownInstanceGraceSec: liveInstancesに無いインスタンスのリソースは、作成からこの秒数以内なら削除しない。
+            NoneならgraceSecと同じ
+
+    Returns:
+        ReapResult: 削除したコンテナ・ボリュームの数
+    """
+    if liveInstances is None:
+        liveInstances = {INSTANCE_ID}
+    if unknownInstanceGraceSec is None:
+        unknownInstanceGraceSec = graceSec
+    client = get_client()
+    now = time.time()
+    result = ReapResult()
+
+    # ボリュームはコンテナにマウントされていると削除できないので、コンテナを先に削除する
+    try:
+        containers = client.containers(all=True, filters={"label": LABEL_MANAGED})
+    except DockerException as e:
+        test_logger.info(f"failed to list containers: {e}")
+        containers = []
+    for container in containers:
+        if not _is_orphan(
+            container.get("Labels") or {}, liveSubmissionIds, liveInstances, now, graceSec, unknownInstanceGraceSec
+        ):
+            continue
+        try:
+            client.remove_container(container["Id"], force=True)
+            result.containers += 1
+        except NotFound:
+            pass
+        except DockerException as e:
+            test_logger.info(f"failed to remove orphan container {container['Id']}: {e}")
+
+    try:
+        volumes = client.volumes(filters={"label": LABEL_MANAGED}).get("Volumes") or []
+    except DockerException as e:
+        test_logger.info(f"failed to list volumes: {e}")
+        volumes = []
+    for volume in volumes:
+        if not _is_orphan(
+            volume.get("Labels") or {}, liveSubmissionIds, liveInstances, now, graceSec, unknownInstanceGraceSec
+        ):
+            continue
+        try:
+            client.remove_volume(volume["Name"])
+            result.volumes += 1
+        except NotFound:
+            pass
+        except DockerException as e:
+            # まだ使われている(overlayの下位層等)場合は、次の機会に削除する
+            test_logger.info(f"failed to remove orphan volume {volume['Name']}: {e}")
+
+    if result.containers > 0 or result.volumes > 0:
+        test_logger.info(
+            f"reaped {result.containers} orphan containers and {result.volumes} orphan volumes"
+        )
+    return result
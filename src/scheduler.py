@@ -0,0 +1,140 @@
+"""
+このプログラムでは、キューにあるジャッジリクエストから次に実行するものを選ぶスケジューラを実装する。
+* 学生のフォーマットチェック(batch_id IS NULL)を、バッチ採点(BatchSubmission)より優先する
+* 同じ優先度の中では、授業ごと・バッチごとに重みに比例した件数ずつ実行する(stride scheduling)
+* 待ち時間がJUDGE_SCHED_MAX_WAIT_SECを超えたリクエストは、優先度や重みに関わらず先に実行する
+  ただし、そうして実行するのは実行する件数のJUDGE_SCHED_OVERDUE_SHAREの割合まで
+
+大きなバッチ採点がキューに積まれていても、学生のフォーマットチェックはすぐに実行される。
+バッチ採点も、待ち時間の上限を超えたものから少しずつ実行されるので止まり続けることはない。
+待ち時間の上限を超えたバッチ採点が大量にあっても、フォーマットチェックの枠がそれで埋まることはない。
+"""
+
+import os
+from collections import deque
+
+from dotenv import load_dotenv
+
+from db.crud import QueuedJudgeRecord
+
+load_dotenv()
+
+# 優先度の高い順
+INTERACTIVE = "interactive"  # 学生のフォーマットチェック(batch_id IS NULL)
+BATCH = "batch"  # バッチ採点
+PRIORITY_CLASSES = [INTERACTIVE, BATCH]
+
+
+def parse_weights(spec: str) -> dict[int, float]:
+    """
+    "<ID>:<重み>"をカンマで区切った文字列を辞書にします。
+    e.g., "1:4,3:0.5" -> {1: 4.0, 3: 0.5}
+    """
+    weights: dict[int, float] = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if item == "":
+            continue
+        key, sep, value = item.partition(":")
+        if not sep or float(value) <= 0:
+            raise ValueError(f"invalid weight: {item}")
+        weights[int(key)] = float(value)
+    return weights
+
+
+def _group(candidate: QueuedJudgeRecord) -> tuple[str, int]:
+    # フォーマットチェックは授業ごと、バッチ採点はバッチごとに公平に実行する
+    if candidate.batch_id is None:
+        return INTERACTIVE, candidate.lecture_id
+    return BATCH, candidate.batch_id
+
+
+class JudgeScheduler:
+    maxWaitSec: int  # これ以上待っているリクエストは優先度に関わらず先に実行する(0なら無効)
+    overdueShare: float  # 待ち時間の上限を超えたリクエストを先に実行する枠の、実行する件数に対する割合
+    lectureWeights: dict[int, float]  # 授業IDごとのフォーマットチェックの重み(無ければ1)
+    batchWeights: dict[int, float]  # バッチIDごとの重み(無ければ1)
+    _pass: dict[tuple[str, int], float]  # グループごとの、これまでに実行した件数/重み
+    _virtualTime: float  # 最後に選んだグループのpass(新しく来たグループはここから始める)
+    _overdueCredit: float  # 待ち時間の上限を超えたリクエストを先に実行できる件数(1以上で1件実行できる)
+
+    def __init__(
+        self,
+        maxWaitSec: int = 600,
+        overdueShare: float = 0.1,
+        lectureWeights: dict[int, float] | None = None,
+        batchWeights: dict[int, float] | None = None,
+    ):
+        self.maxWaitSec = maxWaitSec
+        self.overdueShare = overdueShare
+        self.lectureWeights = lectureWeights or {}
+        self.batchWeights = batchWeights or {}
+        self._pass = {}
+        self._virtualTime = 0.0
+        self._overdueCredit = 1.0
+
+    @classmethod
+    def from_env(cls) -> "JudgeScheduler":
+        return cls(
+            maxWaitSec=int(os.getenv("JUDGE_SCHED_MAX_WAIT_SEC", "600")),
+            overdueShare=float(os.getenv("JUDGE_SCHED_OVERDUE_SHARE", "0.1")),
+            lectureWeights=parse_weights(os.getenv("JUDGE_SCHED_LECTURE_WEIGHTS", "")),
+            batchWeights=parse_weights(os.getenv("JUDGE_SCHED_BATCH_WEIGHTS", "")),
+        )
+
+    def _weight(self, group: tuple[str, int]) -> float:
+        priority_class, group_id = group
+        if priority_class == INTERACTIVE:
+            return self.lectureWeights.get(group_id, 1.0)
+        return self.batchWeights.get(group_id, 1.0)
+
+    def _charge(self, group: tuple[str, int]) -> None:
+        self._virtualTime = max(self._virtualTime, self._pass[group])
+        self._pass[group] += 1.0 / self._weight(group)
+
+    def select(self, candidates: list[QueuedJudgeRecord], n: int) -> list[QueuedJudgeRecord]:
+        """
+        candidatesから、次に実行するリクエストを実行する順に最大n件選びます。
+        """
+        if n <= 0:
+            return []
+        candidates = sorted(candidates, key=lambda candidate: candidate.id)
+
+        # しばらくキューに無かったグループが、その間の分をまとめて実行しないようにする
+        self._pass = {
+            group: max(self._pass.get(group, self._virtualTime), self._virtualTime)
+            for group in map(_group, candidates)
+        }
+
+        # 待ち時間の上限を超えたものは、古い順に先に実行する
+        # (全部を先に実行すると、上限を超えたバッチ採点が溜まっている間フォーマットチェックが止まるので、
+        # 実行する件数のoverdueShareの割合までにする)
+        selected: list[QueuedJudgeRecord] = []
+        if self.maxWaitSec > 0:
+            for candidate in candidates:
+                if len(selected) >= n or self._overdueCredit < 1.0:
+                    break
+                if candidate.wait_sec >= self.maxWaitSec:
+                    selected.append(candidate)
+                    self._charge(_group(candidate))
+                    self._overdueCredit -= 1.0
+        selected_ids = {candidate.id for candidate in selected}
+
+        for priority_class in PRIORITY_CLASSES:
+            queues: dict[tuple[str, int], deque[QueuedJudgeRecord]] = {}
+            for candidate in candidates:
+                group = _group(candidate)
+                if group[0] == priority_class and candidate.id not in selected_ids:
+                    queues.setdefault(group, deque()).append(candidate)
+
+            # 実行した件数/重みが最も小さいグループから1件ずつ選ぶ
+            while len(selected) < n and queues:
+                group = min(queues, key=lambda group: (self._pass[group], group))
+                selected.append(queues[group].popleft())
+                self._charge(group)
+                if not queues[group]:
+                    del queues[group]
+
+        # 待ち時間の上限を超えたものが無い間に溜まった分を、後でまとめて使わないようにする
+        self._overdueCredit = min(1.0, self._overdueCredit + self.overdueShare * len(selected))
+        return selected
@@ -3,17 +3,46 @@
 # $ pytest --log-cli-level=INFO test_execute.py
 import pytest
 import sandbox
-from sandbox.execute import TaskInfo
+from sandbox.execute import TaskInfo, TaskResult
+from sandbox.my_error import Error
 from sandbox.execute import Volume
 from sandbox.execute import VolumeMountInfo
+from sandbox.docker_client import get_client
+from sandbox.labels import INSTANCE_ID, LABEL_CREATED_AT, LABEL_INSTANCE, LABEL_SUBMISSION, owned_by
+from sandbox.reaper import _is_orphan, reap_orphans
+from sandbox.cgroup import CgroupStatsReader
+from sandbox.cpuset import CpusetAllocator, format_cpu_list, parse_cpu_list
+import threading
+import fcntl
+import os
+import socket
+import io
+import tarfile
+from sandbox.namespace import NAMESPACE_HELPER_PATH
+from sandbox.compile_cache import CompileCache
+from sandbox.ccache import ccacheStats, withCcache
+from sandbox.prebuilt import prebuiltObjects
+from sandbox.pool import ContainerPoolManager, PoolConfig, PoolKey
+from sandbox.batch import BatchCase, BatchTaskInfo
+from sandbox.async_execute import runTask
+import asyncio
+import contextlib
+import json
 import logging
-from datetime import timedelta
+from datetime import datetime, timedelta
 from tempfile import TemporaryDirectory
 from pathlib import Path
 import time
 
 from db.crud import *
 from db.database import SessionLocal
+import judge
+from judge import JudgeInfo
+from scheduler import JudgeScheduler
+from worker import DispatchSignal, listen_wakeup
+from upload import MultipartUpload
+import progress
+from progress import DatabaseRelay, ProgressBus, batch_topic, submission_topic
 
 # ロガーの設定
 logging.basicConfig(level=logging.INFO)
@@ -43,6 +72,11 @@ def test_RunHelloWorld():
 
     assert result.stderr == ""
 
+    # 実行したコンテナは結果を読み終えた後に削除されている
+    containerID = task.taskMonitor.containerInfo.containerID
+    assert containerID != ""
+    assert get_client().containers(all=True, filters={"id": containerID}) == []
+
 
 # sandboxの戻り値をきちんとチェックできているか確かめるテスト
 def test_ExitCode():
@@ -143,6 +177,144 @@ def test_Timeout():
     assert result.TLE == True
 
 
+# TLEがCPU時間で判定されるか確かめるテスト
+def test_CpuTime():
+    # CPUを使わずに待つだけなら、制限時間を超えてもTLEにならない
+    task = TaskInfo(name="ubuntu", arguments=["sleep", "1.5"], timeoutSec=1.0)
+
+    result, err = task.run()
+
+    test_logger.info(result)
+
+    assert err.message == ""
+    assert result.TLE == False
+    assert result.timeMS >= 1500
+    assert 0 <= result.cpuTimeMS < 500
+
+    # CPUを使い続けると、CPU時間でTLEになる
+    task = TaskInfo(name="ubuntu", arguments=["sh", "-c", "while :; do :; done"], timeoutSec=1.0)
+
+    result, err = task.run()
+
+    test_logger.info(result)
+
+    assert err.message == ""
+    assert result.TLE == True
+    assert result.cpuTimeMS >= 1000
+
+
+# コアの割り当てと、割り当てたコアだけでコンテナが実行されるか確かめるテスト
+def test_CpusetAllocator():
+    allocator = CpusetAllocator(parse_cpu_list("0-2"), coresPerJob=1)
+    assert allocator.capacity() == 3
+
+    first = allocator.acquire()
+    second = allocator.acquire()
+    assert first != second
+
+    task = TaskInfo(name="ubuntu", arguments=["nproc"], cpusetCpus=format_cpu_list(first))
+    result, err = task.run()
+    assert err.message == ""
+    assert result.stdout == "1\n"
+
+    # 空きが無ければ解放されるまで待つ
+    allocator.acquire()
+    acquired = []
+    waiting = threading.Thread(target=lambda: acquired.append(allocator.acquire()))
+    waiting.start()
+    time.sleep(0.2)
+    assert acquired == []
+
+    allocator.release(second)
+    waiting.join(timeout=5)
+    assert acquired == [second]
+
+
+# 終わった提出のボリュームだけが孤児として削除されるか確かめるテスト
+def test_ReapOrphans():
+    with owned_by("test-finished"):
+        finished_volume, err = Volume.create()
+        assert err.message == ""
+    with owned_by("test-running"):
+        running_volume, err = Volume.create()
+        assert err.message == ""
+
+    result = reap_orphans({"test-running"}, graceSec=0)
+
+    assert result.volumes >= 1
+    names = [volume["Name"] for volume in get_client().volumes()["Volumes"] or []]
+    assert finished_volume.name not in names
+    assert running_volume.name in names
+
+    # 作成直後のものは猶予の間は削除されない
+    with owned_by("test-finished"):
+        new_volume, err = Volume.create()
+        assert err.message == ""
+    reap_orphans({"test-running"})
+    names = [volume["Name"] for volume in get_client().volumes()["Volumes"] or []]
+    assert new_volume.name in names
+
+    new_volume.remove()
+    running_volume.remove()
+
+
+# 生存を報告していないインスタンスのリソースが、十分に古くなるまで孤児とみなされないか確かめるテスト
+def test_ReapOrphanUnknownInstance():
+    now = time.time()
+
+    def labels(instance: str, age: float) -> dict[str, str]:
+        return {LABEL_INSTANCE: instance, LABEL_SUBMISSION: "", LABEL_CREATED_AT: str(now - age)}
+
+    live = {INSTANCE_ID}
+    # 最初の報告がまだのワーカーのコンテナプール等は、graceSecを過ぎてもすぐには削除しない
+    assert not _is_orphan(labels("other", 120), set(), live, now, graceSec=60, unknownInstanceGraceSec=300)
+    assert _is_orphan(labels("other", 400), set(), live, now, graceSec=60, unknownInstanceGraceSec=300)
+    # 生きているインスタンスの、提出に属さないリソースは削除しない
+    assert not _is_orphan(labels(INSTANCE_ID, 400), set(), live, now, graceSec=60, unknownInstanceGraceSec=300)
+
+
+# asyncio版のrunTaskでもTaskInfo.run()と同じ結果が得られるか確かめるテスト
+def test_RunTaskAsync():
+    async def run_all():
+        tasks = [
+            TaskInfo(name="ubuntu", arguments=["sh", "-c", f"cat; echo {i} >&2"], Stdin=f"hello {i}")
+            for i in range(4)
+        ]
+        return await asyncio.gather(*[runTask(task) for task in tasks])
+
+    for i, (result, err) in enumerate(asyncio.run(run_all())):
+        test_logger.info(result)
+
+        assert err.message == ""
+        assert result.exitCode == 0
+        assert result.stdout == f"hello {i}"
+        assert result.stderr == f"{i}\n"
+        assert result.TLE == False
+
+    # 締め切りを過ぎたらコンテナを止めてTLEにする
+    task = TaskInfo(name="ubuntu", arguments=["sh", "-c", "while :; do :; done"], timeoutSec=1.0)
+
+    result, err = asyncio.run(runTask(task))
+
+    assert err.message == ""
+    assert result.TLE == True
+
+
+# 出力の上限を超えたらOLEとして止められるか確かめるテスト
+def test_OutputLimit():
+    task = TaskInfo(name="ubuntu", arguments=["yes"], timeoutSec=5.0, outputLimitByte=1024)
+
+    result, err = task.run()
+
+    test_logger.info(result)
+
+    assert err.message == ""
+    assert result.OLE == True
+    assert result.TLE == False
+    assert len(result.stdout) <= 1024
+    assert result.stdout.startswith("y\ny\n")
+
+
 # ファイルをDockerボリュームにコピーするテスト
 def test_CopyFileFromClientToVolume():
     # ファイル転送先のボリュームの作成
@@ -351,6 +523,648 @@ def test_CloneVolume():
         err = cloned_volume.remove()
         assert err.message == ""
 
+# スナップショットに書き込んでも、元のボリュームが変更されないかチェック
+def test_SnapshotVolume():
+    with TemporaryDirectory() as temp_dir:
+        file1_path = Path(temp_dir) / "file1.txt"
+        with open(file1_path, "w") as f1:
+            f1.write("Content of file1")
+
+        # 元のボリュームを作成
+        original_volume, err = Volume.create()
+        assert err.message == ""
+
+        err = original_volume.copyFile(Path(file1_path), Path("file1.txt"))
+        assert err.message == ""
+
+    # スナップショットを作成
+    snapshot_volume, err = original_volume.snapshot()
+    assert err.message == ""
+
+    # スナップショットから元のファイルが読め、書き込みもできる
+    task = TaskInfo(
+        name="ubuntu",
+        arguments=["sh", "-c", "cat file1.txt && echo new > file2.txt && rm file1.txt"],
+        workDir="/workdir/",
+        volumeMountInfo=[VolumeMountInfo(path="/workdir/", volume=snapshot_volume)],
+    )
+
+    result, err = task.run()
+    assert err.message == ""
+    assert result.exitCode == 0
+    assert result.stdout == "Content of file1"
+
+    # 元のボリュームは変更されていない
+    task = TaskInfo(
+        name="ubuntu",
+        arguments=["ls"],
+        workDir="/workdir/",
+        volumeMountInfo=[VolumeMountInfo(path="/workdir/", volume=original_volume)],
+    )
+
+    result, err = task.run()
+    assert err.message == ""
+    assert result.exitCode == 0
+    assert result.stdout == "file1.txt\n"
+
+    # クリーンアップ
+    err = snapshot_volume.remove()
+    assert err.message == ""
+    err = original_volume.remove()
+    assert err.message == ""
+
+
+# コンパイル後のボリュームを保存・復元でき、上限を超えたら古いものから削除されるかチェック
+def test_CompileCache():
+    with TemporaryDirectory() as tmpdir:
+        cache = CompileCache(Path(tmpdir), maxBytes=1024 * 1024)
+
+        volume, err = Volume.create()
+        assert err.message == ""
+        task = TaskInfo(
+            name="ubuntu",
+            arguments=["sh", "-c", "mkdir -p bin && echo built > bin/a.out"],
+            workDir="/workdir/",
+            volumeMountInfo=[VolumeMountInfo(path="/workdir/", volume=volume)],
+        )
+        result, err = task.run()
+        assert err.message == "" and result.exitCode == 0
+
+        assert cache.save("key", volume).message == ""
+        volume.remove()
+
+        # 別のボリュームに復元すると、コンパイル結果が作業ディレクトリ直下に展開される
+        restored, err = Volume.create()
+        assert err.message == ""
+        assert cache.restore("key", restored)
+        assert not cache.restore("missing", restored)
+        task = TaskInfo(
+            name="ubuntu",
+            arguments=["cat", "bin/a.out"],
+            workDir="/workdir/",
+            volumeMountInfo=[VolumeMountInfo(path="/workdir/", volume=restored)],
+        )
+        result, err = task.run()
+        restored.remove()
+        assert err.message == ""
+        assert result.stdout == "built\n"
+
+        # 上限を超えたら、最後に使われてから長いものから削除される
+        cache.maxBytes = 2500
+        cache.store("old", b"x" * 1000)
+        time.sleep(0.01)
+        cache.store("new", b"x" * 1000)
+        time.sleep(0.01)
+        assert cache.lookup("old") is not None
+        time.sleep(0.01)
+        cache.store("newest", b"x" * 1000)
+        assert cache.lookup("new") is None
+        assert cache.lookup("old") is not None
+        assert cache.lookup("newest") is not None
+
+
+# 2回目のコンパイルがccacheのキャッシュから返されるかチェック
+def test_Ccache():
+    def compile_once() -> None:
+        volume, err = Volume.create()
+        assert err.message == ""
+        with TemporaryDirectory() as tmpdir:
+            source = Path(tmpdir) / "hello.c"
+            source.write_text('#include <stdio.h>\nint main(void) { puts("hello"); return 0; }\n')
+            assert volume.copyFile(source, Path("hello.c")).message == ""
+        task = TaskInfo(
+            name="checker-lang-gcc",
+            arguments=["gcc", "-c", "hello.c", "-o", "hello.o"],
+            workDir="/workdir/",
+            volumeMountInfo=[VolumeMountInfo(path="/workdir/", volume=volume)],
+        )
+        assert withCcache(task).message == ""
+        result, err = task.run()
+        volume.remove()
+        assert err.message == ""
+        assert result.exitCode == 0
+
+    compile_once()
+    before, err = ccacheStats()
+    assert err.message == ""
+    compile_once()
+    after, err = ccacheStats()
+    assert err.message == ""
+
+    hits = lambda stats: stats.get("direct_cache_hit", 0) + stats.get("preprocessed_cache_hit", 0)
+    assert hits(after) == hits(before) + 1
+
+
+# 配置するソースコードだけが事前にコンパイルされ、提出ごとのmakeでは再コンパイルされないかチェック
+def test_PrebuiltObjects():
+    with TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        (tmpdir / "Makefile").write_text("prog: prog.o lib.o\n")
+        (tmpdir / "lib.c").write_text("int answer(void) { return 42; }\n")
+        (tmpdir / "prog.c").write_text('#include <stdio.h>\nint answer(void);\nint main(void) { printf("%d\\n", answer()); return 0; }\n')
+        arranged = [tmpdir / "Makefile", tmpdir / "lib.c"]
+
+        cache = CompileCache(tmpdir / "cache", maxBytes=1024 * 1024)
+        objects, err = prebuiltObjects("checker-lang-gcc", arranged, cache=cache)
+        assert err.message == ""
+        assert tarfile.open(fileobj=io.BytesIO(objects)).getnames() == ["lib.o"]
+
+        # 2回目はキャッシュから返される
+        again, err = prebuiltObjects("checker-lang-gcc", arranged, cache=cache)
+        assert err.message == ""
+        assert again == objects
+
+        volume, err = Volume.create()
+        assert err.message == ""
+        assert volume.copyFiles([tmpdir / "prog.c"] + arranged).message == ""
+        assert volume.extractArchive(objects).message == ""
+
+    task = TaskInfo(
+        name="checker-lang-gcc",
+        arguments=["sh", "-c", "make prog && ./prog"],
+        workDir="/workdir/",
+        volumeMountInfo=[VolumeMountInfo(path="/workdir/", volume=volume)],
+    )
+    result, err = task.run()
+    volume.remove()
+    assert err.message == ""
+    assert result.exitCode == 0
+    assert "prog.c" in result.stdout
+    assert "lib.c" not in result.stdout
+    assert result.stdout.endswith("42\n")
+
+
+# DBを使わないテストで使う、中身の無いジャッジ用テストケース
+def _testcase(id: int) -> TestCaseRecord:
+    return TestCaseRecord(id=id, lecture_id=1, assignment_id=1, for_evaluation=False, type=TestCaseType.Judge,
+                          description=None, score=None, script_path=None, argument_path=None, stdin_path=None,
+                          stdout_path="", stderr_path="", exit_code=0)
+
+
+# テストケースを並列に実行しても、結果がテストケースの順番で返されるかチェック
+def test_ParallelTestcases():
+    # DBを使わずに、テストケースの実行部分だけを試す
+    judge_info = JudgeInfo.__new__(JudgeInfo)
+    judge_info.cpuset = ""
+
+    def run_testcase(testcase, args, stdin, **kwargs):
+        time.sleep(0.5 if testcase.id % 2 == 0 else 0.1)
+        return TaskResult(exitCode=testcase.id), Error.Nothing()
+
+    judge_info._run_testcase = run_testcase
+    testcases = [
+        (_testcase(i), [], "", "", "")
+        for i in range(4)
+    ]
+
+    start = time.monotonic()
+    results = judge_info._run_testcases(testcases, parallel=True)
+    elapsed = time.monotonic() - start
+
+    assert [result.exitCode for result, _ in results] == [0, 1, 2, 3]
+    assert elapsed < 1.0
+
+
+# fail-fastで結果を読むのをやめたら、残りのテストケースが実行されないかチェック
+def test_FailFastStopsTestcases():
+    judge_info = JudgeInfo.__new__(JudgeInfo)
+    judge_info.cpuset = ""
+    executed = []
+
+    def run_testcase(testcase, args, stdin, **kwargs):
+        executed.append(testcase.id)
+        return TaskResult(exitCode=testcase.id), Error.Nothing()
+
+    judge_info._run_testcase = run_testcase
+    testcases = [
+        (_testcase(i), [], "", "", "")
+        for i in range(4)
+    ]
+
+    results = judge_info._run_testcases(testcases, parallel=False)
+    result, err = next(results)
+    results.close()
+
+    assert result.exitCode == 0
+    assert executed == [0]
+
+
+# バッチ実行が有効でも、fail-fastならAC以外の結果が出た後のテストケースが実行されないかチェック
+def test_FailFastSkipsBatch(monkeypatch):
+    monkeypatch.setattr(judge, "BATCH_JUDGE", True)
+    judge_info = JudgeInfo.__new__(JudgeInfo)
+    judge_info.cpuset = ""
+    executed = []
+    skipped = []
+
+    class ArchivedVolume:
+        def archive(self):
+            return b"", Error.Nothing()
+
+    def run_batch(**kwargs):
+        executed.append("batch")
+        return [], Error("batch should not be used")
+
+    def run_testcase(testcase, args, stdin, **kwargs):
+        executed.append(testcase.id)
+        return TaskResult(exitCode=1), Error.Nothing()
+
+    judge_info._load_testcase = lambda testcase: ([], "", "", "", Error.Nothing())
+    judge_info._run_batch = run_batch
+    judge_info._run_testcase = run_testcase
+    judge_info._result_check_and_register = lambda **kwargs: JudgeSummaryStatus.WA
+    judge_info._register_skipped = lambda db, testcase: skipped.append(testcase.id)
+    testcases = [_testcase(i) for i in range(4)]
+
+    status = judge_info._exec_checker(
+        testcase_list=testcases, initial_volume=ArchivedVolume(), container_name="binary-runner",
+        timeoutSec=1.0, memoryLimitMB=256, batch=True, parallel=False, fail_fast=True,
+    )
+
+    assert status == JudgeSummaryStatus.WA
+    assert executed == [0]
+    assert skipped == [1, 2, 3]
+
+
+# フォーマットチェックがバッチ採点より先に選ばれ、授業ごとに重みに比例して選ばれ、待ち時間の上限を超えたものが先に選ばれるかチェック
+def test_JudgeScheduler():
+    scheduler = JudgeScheduler(maxWaitSec=600, lectureWeights={2: 2.0})
+
+    # バッチ採点が先に大量にキューに入っていても、フォーマットチェックが先に選ばれる
+    batch = [QueuedJudgeRecord(id=i, batch_id=1, lecture_id=1, wait_sec=10) for i in range(1, 101)]
+    interactive = [QueuedJudgeRecord(id=i, batch_id=None, lecture_id=1, wait_sec=1) for i in range(101, 104)]
+    selected = scheduler.select(batch + interactive, 5)
+    assert [candidate.id for candidate in selected] == [101, 102, 103, 1, 2]
+
+    # 授業2のフォーマットチェックは、授業1の2倍選ばれる
+    lecture1 = [QueuedJudgeRecord(id=i, batch_id=None, lecture_id=1, wait_sec=1) for i in range(200, 210)]
+    lecture2 = [QueuedJudgeRecord(id=i, batch_id=None, lecture_id=2, wait_sec=1) for i in range(300, 310)]
+    selected = scheduler.select(lecture1 + lecture2, 6)
+    assert sum(1 for candidate in selected if candidate.lecture_id == 2) == 4
+
+    # 待ち時間の上限を超えたバッチ採点は、フォーマットチェックより先に選ばれる
+    starved = [QueuedJudgeRecord(id=1, batch_id=1, lecture_id=1, wait_sec=700)]
+    selected = scheduler.select(starved + lecture1, 2)
+    assert [candidate.id for candidate in selected] == [1, 200]
+
+    # 待ち時間の上限を超えたバッチ採点が溜まっていても、先に選ばれるのは一部だけでフォーマットチェックも選ばれる
+    scheduler = JudgeScheduler(maxWaitSec=600, overdueShare=0.1)
+    overdue = [QueuedJudgeRecord(id=i, batch_id=1, lecture_id=1, wait_sec=900) for i in range(1, 11)]
+    interactive = [QueuedJudgeRecord(id=i, batch_id=None, lecture_id=1, wait_sec=2) for i in range(101, 104)]
+    selected = scheduler.select(overdue + interactive, 5)
+    assert [candidate.id for candidate in selected] == [1, 101, 102, 103, 2]
+    selected = scheduler.select(overdue[2:] + interactive, 3)
+    assert [candidate.id for candidate in selected] == [101, 102, 103]
+
+
+# ワーカースレッドからの通知で、ジャッジリクエストを取得するループがすぐに起きるかチェック
+def test_DispatchSignal():
+    async def main():
+        signal = DispatchSignal()
+        signal.bind(asyncio.get_running_loop())
+
+        # 通知が無ければタイムアウトする
+        assert not await signal.wait(0.1)
+
+        threading.Timer(0.1, signal.notify).start()
+        start = time.monotonic()
+        assert await signal.wait(5.0)
+        assert time.monotonic() - start < 1.0
+
+        # 待つ前に来た通知も受け取り、受け取った通知は消費される
+        signal.notify()
+        await asyncio.sleep(0)
+        assert await signal.wait(0.1)
+        assert not await signal.wait(0.1)
+
+    asyncio.run(main())
+
+
+# 別のプロセスからのUDPの通知で、ジャッジリクエストを取得するループが起きるかチェック
+def test_ListenWakeup():
+    async def main():
+        signal = DispatchSignal()
+        signal.bind(asyncio.get_running_loop())
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        transport = await listen_wakeup(port, signal)
+        assert transport is not None
+
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(b"wakeup", ("127.0.0.1", port))
+        assert await signal.wait(1.0)
+        transport.close()
+
+    asyncio.run(main())
+
+
+# multipart/form-dataのリクエストボディを少しずつ渡しても、フィールドとファイルを受け取れるかチェック
+def test_MultipartUpload():
+    boundary = "judgeboundary"
+    source = "int main(void) { return 0; }\n" * 1000
+    field = f'--{boundary}\r\nContent-Disposition: form-data; name="student_id"\r\n\r\nsxxxxxxx\r\n'
+    file = (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="files"; filename="../main.c"\r\n'
+        f"Content-Type: text/plain\r\n\r\n{source}\r\n"
+    )
+    end = f"--{boundary}--\r\n"
+
+    async def stream(body: bytes):
+        for i in range(0, len(body), 100):
+            yield body[i:i + 100]
+
+    with TemporaryDirectory() as tempdir:
+        upload = MultipartUpload(Path(tempdir) / "upload")
+        err = asyncio.run(upload.receive(f"multipart/form-data; boundary={boundary}", stream((field + file + end).encode())))
+        assert err.message == ""
+        assert upload.fields == {"student_id": "sxxxxxxx"}
+        # ディレクトリ部分は捨てられる
+        assert upload.files == [Path(tempdir) / "upload" / "main.c"]
+        assert upload.files[0].read_text() == source
+
+        # 同じ名前のファイルが2つあれば失敗し、書き込んだファイルは削除される
+        upload = MultipartUpload(Path(tempdir) / "duplicate")
+        err = asyncio.run(upload.receive(f"multipart/form-data; boundary={boundary}", stream((field + file + file + end).encode())))
+        assert "duplicate" in err.message
+        assert not (Path(tempdir) / "duplicate").exists()
+
+
+# ワーカースレッドで登録したジャッジ結果が、提出とバッチの購読者に1回ずつ配信されるかチェック
+def test_ProgressBus():
+    async def main():
+        bus = ProgressBus()
+        bus.bind(asyncio.get_running_loop())
+        submission = SubmissionRecord(
+            id=1, ts=datetime.now(), batch_id=2, student_id="sxxxxxxx", lecture_id=1, assignment_id=1,
+            for_evaluation=False, progress=SubmissionProgressStatus.RUNNING,
+            prebuilt_result=JudgeSummaryStatus.AC, postbuilt_result=JudgeSummaryStatus.AC,
+            judge_result=JudgeSummaryStatus.UNPROCESSED, message="",
+        )
+        result = JudgeResultRecord(submission_id=1, testcase_id=3, timeMS=10, memoryKB=1024, exit_code=0,
+                                   stdout="", stderr="", result=SingleJudgeStatus.AC)
+
+        with bus.subscribe(submission_topic(1)) as submission_events, bus.subscribe(batch_topic(2)) as batch_events:
+            await asyncio.to_thread(bus.publish, submission, "testcase", result)
+            for events in (submission_events, batch_events):
+                event = await asyncio.wait_for(events.get(), timeout=1.0)
+                assert event.event == "testcase"
+                assert '"testcase_id": 3' in event.data
+                assert '"result": "AC"' in event.data
+                assert events.empty()
+
+    asyncio.run(main())
+
+
+# 別のワーカーがIDの小さい結果を遅れてコミットしても、DatabaseRelayが1回ずつ配信するかチェック
+def test_DatabaseRelayLateCommit(monkeypatch):
+    submission = SubmissionRecord(
+        id=1, ts=datetime.now(), batch_id=None, student_id="sxxxxxxx", lecture_id=1, assignment_id=1,
+        for_evaluation=False, progress=SubmissionProgressStatus.RUNNING,
+        prebuilt_result=JudgeSummaryStatus.AC, postbuilt_result=JudgeSummaryStatus.AC,
+        judge_result=JudgeSummaryStatus.UNPROCESSED, message="",
+    )
+    committed: list[JudgeResultRecord] = []
+
+    # DBの代わりに、コミット済みの結果を全て直近に登録されたものとして返す
+    def fetch_judge_results_after(db, after_id, submission_ids, batch_ids, recent_sec=0):
+        return sorted(committed, key=lambda result: result.id)
+
+    monkeypatch.setattr(progress, "SessionLocal", contextlib.nullcontext)
+    monkeypatch.setattr(progress, "fetch_judge_results_after", fetch_judge_results_after)
+    monkeypatch.setattr(progress, "fetch_submission_records", lambda db, ids, batch_ids: [submission])
+
+    def result(id: int) -> JudgeResultRecord:
+        return JudgeResultRecord(id=id, submission_id=1, testcase_id=id, timeMS=10, memoryKB=1024, exit_code=0,
+                                 stdout="", stderr="", result=SingleJudgeStatus.AC)
+
+    async def main():
+        bus = ProgressBus()
+        bus.bind(asyncio.get_running_loop())
+        relay = DatabaseRelay(bus)
+
+        with bus.subscribe(submission_topic(1)) as events:
+            # ID 2の結果が先にコミットされ、ID 1の結果が後からコミットされる
+            committed.append(result(2))
+            relay.poll()
+            committed.append(result(1))
+            relay.poll()
+            relay.poll()
+            await asyncio.sleep(0.1)
+
+            testcase_ids = []
+            while not events.empty():
+                event = events.get_nowait()
+                if event.event == "testcase":
+                    testcase_ids.append(json.loads(event.data)["testcase_id"])
+            assert testcase_ids == [2, 1]
+
+    asyncio.run(main())
+
+
+# tmpfsの作業ディレクトリにボリュームの内容がコピーされ、書き込みがボリュームに残らないかチェック
+def test_TmpfsWorkDir():
+    volume, err = Volume.create()
+    assert err.message == ""
+
+    with TemporaryDirectory() as tempdir:
+        with open(Path(tempdir) / "test.txt", "w") as f:
+            f.write("Hello, World!")
+
+        err = volume.copyFile(Path(tempdir) / "test.txt", Path("test.txt"))
+        assert err.message == ""
+
+    task = TaskInfo(
+        name="ubuntu",
+        arguments=["sh", "-c", "cat test.txt && touch new.txt && df --output=fstype ."],
+        workDir="/workdir/",
+        memoryLimitMB=256,
+        tmpfsWorkDirMB=16,
+        tmpfsSeedVolume=volume,
+    )
+
+    result, err = task.run()
+
+    test_logger.info(result)
+
+    assert err.message == ""
+    assert result.exitCode == 0
+    assert result.stdout.startswith("Hello, World!")
+    assert "tmpfs" in result.stdout
+
+    # ボリュームには書き込まれていない
+    task = TaskInfo(
+        name="ubuntu",
+        arguments=["ls"],
+        workDir="/workdir/",
+        volumeMountInfo=[VolumeMountInfo(path="/workdir/", volume=volume)],
+    )
+
+    result, err = task.run()
+    assert err.message == ""
+    assert result.stdout == "test.txt\n"
+
+    err = volume.remove()
+    assert err.message == ""
+
+# コンテナプール上でタスクを実行でき、実行ごとに作業ディレクトリが掃除されるかチェック
+def test_ContainerPool():
+    pool = ContainerPoolManager(PoolConfig(size=1, maxUses=10, healthCheckIntervalSec=0))
+
+    volume, err = Volume.create()
+    assert err.message == ""
+
+    with TemporaryDirectory() as tempdir:
+        with open(Path(tempdir) / "test.txt", "w") as f:
+            f.write("Hello, World!")
+
+        err = volume.copyFile(Path(tempdir) / "test.txt", Path("test.txt"))
+        assert err.message == ""
+
+    archive, err = volume.archive()
+    assert err.message == ""
+
+    # 1回目の実行で作業ディレクトリにゴミを残す
+    task = TaskInfo(
+        name="ubuntu",
+        arguments=["sh", "-c", "cat test.txt; touch garbage.txt"],
+        workDir="/workdir/",
+        timeoutSec=5.0,
+    )
+
+    result, err = pool.run(task, archive)
+
+    test_logger.info(result)
+
+    assert err.message == ""
+    assert result.exitCode == 0
+    assert result.stdout == "Hello, World!"
+
+    # 2回目の実行ではゴミが消えている
+    task = TaskInfo(name="ubuntu", arguments=["ls"], workDir="/workdir/", timeoutSec=5.0)
+
+    result, err = pool.run(task, archive)
+
+    test_logger.info(result)
+
+    assert err.message == ""
+    assert result.exitCode == 0
+    assert result.stdout == "test.txt\n"
+
+    # 使い回すコンテナでも、1回きりのコンテナと同じCPU時間の制限がかかっている
+    task = TaskInfo(name="ubuntu", arguments=["sh", "-c", "ulimit -t"], workDir="/workdir/", timeoutSec=5.0)
+
+    result, err = pool.run(task, archive)
+
+    assert err.message == ""
+    assert result.stdout == f"{task.cpuTimeLimitSec()}\n"
+
+    pool.shutdown()
+
+    err = volume.remove()
+    assert err.message == ""
+
+
+# イメージ・リソース制限の組が増えても、プールの数が上限を超えないかチェック
+def test_ContainerPoolEviction():
+    pool = ContainerPoolManager(PoolConfig(size=0, maxPools=2, idleTimeoutSec=0))
+    keys = [
+        PoolKey(name="ubuntu", cpus=1, memoryLimitMB=memoryLimitMB, stackLimitKB=0, pidsLimit=0,
+                enableNetwork=False, workDir="/workdir/", cpuTimeLimitSec=-1)
+        for memoryLimitMB in [256, 512, 1024]
+    ]
+
+    first = pool.pool(keys[0])
+    pool.pool(keys[1])
+    # 使われたプールは後回しにされる
+    pool.pool(keys[0])
+    pool.pool(keys[2])
+
+    assert pool.keys() == [keys[0], keys[2]]
+    assert pool.pool(keys[0]) is first
+
+    # しばらく使われていないプールは破棄される
+    pool = ContainerPoolManager(PoolConfig(size=0, maxPools=8, idleTimeoutSec=60))
+    old = pool.pool(keys[0])
+    old.lastUsed -= 120
+    pool.pool(keys[1])
+    assert pool.keys() == [keys[1]]
+    pool.shutdown()
+
+
+# リセットしない場合は、memory.peakを読み込み専用で開くかチェック(Linux 6.12より前では書き込み用に開けない)
+def test_CgroupPeakReadOnly():
+    with TemporaryDirectory() as tempdir:
+        cgroupPath = Path(tempdir)
+        (cgroupPath / "memory.peak").write_text("1048576\n")
+        (cgroupPath / "memory.current").write_text("4096\n")
+
+        reader = CgroupStatsReader(cgroupPath)
+        assert fcntl.fcntl(reader._memoryPeak, fcntl.F_GETFL) & os.O_ACCMODE == os.O_RDONLY
+        # memory.currentではなくmemory.peakの値が読める
+        assert reader.stats.memoryPeakByte == 1048576
+        reader.close()
+
+
+# memory.peakをリセットできなかったことが分かるかチェック(コンテナプールはそのコンテナを使い回さない)
+def test_CgroupPeakResetFailed():
+    with TemporaryDirectory() as tempdir:
+        cgroupPath = Path(tempdir)
+        (cgroupPath / "memory.peak").write_text("1048576\n")
+
+        reader = CgroupStatsReader(cgroupPath, resetPeak=True)
+        assert not reader.peakResetFailed
+        reader.close()
+
+        # 書き込みが必ず失敗するファイルで、リセットできないカーネルの代わりにする
+        (cgroupPath / "memory.peak").unlink()
+        (cgroupPath / "memory.peak").symlink_to("/dev/full")
+
+        reader = CgroupStatsReader(cgroupPath, resetPeak=True)
+        assert reader.peakResetFailed
+        reader.close()
+
+        reader = CgroupStatsReader(cgroupPath)
+        assert not reader.peakResetFailed
+        reader.close()
+
+
+# judge-harnessで複数のテストケースを1つのコンテナで実行できるかチェック
+def test_BatchTask():
+    task = BatchTaskInfo(
+        name="binary-runner",
+        cases=[
+            BatchCase(arguments=["echo", "Hello, World!"], timeoutSec=1.0),
+            BatchCase(arguments=["sh", "-c", "cat; echo error >&2; exit 3"], Stdin="input\n", timeoutSec=1.0),
+            BatchCase(arguments=["sleep", "3"], timeoutSec=1.0),
+            # 前のテストケースが作業ディレクトリに残したファイルは、次のテストケースからは見えない
+            BatchCase(arguments=["sh", "-c", "touch garbage.txt"], timeoutSec=1.0),
+            BatchCase(arguments=["ls", "-A"], timeoutSec=1.0),
+        ],
+        workDir="/workdir/",
+        memoryLimitMB=256,
+    )
+
+    results, err = task.run()
+
+    test_logger.info(results)
+
+    assert err.message == ""
+    assert len(results) == 5
+
+    assert results[0].exitCode == 0
+    assert results[0].stdout == "Hello, World!\n"
+    assert not results[0].TLE
+
+    assert results[1].exitCode == 3
+    assert results[1].stdout == "input\n"
+    assert results[1].stderr == "error\n"
+
+    assert results[2].TLE
+
+    assert results[3].exitCode == 0
+    assert results[4].stdout == ""
+
 # メモリ制限を検出できるかチェック
 def test_MemoryLimit():
     task = TaskInfo(
@@ -369,6 +1183,8 @@ def test_MemoryLimit():
     assert result.exitCode != 0
     # assert result.TLE == False
     assert abs(result.memoryByte - 500 * 1024 * 1024) < 1024 * 1024
+    # OOM killerにkillされたことを検出できる
+    assert result.MLE
 
 
 # ネットワーク制限をできているかチェック
@@ -465,6 +1281,50 @@ def test_UseManyStack():
     assert err.message == ""
 
 
+# namespaceバックエンドでも、Dockerバックエンドと同じ制限・結果になるかチェック
+@pytest.mark.skipif(
+    not os.path.exists(NAMESPACE_HELPER_PATH), reason="ns-sandbox is not installed"
+)
+def test_NamespaceBackend():
+    task = TaskInfo(name="ubuntu", arguments=["sh", "-c", "cat; echo err >&2; exit 3"], Stdin="hello", backend="namespace")
+    result, err = task.run()
+    assert err.message == ""
+    assert result.exitCode == 3
+    assert result.stdout == "hello"
+    assert result.stderr == "err\n"
+
+    # タイムアウト
+    task = TaskInfo(name="ubuntu", arguments=["sleep", "100"], timeoutSec=1.0, backend="namespace")
+    result, err = task.run()
+    assert err.message == ""
+    assert result.TLE == True
+
+    # メモリ制限
+    task = TaskInfo(name="ubuntu", arguments=["dd", "if=/dev/zero", "of=/dev/null", "bs=800M"], timeoutSec=3.0, memoryLimitMB=500, backend="namespace")
+    result, err = task.run()
+    assert err.message == ""
+    assert result.exitCode != 0
+    assert result.MLE
+
+    # プロセス数制限
+    task = TaskInfo(name="ubuntu", arguments=["sh", "-c", "for i in $(seq 20); do sleep 5 & done; wait"], timeoutSec=3.0, pidsLimit=10, backend="namespace")
+    result, err = task.run()
+    assert err.message == ""
+    assert "fork" in result.stderr or "resource" in result.stderr.lower()
+
+    # ネットワークの無効化
+    task = TaskInfo(name="ubuntu", arguments=["sh", "-c", "cat /sys/class/net/*/operstate"], backend="namespace")
+    result, err = task.run()
+    assert err.message == ""
+    assert "up" not in result.stdout.split()
+
+    # スタックサイズの制限
+    task = TaskInfo(name="ubuntu", arguments=["sh", "-c", "ulimit -s"], stackLimitKB=10240, backend="namespace")
+    result, err = task.run()
+    assert err.message == ""
+    assert result.stdout == "10240\n"
+
+
 # 試しにジャッジリクエストを投じてみて、どのような結果になるか見てみる。
 def test_submit_judge():
     with SessionLocal() as db:
@@ -513,3 +1373,108 @@ def test_submit_judge():
     
     for judge_result in judge_results:
         test_logger.info(judge_result)
+
+
+# 同じ内容の2回目の提出では、1回目のジャッジ結果がコピーされるかチェック
+def test_judge_memo():
+    submissions = []
+    with SessionLocal() as db:
+        for _ in range(2):
+            submission = register_judge_request(
+                db=db,
+                batch_id=None,
+                student_id="sxxxxxxx",
+                lecture_id=1,
+                assignment_id=1,
+                for_evaluation=False,
+            )
+            for name in ["gcd_euclid.c", "main_euclid.c", "Makefile"]:
+                register_uploaded_files(
+                    db=db,
+                    submission_id=submission.id,
+                    path=Path("sample_submission/ex1-1") / name,
+                )
+            submissions.append(submission)
+
+    # キューを経由せずに、順番にジャッジする
+    first = JudgeInfo(submissions[0])
+    memo_keys = first._memo_keys()
+    assert memo_keys is not None
+    assert first.judge().silence()
+
+    second = JudgeInfo(submissions[1])
+    assert second._memo_keys() == memo_keys
+    assert second._reuse_memoized_result(memo_keys)
+
+    with SessionLocal() as db:
+        first_record = fetch_submission_record(db=db, submission_id=submissions[0].id)
+        second_record = fetch_submission_record(db=db, submission_id=submissions[1].id)
+        first_results = fetch_judge_results(db=db, submission_id=submissions[0].id)
+        second_results = fetch_judge_results(db=db, submission_id=submissions[1].id)
+
+    assert second_record.progress == SubmissionProgressStatus.DONE
+    assert second_record.judge_result == first_record.judge_result
+    assert [(r.testcase_id, r.result, r.stdout) for r in second_results] == [
+        (r.testcase_id, r.result, r.stdout) for r in first_results
+    ]
+
+
+# テストケースにTLEが含まれる提出は、まとめの結果が別の結果でもメモに登録されないかチェック
+def test_JudgeMemoSkipsTLE(monkeypatch):
+    judge_info = JudgeInfo.__new__(JudgeInfo)
+    judge_info.submission_record = SubmissionRecord(
+        id=1, ts=datetime.now(), batch_id=None, student_id="sxxxxxxx", lecture_id=1, assignment_id=1,
+        for_evaluation=False, progress=SubmissionProgressStatus.DONE,
+        prebuilt_result=JudgeSummaryStatus.AC, postbuilt_result=JudgeSummaryStatus.AC,
+        judge_result=JudgeSummaryStatus.RE, message="",
+    )
+    registered = []
+
+    class Session:
+        def close(self):
+            pass
+
+    def result(id: int, status: SingleJudgeStatus) -> JudgeResultRecord:
+        return JudgeResultRecord(id=id, submission_id=1, testcase_id=id, timeMS=10, memoryKB=1024, exit_code=0,
+                                 stdout="", stderr="", result=status)
+
+    judge_results = [result(1, SingleJudgeStatus.TLE), result(2, SingleJudgeStatus.RE)]
+    monkeypatch.setattr(judge, "SessionLocal", Session)
+    monkeypatch.setattr(judge, "fetch_judge_results", lambda db, submission_id: judge_results)
+    monkeypatch.setattr(judge, "register_judge_memo", lambda db, memo: registered.append(memo))
+
+    judge_info._register_memo(("content", "problem"))
+    assert registered == []
+
+    # TLEが無ければ登録される
+    judge_results[0] = result(1, SingleJudgeStatus.AC)
+    judge_info._register_memo(("content", "problem"))
+    assert [memo.submission_id for memo in registered] == [1]
+
+
+# 生存の報告が途絶えたワーカーが実行していたジャッジリクエストが、キューに戻されるかチェック
+def test_requeue_dead_worker():
+    worker_id = "test-dead-worker"
+    with SessionLocal() as db:
+        submission = register_judge_request(
+            db=db,
+            batch_id=None,
+            student_id="sxxxxxxx",
+            lecture_id=1,
+            assignment_id=1,
+            for_evaluation=False,
+        )
+        register_worker_heartbeat(db, JudgeWorkerRecord(id=worker_id, hostname="test", pid=0, capacity=1))
+        row = db.query(models.Submission).filter(models.Submission.id == submission.id).first()
+        row.progress = "running"
+        row.worker_id = worker_id
+        db.commit()
+
+        # 報告したばかりのワーカーは生きている
+        assert worker_id in fetch_live_worker_ids(db, timeout_sec=60)
+        assert submission.id not in requeue_submissions_of_dead_workers(db, timeout_sec=60)
+
+        time.sleep(2)
+        assert worker_id not in fetch_live_worker_ids(db, timeout_sec=1)
+        assert submission.id in requeue_submissions_of_dead_workers(db, timeout_sec=1)
+        assert fetch_judge_status(db, submission.id) == SubmissionProgressStatus.QUEUED
@@ -0,0 +1,156 @@
+"""
+このプログラムでは、multipart/form-dataで送られた提出を受け取る処理を実装する。
+* リクエストボディを読みながら、ファイルをRESOURCE_PATH以下のディレクトリに直接書き込むクラスMultipartUpload
+
+starletteのrequest.form()はファイルを一時ファイルに溜めてから渡すが、ここでは受け取ったチャンクを
+そのまま保存先のファイルに書き込むので、ファイル全体をメモリや一時ファイルに持つことはない。
+"""
+
+import os
+import shutil
+from pathlib import Path
+from typing import AsyncIterator, BinaryIO
+
+from dotenv import load_dotenv
+from multipart.multipart import MultipartParser, parse_options_header
+
+from sandbox.my_error import Error
+
+load_dotenv()
+
+# 1つのファイルの大きさの上限[byte]と、1つの提出のファイル数の上限
+UPLOAD_MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_FILE_KB", "1024")) * 1024
+UPLOAD_MAX_FILES = int(os.getenv("UPLOAD_MAX_FILES", "32"))
+# ファイル以外のフィールド(student_id等)の値の大きさの上限[byte]
+_MAX_FIELD_BYTES = 1024
+
+
+class _Abort(Exception):
+    pass
+
+
+class MultipartUpload:
+    directory: Path  # ファイルを書き込むディレクトリ
+    fields: dict[str, str]  # ファイル以外のフィールドの値
+    files: list[Path]  # 書き込んだファイルのパス(受け取った順)
+    _err: Error
+    _header_field: bytes
+    _header_value: bytes
+    _headers: dict[bytes, bytes]
+    _field_name: str
+    _field_value: bytearray
+    _file: BinaryIO | None
+    _file_size: int
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.fields = {}
+        self.files = []
+        self._err = Error.Nothing()
+        self._header_field = b""
+        self._header_value = b""
+        self._headers = {}
+        self._field_name = ""
+        self._field_value = bytearray()
+        self._file = None
+        self._file_size = 0
+
+    def _fail(self, message: str) -> None:
+        self._err = Error(message)
+        raise _Abort()
+
+    def _on_part_begin(self) -> None:
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._headers.get(b"content-disposition"))
+        if b"name" not in options:
+            self._fail("multipart part without a name")
+        self._field_name = options[b"name"].decode("utf-8")
+        self._field_value = bytearray()
+
+        if b"filename" not in options:
+            return
+        # 提出されたファイルは作業ディレクトリの直下にファイル名でコピーされるので、ディレクトリ部分は捨てる
+        filename = Path(options[b"filename"].decode("utf-8")).name
+        if filename in ("", ".", ".."):
+            self._fail(f"invalid filename: {options[b'filename']!r}")
+        if len(self.files) >= UPLOAD_MAX_FILES:
+            self._fail(f"too many files (max {UPLOAD_MAX_FILES})")
+        path = self.directory / filename
+        if path in self.files:
+            self._fail(f"duplicate filename: {filename}")
+        self._file = open(path, mode="wb")
+        self._file_size = 0
+        self.files.append(path)
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._file is not None:
+            self._file_size += end - start
+            if self._file_size > UPLOAD_MAX_FILE_BYTES:
+                self._fail(f"{self.files[-1].name} is too large (max {UPLOAD_MAX_FILE_BYTES} bytes)")
+            self._file.write(data[start:end])
+            return
+        self._field_value += data[start:end]
+        if len(self._field_value) > _MAX_FIELD_BYTES:
+            self._fail(f"field {self._field_name} is too large")
+
+    def _on_part_end(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            return
+        self.fields[self._field_name] = self._field_value.decode("utf-8")
+
+    async def receive(self, contentType: str, stream: AsyncIterator[bytes]) -> Error:
+        """
+        リクエストボディを読み、ファイルをdirectoryに書き込みます。
+        失敗した場合は、directoryごと書き込んだファイルを削除します。
+        """
+        mediaType, options = parse_options_header(contentType)
+        if mediaType != b"multipart/form-data" or b"boundary" not in options:
+            return Error("Content-Type must be multipart/form-data")
+
+        parser = MultipartParser(
+            options[b"boundary"],
+            callbacks={
+                "on_part_begin": self._on_part_begin,
+                "on_part_data": self._on_part_data,
+                "on_part_end": self._on_part_end,
+                "on_header_field": self._on_header_field,
+                "on_header_value": self._on_header_value,
+                "on_header_end": self._on_header_end,
+                "on_headers_finished": self._on_headers_finished,
+            },
+        )
+        try:
+            self.directory.mkdir(parents=True)
+            async for chunk in stream:
+                parser.write(chunk)
+            parser.finalize()
+        except _Abort:
+            pass
+        except Exception as e:
+            self._err = Error(f"failed to receive upload: {type(e).__name__}: {e}")
+        finally:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+        if not self._err.silence():
+            self.discard()
+        return self._err
+
+    def discard(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,420 @@
+"""
+このプログラムでは、キューからジャッジリクエストを取得して実行するワーカーを実装する。
+* ジャッジリクエストを取得して実行するループprocess_judge_requests
+* ワーカーの生存をJudgeWorkerテーブルに報告し、止まったワーカーのジャッジリクエストをキューに戻すループreport_heartbeat
+* 削除されずに残ったコンテナ・ボリュームを削除するループreap_orphan_resources
+* APIサーバーからの、ジャッジリクエストを登録したという通知(UDP)を受け取るlisten_wakeup
+
+ワーカーは単独のプロセスとして起動できる(python worker.py)。同じDBを見るワーカーを、同じホストにも
+別のホストにもいくつでも起動でき、ジャッジリクエストはFOR UPDATE SKIP LOCKEDで重複せずに分け合う。
+JUDGE_EMBEDDED_WORKER=true(既定)の場合は、APIサーバー(main.py)のプロセスでも同じループを実行する。
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable
+
+from dotenv import load_dotenv
+
+from db.crud import *
+from db.database import SessionLocal
+from judge import JudgeInfo, prewarm_container_pool
+from progress import progress_bus
+from sandbox.cpuset import cpuset_allocator
+from sandbox.labels import INSTANCE_ID, owned_by
+from sandbox.my_error import Error
+from sandbox.pool import container_pool
+from sandbox.reaper import REAPER_INTERVAL_SEC, reap_orphans
+from scheduler import JudgeScheduler
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("uvicorn")
+
+load_dotenv()
+
+# trueの場合、ジャッジをスレッドプールではなくイベントループ上のコルーチンとして実行する
+JUDGE_ASYNC = os.getenv("JUDGE_ASYNC", "false").lower() == "true"
+# JUDGE_ASYNCの場合に同時に実行するジャッジの数
+ASYNC_MAX_JOBS = int(os.getenv("ASYNC_MAX_JOBS", "200"))
+# 通知が無くてもDBを見に行く間隔[秒]。キューが空の間は最小値から最大値まで倍々に延ばす
+JUDGE_POLL_MIN_SEC = float(os.getenv("JUDGE_POLL_MIN_SEC", "0.5"))
+JUDGE_POLL_MAX_SEC = float(os.getenv("JUDGE_POLL_MAX_SEC", "10"))
+# 生存を報告する間隔[秒]と、報告が途絶えたワーカーを止まったとみなすまでの時間[秒]
+JUDGE_WORKER_HEARTBEAT_SEC = float(os.getenv("JUDGE_WORKER_HEARTBEAT_SEC", "10"))
+JUDGE_WORKER_TIMEOUT_SEC = float(os.getenv("JUDGE_WORKER_TIMEOUT_SEC", "60"))
+# JudgeWorkerテーブルに生きていると報告されていないインスタンスのリソースを削除するまでの時間[秒]
+# (最初の報告が遅れたワーカーや、生存を報告しない古いプロセスのリソースを作成直後に削除しないため)
+REAPER_UNKNOWN_INSTANCE_GRACE_SEC = JUDGE_WORKER_TIMEOUT_SEC * 5
+# APIサーバーが別のプロセスのワーカーに、ジャッジリクエストを登録したことを知らせるUDPのポート(0なら知らせない)
+JUDGE_WAKEUP_PORT = int(os.getenv("JUDGE_WAKEUP_PORT", "47100"))
+
+
+# ジャッジの終了・ジャッジリクエストの登録を、ジャッジリクエストを取得するループに知らせる
+class DispatchSignal:
+    _event: asyncio.Event
+    _loop: asyncio.AbstractEventLoop | None
+
+    def __init__(self):
+        self._event = asyncio.Event()
+        self._loop = None
+
+    def bind(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+
+    def notify(self) -> None:
+        # ワーカースレッドからも呼ばれるので、イベントループのスレッドでsetする
+        loop = self._loop
+        if loop is None:
+            return
+        try:
+            loop.call_soon_threadsafe(self._event.set)
+        except RuntimeError:
+            # イベントループが既に閉じている(シャットダウン中)
+            pass
+
+    async def wait(self, timeoutSec: float) -> bool:
+        """
+        通知が来るか、timeoutSec秒経つまで待ちます。通知が来た場合はTrueを返します。
+        """
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout=timeoutSec)
+            return True
+        except TimeoutError:
+            return False
+        finally:
+            # 待っている間に来た通知はここで消費し、この後に来た通知は次のwaitで受け取る
+            self._event.clear()
+
+
+dispatch_signal = DispatchSignal()
+
+
+# 受け取ったデータグラムの内容に関わらず、キューを見に行くループを起こす
+class _WakeupProtocol(asyncio.DatagramProtocol):
+    dispatch: DispatchSignal
+
+    def __init__(self, dispatch: DispatchSignal):
+        self.dispatch = dispatch
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        self.dispatch.notify()
+
+
+async def listen_wakeup(
+    port: int = JUDGE_WAKEUP_PORT, dispatch: DispatchSignal = dispatch_signal
+) -> asyncio.DatagramTransport | None:
+    """
+    APIサーバーからの通知をportで受け取り始め、そのトランスポートを返します。受け取れなければNoneを返します。
+    同じホストの複数のワーカーが同じポートで受け取れるように、SO_REUSEPORTを使います。
+    """
+    if port <= 0:
+        return None
+    try:
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: _WakeupProtocol(dispatch), local_addr=("0.0.0.0", port), reuse_port=True
+        )
+    except OSError as e:
+        logger.error(f"ジャッジリクエストの通知を受け取れません(port {port}): {e}")
+        return None
+    return transport
+
+
+def wake_up_workers(port: int = JUDGE_WAKEUP_PORT) -> None:
+    """
+    生きているワーカーのホストに、キューを見に行くように知らせます。DBを読むので別スレッドで呼んでください。
+    通知が届かなくても、ワーカーはJUDGE_POLL_MAX_SEC秒以内にキューを見に行きます。
+    """
+    if port <= 0:
+        return
+    with SessionLocal() as db:
+        hostnames = fetch_live_worker_hostnames(db, JUDGE_WORKER_TIMEOUT_SEC)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for hostname in hostnames:
+            try:
+                sock.sendto(b"wakeup", (hostname, port))
+            except OSError as e:
+                logger.info(f"failed to wake up workers on {hostname}: {e}")
+
+
+class WorkerPool:
+    max_workers: int
+    executor: ThreadPoolExecutor
+    active_jobs: dict
+    on_done: Callable[[], None] | None  # ジャッジが終わったときに(ワーカースレッドで)呼ばれる
+
+    def __init__(self, max_workers: int, on_done: Callable[[], None] | None = None):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.active_jobs = {}
+        self.on_done = on_done
+
+    def available_workers(self) -> int:
+        return self.max_workers - len(self.active_jobs)
+
+    def collect_completed_jobs(self) -> list:
+        now_completed = [job for job, future in self.active_jobs.items() if future.done()]
+        completed_jobrecord = [(job[0], job[1], future.result()) for job, future in self.active_jobs.items() if future.done()]
+        for job in now_completed:
+            self.active_jobs.pop(job)
+        return completed_jobrecord
+
+    def submit_job(self, job: str, func, *args, **kwargs):
+        if self.available_workers() > 0:
+            future = self.executor.submit(func, *args, **kwargs)
+            self.active_jobs[(job, datetime.now())] = future
+            if self.on_done is not None:
+                on_done = self.on_done
+                future.add_done_callback(lambda _: on_done())
+            return True
+        return False
+    
+
+# WorkerPoolと同じインターフェースで、ジャッジをasyncioのタスクとして実行する
+class AsyncJobPool:
+    max_jobs: int
+    active_jobs: dict
+    on_done: Callable[[], None] | None  # ジャッジが終わったときに呼ばれる
+
+    def __init__(self, max_jobs: int, on_done: Callable[[], None] | None = None):
+        self.max_jobs = max_jobs
+        self.active_jobs = {}
+        self.on_done = on_done
+
+    def available_workers(self) -> int:
+        return self.max_jobs - len(self.active_jobs)
+
+    def collect_completed_jobs(self) -> list:
+        now_completed = [job for job, task in self.active_jobs.items() if task.done()]
+        completed_jobrecord = []
+        for job in now_completed:
+            task = self.active_jobs.pop(job)
+            if task.cancelled():
+                result = Error("cancelled")
+            elif task.exception() is not None:
+                result = Error(f"{type(task.exception()).__name__}: {task.exception()}")
+            else:
+                result = task.result()
+            completed_jobrecord.append((job[0], job[1], result))
+        return completed_jobrecord
+
+    def submit_job(self, job: str, func, *args, **kwargs):
+        if self.available_workers() > 0:
+            task = asyncio.create_task(func(*args, **kwargs))
+            self.active_jobs[(job, datetime.now())] = task
+            if self.on_done is not None:
+                on_done = self.on_done
+                task.add_done_callback(lambda _: on_done())
+            return True
+        return False
+
+    async def shutdown(self) -> None:
+        # 実行中のジャッジを最後まで待つ
+        await asyncio.gather(*self.active_jobs.values(), return_exceptions=True)
+
+# コアを割り当てる場合は、同時に実行するジャッジの数を割り当てられる数に合わせる
+# (ジャッジを取得した時点で必ずコアが空いているので、計測が他のジャッジの影響を受けない)
+if cpuset_allocator.enabled():
+    MAX_JOBS = cpuset_allocator.capacity()
+else:
+    MAX_JOBS = ASYNC_MAX_JOBS if JUDGE_ASYNC else 50
+
+# ジャッジが終わったら、次のジャッジリクエストをすぐに取得する
+if JUDGE_ASYNC:
+    worker_pool = AsyncJobPool(max_jobs=MAX_JOBS, on_done=dispatch_signal.notify)
+else:
+    worker_pool = WorkerPool(max_workers=MAX_JOBS, on_done=dispatch_signal.notify)
+
+# キューから次に実行するジャッジリクエストを選ぶ(フォーマットチェック優先、授業・バッチごとに公平に)
+judge_scheduler = JudgeScheduler.from_env()
+
+def process_one_judge_request(submission: SubmissionRecord) -> Error:
+    logger.info(f"JudgeInfo(submission_id={submission.id}, lecture_id={submission.lecture_id}, assignment_id={submission.assignment_id}, for_evaluation={submission.for_evaluation}) will be created...")
+    # 作成したコンテナ・ボリュームに提出IDのラベルを付け、コンテナにはこのジャッジ用のコアを使わせる
+    with owned_by(submission.id), cpuset_allocator.allocated() as cpuset:
+        judge_info = JudgeInfo(submission, cpuset=cpuset)
+        logger.info("START JUDGE...")
+        err = judge_info.judge()
+        logger.info("END JUDGE")
+    
+    return err
+
+async def process_one_judge_request_async(submission: SubmissionRecord) -> Error:
+    logger.info(f"JudgeInfo(submission_id={submission.id}, lecture_id={submission.lecture_id}, assignment_id={submission.assignment_id}, for_evaluation={submission.for_evaluation}) will be created...")
+    # 作成したコンテナ・ボリュームに提出IDのラベルを付け、コンテナにはこのジャッジ用のコアを使わせる
+    with owned_by(submission.id):
+        async with cpuset_allocator.allocatedAsync() as cpuset:
+            # JudgeInfoの初期化はDBを読むので別スレッドで行う
+            judge_info = await asyncio.to_thread(JudgeInfo, submission, cpuset)
+            logger.info("START JUDGE...")
+            err = await judge_info.judge_async()
+            logger.info("END JUDGE")
+
+    return err
+
+# ジャッジの終了やジャッジリクエストの登録の通知が来たらすぐに、来なくてもpoll_sec秒ごとにキューを見る
+async def process_judge_requests():
+    dispatch_signal.bind(asyncio.get_running_loop())
+    poll_sec = JUDGE_POLL_MIN_SEC
+    while True:
+        try:
+            completed_jobrecord_list = worker_pool.collect_completed_jobs()
+            for completed_jobrecord in completed_jobrecord_list:
+                logger.info(f"job: \"{completed_jobrecord[0]}\", date: {completed_jobrecord[1]}, result: {completed_jobrecord[2]}")
+            with SessionLocal() as db:
+                num_available_workers = worker_pool.available_workers()
+                queued_submissions = fetch_queued_judge_and_change_status_to_running(
+                    db, num_available_workers, select=judge_scheduler.select, worker_id=INSTANCE_ID
+                )
+            if queued_submissions:
+                poll_sec = JUDGE_POLL_MIN_SEC
+                logger.info(
+                    f"{len(queued_submissions)}件のジャッジリクエストを取得しました。"
+                )
+                # スレッドプールを使用して各ジャッジリクエストを処理
+                for submission in queued_submissions:
+                    logger.info(f"submission: {submission}")
+                    if JUDGE_ASYNC:
+                        logger.info("throw judge request to event loop...")
+                        worker_pool.submit_job(f"submission-{submission.id}", process_one_judge_request_async, submission)
+                    else:
+                        logger.info("throw judge request to thread pool...")
+                        worker_pool.submit_job(f"submission-{submission.id}", process_one_judge_request, submission)
+            elif num_available_workers > 0:
+                # キューが空の間は、DBを見に行く間隔を延ばしていく
+                poll_sec = min(poll_sec * 2, JUDGE_POLL_MAX_SEC)
+                logger.info("キューにジャッジリクエストはありません。")
+        except Exception as e:
+            import traceback
+            logger.error(f"例外が発生しました: {type(e).__name__}: {str(e)}")
+            logger.error(f"スタックトレース:\n{traceback.format_exc()}")
+            logger.info("データベースに接続できない可能性があります。準備ができていない可能性があります。")
+            poll_sec = JUDGE_POLL_MAX_SEC
+
+        await dispatch_signal.wait(poll_sec)
+
+
+def _live_instances() -> set[str]:
+    with SessionLocal() as db:
+        return fetch_live_worker_ids(db, JUDGE_WORKER_TIMEOUT_SEC) | {INSTANCE_ID}
+
+
+# 実行中のジャッジに属さないコンテナ・ボリューム(ジャッジやワーカーが途中で落ちた等で残ったもの)を定期的に削除する
+async def reap_orphan_resources():
+    while True:
+        try:
+            live_submission_ids = {
+                job.removeprefix("submission-") for job, _ in worker_pool.active_jobs
+            }
+            # 他のワーカーが作成したものは、そのワーカーが生きている間は削除しない
+            live_instances = await asyncio.to_thread(_live_instances)
+            await asyncio.to_thread(
+                reap_orphans,
+                live_submission_ids,
+                live_instances,
+                unknownInstanceGraceSec=REAPER_UNKNOWN_INSTANCE_GRACE_SEC,
+            )
+        except Exception as e:
+            logger.error(f"孤児リソースの削除に失敗しました: {type(e).__name__}: {str(e)}")
+
+        await asyncio.sleep(REAPER_INTERVAL_SEC)
+
+
+def _worker_record() -> JudgeWorkerRecord:
+    return JudgeWorkerRecord(
+        id=INSTANCE_ID,
+        hostname=socket.gethostname(),
+        pid=os.getpid(),
+        capacity=MAX_JOBS,
+        running=len(worker_pool.active_jobs),
+    )
+
+
+def _register_heartbeat() -> None:
+    with SessionLocal() as db:
+        register_worker_heartbeat(db, _worker_record())
+
+
+# ワーカーの生存を報告し、報告が途絶えたワーカーが実行していたジャッジリクエストをキューに戻す
+async def report_heartbeat():
+    while True:
+        try:
+            def report() -> list[int]:
+                with SessionLocal() as db:
+                    register_worker_heartbeat(db, _worker_record())
+                    return requeue_submissions_of_dead_workers(db, JUDGE_WORKER_TIMEOUT_SEC)
+
+            requeued = await asyncio.to_thread(report)
+            if requeued:
+                logger.info(f"止まったワーカーのジャッジリクエストをキューに戻しました: {requeued}")
+                dispatch_signal.notify()
+        except Exception as e:
+            logger.error(f"ワーカーの生存の報告に失敗しました: {type(e).__name__}: {str(e)}")
+
+        await asyncio.sleep(JUDGE_WORKER_HEARTBEAT_SEC)
+
+
+async def start_worker() -> list[asyncio.Task]:
+    """
+    ジャッジリクエストを取得して実行するループ等を開始し、そのタスクのリストを返します。
+    """
+    progress_bus.bind(asyncio.get_running_loop())
+    # 他のワーカーに孤児とみなされないように、コンテナ等を作る前に生存を報告しておく
+    try:
+        await asyncio.to_thread(_register_heartbeat)
+    except Exception as e:
+        logger.error(f"ワーカーの生存の報告に失敗しました: {type(e).__name__}: {str(e)}")
+    await asyncio.to_thread(prewarm_container_pool)
+    return [
+        asyncio.create_task(process_judge_requests()),
+        asyncio.create_task(report_heartbeat()),
+        asyncio.create_task(reap_orphan_resources()),
+    ]
+
+
+async def stop_worker(tasks: list[asyncio.Task]) -> None:
+    """
+    新しいジャッジリクエストの取得をやめ、実行中のジャッジを最後まで実行してから終了します。
+    """
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    # 現在実行しているジャッジリクエストを最後まで実行し、保留状態のものは破棄する
+    if JUDGE_ASYNC:
+        await worker_pool.shutdown()
+    else:
+        await asyncio.to_thread(worker_pool.executor.shutdown, wait=True, cancel_futures=True)
+    container_pool.shutdown()
+    completed_jobrecord_list = worker_pool.collect_completed_jobs()
+    for completed_jobrecord in completed_jobrecord_list:
+        logger.info(f"job: \"{completed_jobrecord[0]}\", date: {completed_jobrecord[1]}, result: {completed_jobrecord[2]}")
+    # このワーカーがstatusをrunningにしてしまっているタスクをqueuedに戻す
+    # そして途中結果を削除する
+    with SessionLocal() as db:
+        undo_running_submissions(db, worker_id=INSTANCE_ID)
+        unregister_worker(db, INSTANCE_ID)
+
+
+# SIGINT・SIGTERMを受け取るまでジャッジを実行する
+async def main():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    logger.info(f"worker {INSTANCE_ID} on {socket.gethostname()} started")
+    tasks = await start_worker()
+    wakeup = await listen_wakeup()
+    await stop.wait()
+    logger.info(f"worker {INSTANCE_ID} is stopping...")
+    if wakeup is not None:
+        wakeup.close()
+    await stop_worker(tasks)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())